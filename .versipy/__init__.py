@@ -6,4 +6,4 @@ __description__ = "__package_description__"
 __url__ = "__package_url__"
 __licence__ = "__package_licence__"
 __author__ = "__author_name__"
-__all__ = ["pycoQC", "Fast5_to_seq_summary", "Barcode_split", "common"]
+__all__ = ["pycoQC", "Fast5_to_seq_summary", "Barcode_split", "Reads_query", "common"]
@@ -33,6 +33,9 @@ setup(
         '__dependency_6__',
         '__dependency_7__',
         '__dependency_8__'],
+    extras_require = {
+        'zstd': ['zstandard'],
+        'lz4': ['lz4']},
     packages = ['__package_name__'],
     package_dir = {'__package_name__': '__package_name__'},
     package_data = {'__package_name__': ['templates/*']},
@@ -40,5 +43,6 @@ setup(
         'console_scripts': [
             '__entry_point_1__',
             '__entry_point_2__',
-            '__entry_point_3__']}
+            '__entry_point_3__',
+            '__entry_point_4__']}
 )
@@ -29,6 +29,7 @@ def Barcode_split (
     output_dir:str="",
     output_unclassified:bool=False,
     min_barcode_percent:float=0.1,
+    threads:int=1,
     verbose:bool=False,
     quiet:bool=False):
     """
@@ -46,6 +47,8 @@ def Barcode_split (
         If True unclassified barcodes are also written in a file. By default they are skiped
     * min_barcode_percent
         Minimal percent of total reads to write barcode reads in file.
+    * threads
+        Number of processes and threads to use to parse and decompress the input files
     * verbose
         Increase verbosity
     * quiet
@@ -68,7 +71,7 @@ def Barcode_split (
     # Process data
     logger.warning ("Import data from sequencing summary file(s) and cleanup")
     logger.info ("\tRead files and import in a dataframe")
-    pps = pycoQC_parse(summary_file=summary_file, barcode_file=barcode_file, cleanup=False, verbose=verbose, quiet=quiet)
+    pps = pycoQC_parse(summary_file=summary_file, barcode_file=barcode_file, cleanup=False, threads=threads, verbose=verbose, quiet=quiet)
     df = pps.reads_df
 
     # Rename barcode field and check if present
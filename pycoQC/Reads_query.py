@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~IMPORTS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+# Standard library imports
+from collections import *
+import warnings
+import datetime
+import sys
+
+# Third party imports
+import pandas as pd
+
+# Local lib import
+from pycoQC import __name__ as package_name
+from pycoQC import __version__ as package_version
+from pycoQC.common import *
+from pycoQC.pycoQC_parse import pycoQC_parse
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~GLOBAL SETTINGS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+# Silence futurewarnings
+warnings.filterwarnings("ignore", category=FutureWarning)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~MAIN CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+def Reads_query (
+    summary_file:str,
+    barcode_file:str="",
+    bam_file:str="",
+    read_ids:list=[],
+    read_ids_file:str="",
+    filters:dict={},
+    columns:list=None,
+    output_file:str="",
+    runid_list:list=[],
+    filter_calibration:bool=False,
+    filter_duplicated:bool=False,
+    min_barcode_percent:float=0.1,
+    threads:int=1,
+    cache_dir:str="",
+    progress_bar:bool=False,
+    verbose:bool=False,
+    quiet:bool=False):
+    """
+    Extract the cleaned records of specific reads, or of all the reads matching column conditions, from sequencing summary
+    files and optional barcode and Bam files. Selected reads are written in a tabulated file.
+    With cache_dir, both the parsed files and the read index are reused by subsequent queries
+    * summary_file
+        Path to a sequencing_summary generated by Albacore 1.0.0 + (read_fast5_basecaller.py) / Guppy 2.1.3+ (guppy_basecaller).
+        One can also pass multiple space separated file paths or a UNIX style regex matching multiple files
+    * barcode_file
+        Path to the barcode_file generated by Guppy 2.1.3+ (guppy_barcoder) or Deepbinner 0.2.0+. This is not a required file.
+        One can also pass multiple space separated file paths or a UNIX style regex matching multiple files
+    * bam_file
+        Path to a Bam file corresponding to reads in the summary_file. This is not a required file.
+        One can also pass multiple space separated file paths or a UNIX style regex matching multiple files
+        Sorting and indexing are optional: unsorted SAM/BAM files are parsed sequentially and "-" reads alignments streamed from stdin
+    * read_ids
+        List of read_ids to select
+    * read_ids_file
+        Path to a file containing read_ids to select, one per line
+    * filters
+        Dict of column names to conditions, given as a dict with any of the keys "isin" (list of values to keep),
+        "min" and "max" (inclusive bounds)
+    * columns
+        List of columns to write. By default all the columns are written
+    * output_file
+        Path to the output tabulated file. By default the reads are written to the standard output
+    * runid_list
+        Select only specific runids
+    * filter_calibration
+        If True read flagged as calibration strand by the software are removed
+    * filter_duplicated
+        If True duplicated read_ids are removed but the first occurence is kept
+    * min_barcode_percent
+        Minimal percent of total reads to retain barcode label. If below the barcode value is set as `unclassified`.
+    * threads
+        Number of processes and threads to use to parse and decompress the input files
+    * cache_dir
+        If given, parsed files and the read index are cached in this directory
+    * progress_bar
+        If True, display a progress bar of the bytes read for each parsing stage
+    * verbose
+        Increase verbosity
+    * quiet
+        Reduce verbosity
+    """
+
+    # Save args and init options in dict for report
+    options_d = locals()
+    info_d = {"package_name":package_name, "package_version":package_version, "timestamp":str(datetime.datetime.now())}
+
+    # Set logging level
+    logger = get_logger (name=__name__, verbose=verbose, quiet=quiet)
+
+    # Print debug info
+    logger.debug("General info")
+    logger.debug(dict_to_str(info_d))
+    logger.debug("Runtime options")
+    logger.debug(dict_to_str(options_d))
+
+    # Collect read_ids to select
+    read_ids = list(read_ids)
+    if read_ids_file:
+        with open_file (read_ids_file) as fp:
+            read_ids.extend([line.strip().decode() for line in fp if line.strip()])
+    if not read_ids and not filters:
+        raise pycoQCError ("At least one read_id or filter is required")
+
+    # Import data
+    logger.warning ("Import data from sequencing summary file(s) and cleanup")
+    pps = pycoQC_parse(
+        summary_file=summary_file,
+        barcode_file=barcode_file,
+        bam_file=bam_file,
+        runid_list=runid_list,
+        filter_calibration=filter_calibration,
+        filter_duplicated=filter_duplicated,
+        min_barcode_percent=min_barcode_percent,
+        threads=threads,
+        cache_dir=cache_dir,
+        progress_bar=progress_bar,
+        verbose=verbose,
+        quiet=quiet)
+
+    logger.warning ("Query reads")
+    df = pps.query(read_ids=read_ids or None, filters=filters, columns=columns)
+    logger.info ("\t{:,} reads selected".format(len(df)))
+
+    # Write selected reads
+    df.to_csv(output_file if output_file else sys.stdout, sep="\t")
+    return df
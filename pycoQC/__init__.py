@@ -6,4 +6,4 @@ __description__ = "PycoQC computes metrics and generates interactive QC plots fo
 __url__ = "https://github.com/a-slide/pycoQC"
 __licence__ = "GPLv3"
 __author__ = "Adrien Leger & Tommaso Leonardi"
-__all__ = ["pycoQC", "Fast5_to_seq_summary", "Barcode_split", "common"]
+__all__ = ["pycoQC", "Fast5_to_seq_summary", "Barcode_split", "Reads_query", "common"]
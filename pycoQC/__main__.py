@@ -15,6 +15,7 @@ from jinja2 import Environment, PackageLoader, Template
 from pycoQC.pycoQC import pycoQC
 from pycoQC.Fast5_to_seq_summary import Fast5_to_seq_summary
 from pycoQC.Barcode_split import Barcode_split
+from pycoQC.Reads_query import Reads_query
 from pycoQC.common import get_logger
 from pycoQC import __version__ as package_version
 from pycoQC import __name__ as package_name
@@ -36,7 +37,10 @@ def main_pycoQC (args=None):
             * Including Guppy barcoding file + html output + json output
                 pycoQC -f sequencing_summary.txt -b barcoding_sequencing.txt -o pycoQC_output.html -j pycoQC_output.json
             * Including Bam file + html output
-                pycoQC -f sequencing_summary.txt -a alignment.bam -o pycoQC_output.html"""))
+                pycoQC -f sequencing_summary.txt -a alignment.bam -o pycoQC_output.html
+            * Partial QC states of several flowcells merged in a single report
+                pycoQC -f flowcell_1/sequencing_summary.txt --state_outfile flowcell_1.state.npz
+                pycoQC --state_file flowcell_*.state.npz -o pycoQC_output.html"""))
     parser.add_argument('--version', action='version', version="{} v{}".format(package_name, package_version))
 
     # Define arguments
@@ -49,11 +53,18 @@ def main_pycoQC (args=None):
         One can also pass multiple space separated file paths or a UNIX style regex matching multiple files (optional)"""))
     parser_io.add_argument("--bam_file", "-a", default=[], nargs='*',
         help=textwrap.dedent("""Path to a Bam file corresponding to reads in the summary_file. Preferably aligned with Minimap2
-          One can also pass multiple space separated file paths or a UNIX style regex matching multiple files (optional)"""))
+          One can also pass multiple space separated file paths or a UNIX style regex matching multiple files
+          Unsorted SAM/BAM files are accepted and "-" reads alignments streamed from stdin, for example piped from minimap2 (optional)"""))
     parser_io.add_argument("--html_outfile", "-o", default="", type=str,
         help="Path to an output html file report (required if json_outfile not given)")
     parser_io.add_argument("--json_outfile", "-j", default="", type=str,
         help="Path to an output json file report (required if html_outfile not given)")
+    parser_io.add_argument("--state_outfile", default="", type=str,
+        help=textwrap.dedent("""Path to an output file where to save the partial QC state of the reads. States of several subsets of reads,
+        for example flowcells processed on different nodes, can then be merged in a single report with --state_file (optional)"""))
+    parser_io.add_argument("--state_file", default=[], nargs='*',
+        help=textwrap.dedent("""Partial QC state files generated with --state_outfile to merge and report on instead of summary files.
+        One can also pass multiple space separated file paths or a UNIX style regex matching multiple files (optional)"""))
     parser_filt = parser.add_argument_group('Filtering options')
     parser_filt.add_argument("--min_pass_qual", default=7, type=float,
         help="Minimum quality to consider a read as 'pass' (default: %(default)s)")
@@ -64,6 +75,15 @@ def main_pycoQC (args=None):
     parser_filt.add_argument("--filter_duplicated", default=False, action='store_true',
         help=textwrap.dedent("""If given, duplicated read_ids are removed but the first occurence is kept
         (Guppy sometimes outputs the same read multiple times) (default: %(default)s)"""))
+    parser_filt.add_argument("--runid_list", default=[], nargs='*',
+        help=textwrap.dedent("""Select only specific runids to be analysed. Can also be used to force pycoQC to order the runids for
+        temporal plots, if the sequencing_summary file contain several sucessive runs (default: all runids)"""))
+    parser_filt.add_argument("--min_time", default=0, type=float,
+        help="Only select reads starting after min_time hours from the beginning of their run (default: %(default)s)")
+    parser_filt.add_argument("--max_time", default=0, type=float,
+        help="If not 0, only select reads starting before max_time hours from the beginning of their run (default: %(default)s)")
+    parser_filt.add_argument("--pass_only", default=False, action='store_true',
+        help="If given, only the 'pass' reads defined by --min_pass_qual and --min_pass_len are selected (default: %(default)s)")
     parser_filt.add_argument("--min_barcode_percent", default=0.1, type=float,
         help="Minimal percent of total reads to retain barcode label. If below, the barcode value is set as `unclassified` (default: %(default)s)")
     parser_html = parser.add_argument_group('HTML report options')
@@ -82,6 +102,26 @@ def main_pycoQC (args=None):
     parser_other.add_argument("--sample", default=100000, type=int,
         help=textwrap.dedent("""If not None a n number of reads will be randomly selected instead of the entire dataset for ploting function
         (deterministic sampling) (default: %(default)s)"""))
+    parser_other.add_argument("--threads", "-t", default=1, type=int,
+        help="Number of processes to use to parse multiple summary or barcode files concurrently. Remaining threads are used to decompress the input files (default: %(default)s)")
+    parser_other.add_argument("--chunksize", default=0, type=int,
+        help=textwrap.dedent("""If given, summary files are streamed by chunks of chunksize reads with bounded memory instead of being
+        fully loaded. Plots are then generated from a random sample of the reads (default: %(default)s)"""))
+    parser_other.add_argument("--max_memory", default="", type=str,
+        help=textwrap.dedent("""Maximal memory to use, in bytes or with a K, M, G or T suffix (e.g. 8G). The memory needed is estimated
+        from the input files, which are then fully loaded, loaded with compact read_ids or streamed by chunks sized to fit in
+        max_memory, or an error is raised if even the smallest chunks do not fit. The selected strategy is logged and saved in the
+        json report (default: %(default)s)"""))
+    parser_other.add_argument("--follow", default=False, action='store_true',
+        help=textwrap.dedent("""Follow growing summary files during a run. Reads appended to the files are parsed every --follow_interval
+        seconds and the reports are re-generated, until interrupted. Summary files are streamed and must be uncompressed (default: %(default)s)"""))
+    parser_other.add_argument("--follow_interval", default=900, type=int,
+        help="Number of seconds between 2 refreshes in follow mode (default: %(default)s)")
+    parser_other.add_argument("--cache_dir", default="", type=str,
+        help=textwrap.dedent("""If given, parsed summary and barcode files are cached in this directory as binary columns.
+        Cache entries are reused as long as the input files are unchanged (default: %(default)s)"""))
+    parser_other.add_argument("--progress", default=False, action='store_true',
+        help="If given, display a progress bar of the bytes read while parsing the input files (default: %(default)s)")
     parser_other.add_argument("--default_config", "-d", action='store_true',
         help="Print default configuration file. Can be used to generate a template JSON file (default: %(default)s)")
     parser_verbosity = parser.add_mutually_exclusive_group()
@@ -101,13 +141,13 @@ def main_pycoQC (args=None):
             sys.stdout.write(fp.read())
         sys.exit()
 
-    elif not args.summary_file:
+    elif not args.summary_file and not args.state_file:
         logger.warning ("ERROR: `--summary_file` is a required argument")
         parser.print_help()
         sys.exit()
 
-    elif not args.html_outfile and not args.json_outfile:
-        logger.warning ("ERROR: At least one output file required `--html_outfile` or `--json_outfile`")
+    elif not args.html_outfile and not args.json_outfile and not args.state_outfile:
+        logger.warning ("ERROR: At least one output file required `--html_outfile`, `--json_outfile` or `--state_outfile`")
         parser.print_help()
         sys.exit()
 
@@ -116,6 +156,10 @@ def main_pycoQC (args=None):
         summary_file = args.summary_file,
         barcode_file = args.barcode_file,
         bam_file = args.bam_file,
+        runid_list = args.runid_list,
+        min_time = args.min_time,
+        max_time = args.max_time,
+        pass_only = args.pass_only,
         filter_calibration = args.filter_calibration,
         filter_duplicated = args.filter_duplicated,
         min_barcode_percent = args.min_barcode_percent,
@@ -128,6 +172,15 @@ def main_pycoQC (args=None):
         skip_coverage_plot = args.skip_coverage_plot,
         template_file = args.template_file,
         json_outfile = args.json_outfile,
+        threads = args.threads,
+        chunksize = args.chunksize,
+        max_memory = args.max_memory,
+        cache_dir = args.cache_dir,
+        progress_bar = args.progress,
+        follow = args.follow,
+        follow_interval = args.follow_interval,
+        state_outfile = args.state_outfile,
+        state_files = args.state_file,
         verbose = args.verbose,
         quiet = args.quiet)
 
@@ -197,6 +250,8 @@ def main_Barcode_split (args=None):
         help="If given, unclassified barcodes are also written in a file. By default they are skiped")
     parser.add_argument("--min_barcode_percent", "-p", default=0.1, type=float,
         help="Minimal percent of total reads to retain barcode label. If below, the barcode value is set as `unclassified` (default: %(default)s)")
+    parser.add_argument("--threads", "-t", default=1, type=int,
+        help="Number of processes and threads to use to parse and decompress the input files (default: %(default)s)")
     parser_verbosity = parser.add_mutually_exclusive_group()
     parser_verbosity.add_argument("-v", "--verbose", action="store_true", default=False, help="Increase verbosity")
     parser_verbosity.add_argument("-q", "--quiet", action="store_true", default=False, help="Reduce verbosity")
@@ -211,5 +266,112 @@ def main_Barcode_split (args=None):
         output_dir=args.output_dir,
         output_unclassified=args.output_unclassified,
         min_barcode_percent=args.min_barcode_percent,
+        threads=args.threads,
+        verbose=args.verbose,
+        quiet=args.quiet)
+
+#~~~~~~~~~~~~~~Reads_query CLI ENTRY POINT~~~~~~~~~~~~~~#
+def main_Reads_query (args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    # Define parser object
+    parser = argparse.ArgumentParser(
+        formatter_class = argparse.RawDescriptionHelpFormatter,
+        description = textwrap.dedent("""
+            Reads_query extracts the records of specific reads or of reads matching column conditions\n
+            * Records of 2 reads
+                Reads_query -f sequencing_summary.txt -r read_id_1 read_id_2
+            * Low identity reads of channels 1 to 256 within the first hour of the run, reusing the cache of previous queries
+                Reads_query -f sequencing_summary.txt -a alignment.bam --range channel 1:256 --range start_time :3600 --range identity_freq :0.8 --cache_dir cache"""))
+    parser.add_argument('--version', action='version', version="{} v{}".format(package_name, package_version))
+
+    # Define arguments
+    parser_io = parser.add_argument_group('Input/output options')
+    parser_io.add_argument("--summary_file", "-f", required=True, nargs='*',
+        help=textwrap.dedent("""Path to a sequencing_summary generated by Albacore 1.0.0 + (read_fast5_basecaller.py) / Guppy 2.1.3+ (guppy_basecaller).
+        One can also pass multiple space separated file paths or a UNIX style regex matching multiple files"""))
+    parser_io.add_argument("--barcode_file", "-b", default=[], nargs='*',
+        help=textwrap.dedent("""Path to the barcode_file generated by Guppy 2.1.3+ (guppy_barcoder) or Deepbinner 0.2.0+.
+        One can also pass multiple space separated file paths or a UNIX style regex matching multiple files (optional)"""))
+    parser_io.add_argument("--bam_file", "-a", default=[], nargs='*',
+        help=textwrap.dedent("""Path to a Bam file corresponding to reads in the summary_file.
+        One can also pass multiple space separated file paths or a UNIX style regex matching multiple files
+        Unsorted SAM/BAM files are accepted and "-" reads alignments streamed from stdin, for example piped from minimap2 (optional)"""))
+    parser_io.add_argument("--output_file", "-o", default="", type=str,
+        help="Path to the output tabulated file (default: standard output)")
+    parser_query = parser.add_argument_group('Query options')
+    parser_query.add_argument("--read_ids", "-r", default=[], nargs='*',
+        help="List of read_ids to select")
+    parser_query.add_argument("--read_ids_file", default="", type=str,
+        help="Path to a file containing read_ids to select, one per line")
+    parser_query.add_argument("--range", default=[], nargs=2, action="append", metavar=("COLUMN", "MIN:MAX"),
+        help="Select reads with values of COLUMN within inclusive bounds. Either bound can be omitted, eg `--range channel 1:256 --range identity_freq :0.8`")
+    parser_query.add_argument("--isin", default=[], nargs='+', action="append", metavar="COLUMN VALUE",
+        help="Select reads with values of COLUMN in the list of values, eg `--isin barcode barcode01 barcode02`")
+    parser_query.add_argument("--columns", default=None, nargs='*',
+        help="List of columns to write (default: all columns)")
+    parser_filt = parser.add_argument_group('Filtering options')
+    parser_filt.add_argument("--runid_list", default=[], nargs='*',
+        help="Select only specific runids (default: all runids)")
+    parser_filt.add_argument("--filter_calibration", default=False, action='store_true',
+        help="If given, reads flagged as calibration strand by the basecaller are removed (default: %(default)s)")
+    parser_filt.add_argument("--filter_duplicated", default=False, action='store_true',
+        help="If given, duplicated read_ids are removed but the first occurence is kept (default: %(default)s)")
+    parser_filt.add_argument("--min_barcode_percent", default=0.1, type=float,
+        help="Minimal percent of total reads to retain barcode label. If below, the barcode value is set as `unclassified` (default: %(default)s)")
+    parser_other = parser.add_argument_group('Other options')
+    parser_other.add_argument("--threads", "-t", default=1, type=int,
+        help="Number of processes and threads to use to parse and decompress the input files (default: %(default)s)")
+    parser_other.add_argument("--cache_dir", default="", type=str,
+        help="If given, parsed files and the read index are cached in this directory and reused by subsequent queries (default: %(default)s)")
+    parser_other.add_argument("--progress", default=False, action='store_true',
+        help="If given, display a progress bar of the bytes read while parsing the input files (default: %(default)s)")
+    parser_verbosity = parser.add_mutually_exclusive_group()
+    parser_verbosity.add_argument("-v", "--verbose", action="store_true", default=False, help="Increase verbosity")
+    parser_verbosity.add_argument("-q", "--quiet", action="store_true", default=False, help="Reduce verbosity")
+
+    # Try to parse arguments
+    args = parser.parse_args()
+
+    # Convert range and isin options to filters
+    def to_value (v):
+        try:
+            return float(v)
+        except ValueError:
+            return v
+
+    filters = {}
+    for col, bounds in args.range:
+        if not ":" in bounds:
+            parser.error ("Invalid range `{}` for column {}, expected MIN:MAX".format(bounds, col))
+        vmin, vmax = bounds.split(":", 1)
+        filters.setdefault(col, {})
+        if vmin:
+            filters[col]["min"] = float(vmin)
+        if vmax:
+            filters[col]["max"] = float(vmax)
+    for col, *values in args.isin:
+        if not values:
+            parser.error ("No values given for column {}".format(col))
+        filters.setdefault(col, {})["isin"] = [to_value(v) for v in values]
+
+    # Run main function
+    Reads_query (
+        summary_file=args.summary_file,
+        barcode_file=args.barcode_file,
+        bam_file=args.bam_file,
+        read_ids=args.read_ids,
+        read_ids_file=args.read_ids_file,
+        filters=filters,
+        columns=args.columns,
+        output_file=args.output_file,
+        runid_list=args.runid_list,
+        filter_calibration=args.filter_calibration,
+        filter_duplicated=args.filter_duplicated,
+        min_barcode_percent=args.min_barcode_percent,
+        threads=args.threads,
+        cache_dir=args.cache_dir,
+        progress_bar=args.progress,
         verbose=args.verbose,
         quiet=args.quiet)
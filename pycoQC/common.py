@@ -1,16 +1,35 @@
 # -*- coding: utf-8 -*-
 
 # Standard library imports
-from os import access, R_OK, listdir, path, makedirs
+from os import access, R_OK, listdir, path, makedirs, stat, rename
 import inspect
+import json
+import hashlib
+import shutil
+import tempfile
+import warnings
 from glob import iglob, glob
 import sys
 import logging
+import multiprocessing as mp
+import io
+import gzip
+import bz2
+import lzma
+import zipfile
+import zlib
+import struct
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from collections import *
 
 # Third party imports
+import numpy as np
 import pandas as pd
 import pysam as ps
+from tqdm import tqdm
 
 #~~~~~~~~~~~~~~CUSTOM EXCEPTION AND WARN CLASSES~~~~~~~~~~~~~~#
 class pycoQCError (Exception):
@@ -27,6 +46,10 @@ def is_readable_file (fn):
     """Verify the readability of a file or list of file"""
     return path.isfile (fn) and access (fn, R_OK)
 
+def is_stream (fn):
+    """Return True if fn is the standard input ("-") or a named pipe, which can only be read once and sequentially"""
+    return fn == "-" or (path.exists(fn) and not path.isfile(fn))
+
 def check_arg (arg_name, arg_val, required_type, allow_none=True, min=None, max=None, choices=[]):
     """Check argument values and type"""
     if allow_none and arg_val is None:
@@ -49,7 +72,35 @@ def check_arg (arg_name, arg_val, required_type, allow_none=True, min=None, max=
 
     return arg_val
 
-def sequencing_summary_file_sample (infile, outfile=None, n_seq=10000):
+def parse_memory_size (size):
+    """
+    Convert a memory size given as a number of bytes or as a string with a K, M, G or T suffix (e.g. 8G) in bytes.
+    Suffixes are powers of 1024
+    """
+    if isinstance(size, (int, float)) and not isinstance(size, bool):
+        return int(size)
+    s = str(size).strip().upper().rstrip("B")
+    factor = 1
+    if s and s[-1] in "KMGT":
+        factor = 1024**("KMGT".index(s[-1])+1)
+        s = s[:-1]
+    try:
+        n = float(s)
+    except ValueError:
+        raise pycoQCError ("Invalid memory size `{}`. Expected a number of bytes or a number with a K, M, G or T suffix".format(size))
+    if n <= 0:
+        raise pycoQCError ("Invalid memory size `{}`. The size has to be positive".format(size))
+    return int(n*factor)
+
+def format_memory_size (n):
+    """Format a number of bytes in a human readable string"""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(n) < 1024:
+            return "{:.1f} {}".format(n, unit)
+        n /= 1024
+    return "{:.1f} TB".format(n)
+
+def sequencing_summary_file_sample (infile, outfile=None, n_seq=10000, threads=1):
     """
     Sample a number read lines in infile and write the output_over_time in output_file
     If the file contains several runids the function will sample proportionally to the
@@ -59,8 +110,11 @@ def sequencing_summary_file_sample (infile, outfile=None, n_seq=10000):
         Path to a sequencing_summary output file. If not given, will return a dataframe instead
     * n_seq: STR (default 10000)
         Overall number of sequence lines to sample
+    * threads: INT (default 1)
+        Number of threads used to decompress infile
     """
-    df = pd.read_csv(infile, sep ="\t")
+    with open_file(infile, threads=threads) as fp:
+        df = pd.read_csv(fp, sep ="\t")
     df.dropna (inplace=True)
     total = len(df)
     print ("{} sequences".format(total))
@@ -264,7 +318,7 @@ def head (fp, n=10, sep="\t", comment=None):
 
     # Get lines
     try:
-        with open(fp) as fh:
+        with io.TextIOWrapper(open_file(fp)) as fh:
             line_num = 0
             while (line_num < n):
                 l= next(fh).strip()
@@ -315,50 +369,1684 @@ def ls (dir_path):
 
 def expand_file_names(fn, bam_check=False):
     """"""
-    # Try to expand file name to list
+    # Try to expand file name to list. Alignment files can also be streamed from stdin with "-"
+    expand = lambda f: [f] if bam_check and f == "-" else glob(f)
     if isinstance(fn, list):
         if len(fn) ==1:
-            fn_list=glob(fn[0])
+            fn_list=expand(fn[0])
         else:
             fn_list = []
             for f in fn:
-                fn_list.extend(glob(f))
+                fn_list.extend(expand(f))
     elif isinstance(fn, str):
-        fn_list=glob(fn)
+        fn_list=expand(fn)
     else:
         raise pycoQCError ("{} has to be either a file or a regular expression or a list of files".format(fn))
 
     # Verify that files are readable
     if not fn_list:
         raise pycoQCError("No files found in {}".format(fn))
+    if bam_check and fn_list.count("-") > 1:
+        raise pycoQCError("The standard input can only be given once")
     for f in fn_list:
+        # Extra checks for alignment files. Unsorted and unindexed SAM/BAM files are accepted and streams are not opened
+        if bam_check and is_stream(f):
+            continue
         if not is_readable_file (f):
             raise pycoQCError("Cannot read file {}".format(f))
-        # Extra checks for bam files
         if bam_check:
-            with ps.AlignmentFile(f, "rb") as bam:
-                if not bam.has_index():
-                    raise pycoQCError("No index found for bam file: {}. Please index with samtools index".format(f))
-                if not bam.header['HD']['SO'] == 'coordinate':
-                    raise pycoQCError("Bam file not sorted: {}. Please sort with samtools sort".format(f))
+            try:
+                with ps.AlignmentFile(f, "r"):
+                    pass
+            except (ValueError, OSError) as E:
+                raise pycoQCError("Cannot read alignments from file {}: {}".format(f, E))
     return fn_list
 
-def merge_files_to_df(fn_list):
-    """"""
-    if len(fn_list) == 1:
-        df =  pd.read_csv(fn_list[0], sep ="\t")
+#~~~~~~~ PROGRESS ~~~~~~~#
+
+class Progress ():
+    """
+    Progress of a parsing stage, measured in bytes read from the input files and in records parsed.
+    The throughput and the time remaining, extrapolated from the bytes left to read, are reported at regular intervals in
+    the log, in an optional tqdm progress bar and to an optional callback
+    """
+    def __init__ (self, stage, total_bytes=0, unit="reads", logger=None, progress_bar=False, callback=None, log_interval=10, callback_interval=1):
+        """
+        * stage
+            Name of the parsing stage
+        * total_bytes
+            Total size of the input files or 0 if unknown
+        * unit
+            Name of the records parsed
+        * logger
+            Logger reporting the progress at info level every log_interval seconds
+        * progress_bar
+            If True, display a tqdm progress bar of the bytes read
+        * callback
+            Function called with the dict returned by get_stats every callback_interval seconds and at the end of the stage
+        """
+        self.stage = stage
+        self.total_bytes = total_bytes
+        self.unit = unit
+        self.logger = logger
+        self.callback = callback
+        self.log_interval = log_interval
+        self.callback_interval = callback_interval
+        self.bytes = 0
+        self.records = 0
+        self.done = False
+        self._start = self._last_log = self._last_callback = time.time()
+        self._bar = tqdm (total=total_bytes or None, desc=stage, unit="B", unit_scale=True, unit_divisor=1024,
+            mininterval=0.5, smoothing=0.1, disable=not progress_bar)
+        self._bar_bytes = 0
+
+    def add_bytes (self, n_bytes):
+        """Add bytes read. Can be called from any thread, the progress is only reported by update"""
+        self.bytes += n_bytes
+
+    def set_bytes (self, n_bytes):
+        """Set the total number of bytes read"""
+        self.bytes = n_bytes
+
+    def update (self, n_records=0):
+        """Add records parsed and report the progress if due"""
+        self.records += n_records
+        bytes_read = self.bytes
+        if bytes_read != self._bar_bytes:
+            self._bar.update(bytes_read-self._bar_bytes)
+            self._bar_bytes = bytes_read
+            self._bar.set_postfix_str("{:,} {}".format(self.records, self.unit), refresh=False)
+        now = time.time()
+        if self.logger and now-self._last_log >= self.log_interval:
+            self._last_log = now
+            self.logger.info ("\t\t{}".format(self))
+        if self.callback and now-self._last_callback >= self.callback_interval:
+            self._last_callback = now
+            self.callback(self.get_stats())
+
+    def close (self):
+        """End the stage and report the final throughput"""
+        if self.done:
+            return
+        self.done = True
+        self.update()
+        self._bar.close()
+        if self.logger:
+            self.logger.debug ("\t\t{}".format(self))
+        if self.callback:
+            self.callback(self.get_stats())
+
+    def get_stats (self):
+        """
+        Return a dict with the stage name, bytes read, total bytes, records parsed, elapsed time (s), records per second,
+        MB per second, estimated time remaining (s, None if unknown) and a done flag
+        """
+        elapsed = time.time()-self._start
+        bytes_read = self.bytes
+        eta = None
+        if self.done:
+            eta = 0.0
+        elif self.total_bytes and bytes_read:
+            eta = max(0.0, elapsed*(self.total_bytes-bytes_read)/bytes_read)
+        return OrderedDict ((
+            ("stage", self.stage),
+            ("bytes", bytes_read),
+            ("total_bytes", self.total_bytes),
+            ("records", self.records),
+            ("elapsed", elapsed),
+            ("records_per_s", self.records/elapsed if elapsed else 0.0),
+            ("mb_per_s", bytes_read/1048576/elapsed if elapsed else 0.0),
+            ("eta", eta),
+            ("done", self.done)))
+
+    def __str__ (self):
+        s = self.get_stats()
+        if s["total_bytes"]:
+            size = "{} / {} ({:.1%})".format(format_memory_size(s["bytes"]), format_memory_size(s["total_bytes"]), min(1, s["bytes"]/s["total_bytes"]))
+        else:
+            size = format_memory_size(s["bytes"])
+        msg = "{}: {}, {:,} {} in {:.1f}s ({:,.0f} {}/s, {:.1f} MB/s)".format(
+            s["stage"], size, s["records"], self.unit, s["elapsed"], s["records_per_s"], self.unit, s["mb_per_s"])
+        if not s["done"] and s["eta"] is not None:
+            msg += ", {:.0f}s remaining".format(s["eta"])
+        return msg
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._bar.close()
+
+class Progress_reader (io.RawIOBase):
+    """Binary reader adding the number of bytes read from a file object to a Progress object"""
+    def __init__ (self, fp, progress):
+        self._fp = fp
+        self._progress = progress
+
+    def readable (self):
+        return True
+
+    def readinto (self, b):
+        n = self._fp.readinto(b)
+        if n:
+            self._progress.add_bytes(n)
+        return n
+
+    def close (self):
+        if not self.closed:
+            self._fp.close()
+        super().close()
+
+def _open_raw (fn, progress=None):
+    """Open a file for binary reading, counting the bytes read in progress if given"""
+    if progress is None:
+        return open(fn, "rb")
+    return io.BufferedReader(Progress_reader(open(fn, "rb", buffering=0), progress), buffer_size=1<<20)
+
+#~~~~~~~ COMPRESSED FILES ~~~~~~~#
+
+def open_file (fn, threads=1, progress=None):
+    """
+    Open a plain or compressed file for binary reading, without temporary files.
+    The compression is detected from the magic number (see compression_format): gzip (including multi-member gzip and BGZF),
+    bz2, xz, zip, zstd and lz4. zstd and lz4 require the optional zstandard and lz4 packages, installed with the zstd and lz4
+    extras of pycoQC
+    * threads
+        If > 1, BGZF blocks are inflated concurrently by a pool of threads. Other formats are decompressed in a
+        background thread, concurrently with the parsing
+    * progress
+        Progress object to which the number of bytes read from the file, before decompression, is added. The bytes of zip
+        archives are not counted
+    """
+    with open(fn, "rb") as fp:
+        magic = fp.read(18)
+    fmt = compression_format(magic)
+
+    if fmt == "gzip":
+        if threads > 1 and is_bgzf(magic):
+            return io.BufferedReader(BGZF_reader(fn, threads=threads, progress=progress), buffer_size=1<<20)
+        fp = gzip.open(_open_raw(fn, progress) if progress else fn, "rb")
+
+    elif fmt == "bz2":
+        fp = bz2.open(_open_raw(fn, progress) if progress else fn, "rb")
+
+    elif fmt == "xz":
+        fp = lzma.open(_open_raw(fn, progress) if progress else fn, "rb")
+
+    elif fmt == "zip":
+        fp = _open_zip_member(fn)
+
+    elif fmt == "zstd":
+        fp = _import_optional("zstandard", "zstd", fn).ZstdDecompressor().stream_reader(_open_raw(fn, progress), closefd=True)
+
+    elif fmt == "lz4":
+        fp = _import_optional("lz4.frame", "lz4", fn).frame.open(_open_raw(fn, progress) if progress else fn, "rb")
+
+    else:
+        return _open_raw(fn, progress)
+
+    if threads > 1:
+        return io.BufferedReader(Prefetch_reader(fp), buffer_size=1<<20)
+    return fp
+
+def compression_format (magic):
+    """
+    Return the compression format of a file from its first bytes: "gzip", "bz2", "xz", "zip", "zstd", "lz4", or None for
+    uncompressed files
+    """
+    if magic[:2] == b"\x1f\x8b":
+        return "gzip"
+    elif magic[:3] == b"BZh":
+        return "bz2"
+    elif magic[:6] == b"\xfd7zXZ\x00":
+        return "xz"
+    elif magic[:4] == b"PK\x03\x04":
+        return "zip"
+    elif magic[:4] == b"\x28\xb5\x2f\xfd":
+        return "zstd"
+    elif magic[:4] == b"\x04\x22\x4d\x18":
+        return "lz4"
+    return None
+
+def _import_optional (module, fmt, fn):
+    """Import the module needed to read a file compressed in format fmt, or raise a pycoQCError naming the package to install"""
+    try:
+        return __import__(module)
+    except ImportError:
+        package = module.split(".")[0]
+        raise pycoQCError ("The {} package is required to read {} compressed file {}. Install it with `pip install {}` or `pip install pycoQC[{}]`".format(
+            package, fmt, fn, package, fmt))
+
+def _open_zip_member (fn, fp=None):
+    """Open the single file of a zip archive for binary reading, from its path or from the seekable binary file object fp"""
+    with zipfile.ZipFile(fp if fp else fn) as zf:
+        names = zf.namelist()
+        if len(names) != 1:
+            raise pycoQCError ("Zip archive {} should contain exactly one file, found {}".format(fn, len(names)))
+        return zf.open(names[0])
+
+def is_bgzf (header):
+    """Check if a gzip member header contains the BGZF extra subfield"""
+    return len(header) >= 18 and header[:2] == b"\x1f\x8b" and bool(header[3] & 4) and header[12:14] == b"BC"
+
+def _inflate_bgzf_blocks (blocks):
+    """Worker function inflating a list of raw BGZF blocks payloads and checking their CRC"""
+    data_list = []
+    for cdata, crc in blocks:
+        data = zlib.decompress(cdata, wbits=-15)
+        if zlib.crc32(data) != crc:
+            raise pycoQCError ("CRC check failed for BGZF block")
+        data_list.append(data)
+    return b"".join(data_list)
+
+class BGZF_reader (io.RawIOBase):
+    """
+    Binary reader of BGZF files (blocked gzip as generated by bgzip and samtools) inflating batches of blocks
+    in a pool of threads. zlib releases the GIL so blocks are effectively inflated in parallel
+    """
+    def __init__ (self, fn, threads=2, batch_size=16, progress=None):
+        """
+        * fn
+            Path to a BGZF file
+        * threads
+            Number of threads used to inflate blocks
+        * batch_size
+            Number of blocks inflated by each task
+        * progress
+            Progress object to which the number of compressed bytes read is added
+        """
+        self._fp = _open_raw(fn, progress)
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._max_pending = threads*2
+        self._batch_size = batch_size
+        self._pending = deque()
+        self._buffer = b""
+        self._pos = 0
+        self._eof = False
+
+    def readable (self):
+        return True
+
+    def readinto (self, b):
+        while self._pos >= len(self._buffer):
+            self._submit_batches()
+            if not self._pending:
+                return 0
+            self._buffer = self._pending.popleft().result()
+            self._pos = 0
+        n = min(len(b), len(self._buffer)-self._pos)
+        b[:n] = self._buffer[self._pos:self._pos+n]
+        self._pos += n
+        return n
+
+    def close (self):
+        if not self.closed:
+            self._executor.shutdown(wait=True)
+            self._fp.close()
+        super().close()
+
+    def _submit_batches (self):
+        """Read raw blocks and submit them to the pool until enough batches are pending"""
+        while not self._eof and len(self._pending) < self._max_pending:
+            blocks = []
+            while len(blocks) < self._batch_size:
+                block = read_bgzf_block(self._fp)
+                if block is None:
+                    self._eof = True
+                    break
+                blocks.append(block)
+            if blocks:
+                self._pending.append(self._executor.submit(_inflate_bgzf_blocks, blocks))
+
+def _read_bgzf_header (fp):
+    """
+    Read the header of the BGZF block at the current position of fp.
+    Return the total size of the block and the size of its header or None at the end of file
+    """
+    header = fp.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:2] != b"\x1f\x8b":
+        raise pycoQCError ("Invalid BGZF block header")
+
+    # Find the total block size in the BC extra subfield
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = fp.read(xlen)
+    i = 0
+    while i+4 <= len(extra):
+        slen = struct.unpack("<H", extra[i+2:i+4])[0]
+        if extra[i:i+2] == b"BC":
+            return (struct.unpack("<H", extra[i+4:i+6])[0]+1, 12+xlen)
+        i += 4+slen
+    raise pycoQCError ("Missing BGZF block size")
+
+def read_bgzf_block (fp):
+    """Return the deflated payload and CRC of the BGZF block at the current position of fp or None at the end of file"""
+    sizes = _read_bgzf_header(fp)
+    if sizes is None:
+        return None
+    block_size, header_size = sizes
+    payload = fp.read(block_size-header_size)
+    crc = struct.unpack("<I", payload[-8:-4])[0]
+    return (payload[:-8], crc)
+
+def bgzf_block_offsets (fn):
+    """List the offsets of all the blocks of a BGZF file, using the bgzip .gzi index if available"""
+    gzi_fn = fn+".gzi"
+    if is_readable_file(gzi_fn) and path.getmtime(gzi_fn) >= path.getmtime(fn):
+        with open(gzi_fn, "rb") as fp:
+            n = struct.unpack("<Q", fp.read(8))[0]
+            index = np.frombuffer(fp.read(16*n), dtype="<u8").reshape(n, 2)
+        return [0]+index[:, 0].tolist()
+
+    offsets = []
+    with open(fn, "rb") as fp:
+        while True:
+            offset = fp.tell()
+            sizes = _read_bgzf_header(fp)
+            if sizes is None:
+                return offsets
+            offsets.append(offset)
+            fp.seek(offset+sizes[0])
+
+class Prefetch_reader (io.RawIOBase):
+    """
+    Binary reader wrapping a file object read by a background thread, so that decompression runs concurrently with
+    the consumer of the data
+    """
+    def __init__ (self, fp, chunk_size=1<<22, max_chunks=4):
+        """
+        * fp
+            Binary file object to read from
+        * chunk_size
+            Size of the chunks read by the background thread
+        * max_chunks
+            Maximal number of chunks waiting to be consumed
+        """
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._stop = threading.Event()
+        self._buffer = b""
+        self._pos = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def readable (self):
+        return True
+
+    def readinto (self, b):
+        while self._pos >= len(self._buffer):
+            if self._eof:
+                return 0
+            data = self._queue.get()
+            if isinstance(data, Exception):
+                raise data
+            if not data:
+                self._eof = True
+            self._buffer = data
+            self._pos = 0
+        n = min(len(b), len(self._buffer)-self._pos)
+        b[:n] = self._buffer[self._pos:self._pos+n]
+        self._pos += n
+        return n
+
+    def close (self):
+        if not self.closed:
+            self._stop.set()
+            # Unblock the worker if the queue is full
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._fp.close()
+        super().close()
+
+    def _worker (self):
+        try:
+            while not self._stop.is_set():
+                data = self._fp.read(self._chunk_size)
+                self._queue.put(data)
+                if not data:
+                    break
+        except Exception as E:
+            self._queue.put(E)
+
+class Iter_reader (io.RawIOBase):
+    """Binary reader over an iterator of bytes chunks"""
+    def __init__ (self, iterator):
+        self._iterator = iter(iterator)
+        self._buffer = b""
+        self._pos = 0
+
+    def readable (self):
+        return True
+
+    def readinto (self, b):
+        while self._pos >= len(self._buffer):
+            self._buffer = next(self._iterator, b"")
+            self._pos = 0
+            if not self._buffer:
+                return 0
+        n = min(len(b), len(self._buffer)-self._pos)
+        b[:n] = self._buffer[self._pos:self._pos+n]
+        self._pos += n
+        return n
+
+#~~~~~~~ FILE RANGES ~~~~~~~#
+
+def split_file_ranges (fn, n_ranges, min_range_size=1<<20):
+    """
+    Split an uncompressed or a BGZF file in up to n_ranges byte ranges of similar sizes that can be parsed independently.
+    Ranges of BGZF files are aligned on blocks. Return a list of (start, end, prev_start, bgzf) tuples, where prev_start is
+    the offset of the block before start for BGZF files, or an empty list if the file cannot be split
+    """
+    size = path.getsize(fn)
+    n_ranges = int(min(n_ranges, size//min_range_size))
+    if n_ranges <= 1:
+        return []
+    with open(fn, "rb") as fp:
+        magic = fp.read(18)
+
+    if is_bgzf(magic):
+        offsets = bgzf_block_offsets(fn)
+        idx_list = sorted(set(np.linspace(0, len(offsets), n_ranges+1).astype(int)))
+        bounds = [offsets[i] for i in idx_list[:-1]]+[size]
+        return [(bounds[i], bounds[i+1], offsets[idx_list[i]-1] if idx_list[i] else None, True) for i in range(len(bounds)-1)]
+
+    elif compression_format(magic):
+        return []
 
     else:
-        df_list = []
-        for fn in fn_list:
-            df_list.append (pd.read_csv(fn, sep ="\t"))
-        df = pd.concat(df_list, ignore_index=True, sort=False, join="inner")
+        bounds = np.linspace(0, size, n_ranges+1).astype(int).tolist()
+        return [(bounds[i], bounds[i+1], None, False) for i in range(n_ranges)]
+
+def _iter_raw_chunks (fp, start, end=None, bgzf=False, chunk_size=1<<20):
+    """Yield the decompressed data of fp from offset start to offset end or to the end of file"""
+    fp.seek(start)
+    while end is None or fp.tell() < end:
+        if bgzf:
+            block = read_bgzf_block(fp)
+            if block is None:
+                return
+            data = _inflate_bgzf_blocks([block])
+        else:
+            data = fp.read(chunk_size if end is None else min(chunk_size, end-fp.tell()))
+            if not data:
+                return
+        yield data
+
+def iter_range_lines (fn, start, end, prev_start=None, bgzf=False):
+    """
+    Yield the data of all the lines starting in the range [start, end) of fn, including the end of the last line.
+    The header line at the beginning of the file is skipped.
+    """
+    with open(fn, "rb") as fp:
+        # A line starts in the range if the previous byte is a newline
+        if start == 0:
+            skip = True
+        elif bgzf:
+            skip = b"".join(_iter_raw_chunks(fp, prev_start, start, bgzf))[-1:] != b"\n"
+        else:
+            fp.seek(start-1)
+            skip = fp.read(1) != b"\n"
+
+        last = b"\n"
+        for data in _iter_raw_chunks(fp, start, end, bgzf):
+            if skip:
+                i = data.find(b"\n")
+                if i == -1:
+                    continue
+                data = data[i+1:]
+                skip = False
+            if data:
+                last = data[-1:]
+                yield data
+
+        # Complete the last line from the following range
+        if skip or last == b"\n":
+            return
+        for data in _iter_raw_chunks(fp, end, None, bgzf):
+            i = data.find(b"\n")
+            if i != -1:
+                yield data[:i+1]
+                return
+            yield data
+
+def get_file_header (fn, sep="\t"):
+    """Read the column names of a tabulated file without loading any data. Compressed files are also supported"""
+    with open_file(fn) as fp:
+        return list(pd.read_csv(fp, sep=sep, nrows=0).columns)
+
+def estimate_file_rows (fn, sample_size=1<<22):
+    """
+    Estimate the number of data lines of a plain or compressed tabulated file without reading it entirely.
+    The first sample_size bytes of data are decompressed, and their number of lines is extrapolated to the whole file
+    from the number of compressed bytes consumed. Files shorter than the sample are counted exactly
+    """
+    file_size = stat(fn).st_size
+    with open(fn, "rb") as raw:
+        fmt = compression_format(raw.read(6))
+        raw.seek(0)
+        if fmt == "gzip":
+            fp = gzip.GzipFile(fileobj=raw)
+        elif fmt == "bz2":
+            fp = bz2.BZ2File(raw)
+        elif fmt == "xz":
+            fp = lzma.LZMAFile(raw)
+        elif fmt == "zip":
+            fp = _open_zip_member(fn, raw)
+        elif fmt == "zstd":
+            fp = _import_optional("zstandard", "zstd", fn).ZstdDecompressor().stream_reader(raw, read_size=1<<16)
+        elif fmt == "lz4":
+            fp = _import_optional("lz4.frame", "lz4", fn).frame.LZ4FrameFile(raw)
+        else:
+            fp = raw
+        data = fp.read(sample_size)
+        consumed = raw.tell()
+
+    n_lines = data.count(b"\n")
+    if len(data) < sample_size:
+        if data and not data.endswith(b"\n"):
+            n_lines += 1
+        return max(n_lines-1, 0)
+    return max(int(n_lines*file_size/max(consumed, 1))-1, 0)
+
+def select_file_columns (header, rename_colnames={}, required_colnames=[], optional_colnames=[], fn=""):
+    """
+    Resolve the columns to load from a file header only.
+    Return an OrderedDict mapping the source column names to their standardised names.
+    If several source columns map to the same standardised name, the first one found in the header is used
+    * header
+        List of column names found in the file
+    * rename_colnames
+        Dict mapping alternative source column names to standardised names
+    * required_colnames
+        List of standardised column names that have to be found in the header
+    * optional_colnames
+        List of standardised column names to load only if found in the header
+    """
+    col_dict = OrderedDict()
+    for col in header:
+        std_col = rename_colnames.get(col, col)
+        if (std_col in required_colnames or std_col in optional_colnames) and not std_col in col_dict.values():
+            col_dict[col] = std_col
+
+    # Verify the presence of the required columns
+    for col in required_colnames:
+        if not col in col_dict.values():
+            raise pycoQCError("Column {} not found in the provided file {}".format(col, fn))
+
+    return col_dict
+
+def _read_csv_kwargs (fn, rename_colnames={}, required_colnames=None, optional_colnames=[], dtype_dict={}):
+    """Define the pandas read_csv options to load the selected columns of a file, and the mapping to standardised names"""
+    if required_colnames is None:
+        return ({"sep":"\t"}, {})
+
+    col_dict = select_file_columns (
+        header = get_file_header(fn),
+        rename_colnames = rename_colnames,
+        required_colnames = required_colnames,
+        optional_colnames = optional_colnames,
+        fn = fn)
+    dtype = {col:dtype_dict[std_col] for col, std_col in col_dict.items() if std_col in dtype_dict}
+    return ({"sep":"\t", "usecols":list(col_dict.keys()), "dtype":dtype}, col_dict)
+
+def _standardise_df (df, col_dict, required_colnames, optional_colnames):
+    """Rename and reorder columns as required + optional"""
+    if not col_dict:
+        return df
+    df = df.rename(columns=col_dict)
+    return df[[col for col in required_colnames+optional_colnames if col in df]]
 
-    if len(df) == 0:
+def filter_rows (df, filters, na_colnames=None, return_counts=False):
+    """
+    Select the rows of df matching all the filters.
+    filters is a dict of column names to conditions, given as a dict with any of the keys "isin" (list of values to keep),
+    "min" and "max" (inclusive bounds). Rows with NA values in the filtered columns are discarded, unless na_colnames is
+    given: rows with NA values in any of these columns are then kept, so that they can be counted as NA values later.
+    If return_counts, also return an OrderedDict of the number of rows discarded by the condition of each column, rows
+    failing several conditions being counted for the first one in the order of filters
+    """
+    counts = OrderedDict((col, 0) for col in filters or {})
+    if not filters or df.empty:
+        return (df, counts) if return_counts else df
+    keep_na = None
+    if na_colnames:
+        keep_na = df[[col for col in na_colnames if col in df]].isna().any(axis=1).values
+    mask = np.ones(len(df), dtype=bool)
+    for col, cond in filters.items():
+        s = df[col]
+        col_mask = np.ones(len(df), dtype=bool)
+        if "isin" in cond:
+            col_mask &= s.isin(cond["isin"]).values
+        if cond.get("min") is not None:
+            col_mask &= (s >= cond["min"]).fillna(False).values.astype(bool)
+        if cond.get("max") is not None:
+            col_mask &= (s <= cond["max"]).fillna(False).values.astype(bool)
+        if not "isin" in cond:
+            col_mask &= s.notna().values
+        if keep_na is not None:
+            col_mask |= keep_na
+        counts[col] = int(np.count_nonzero(mask & ~col_mask))
+        mask &= col_mask
+    df = df if mask.all() else df[mask]
+    return (df, counts) if return_counts else df
+
+def merge_counts (*count_dicts):
+    """Sum dicts of counts key by key, in order of first occurrence of the keys"""
+    merged = OrderedDict()
+    for count_dict in count_dicts:
+        for key, n in count_dict.items():
+            merged[key] = merged.get(key, 0)+n
+    return merged
+
+# Number of lines parsed at once when rows are filtered at parsing time, or when read_ids are stored as binary keys or
+# the progress is reported
+FILTER_CHUNKSIZE = 1000000
+READ_ID_KEYS_CHUNKSIZE = 100000
+PROGRESS_CHUNKSIZE = 100000
+
+def _read_filtered_arrays (fp, read_kwargs, col_dict, required_colnames, optional_colnames, filters, read_id_keys=False, progress=None):
+    """
+    Parse an open file by chunks and only keep the rows matching filters, so that discarded rows are never accumulated.
+    If read_id_keys, the read_ids of each chunk are replaced by their binary keys (see split_read_id_keys).
+    If progress is given, the rows parsed are added to it after each chunk. Rows with NA values in the required columns are
+    kept, so that they are counted as NA values by the cleanup.
+    Return the columns as a dict of compact arrays and an OrderedDict of the number of rows discarded by each filtered column
+    """
+    arrays_list = []
+    filtered_rows = OrderedDict()
+    chunksize = READ_ID_KEYS_CHUNKSIZE if read_id_keys else PROGRESS_CHUNKSIZE if progress else FILTER_CHUNKSIZE
+    for df in pd.read_csv(fp, chunksize=chunksize, **read_kwargs):
+        df = _standardise_df (df, col_dict, required_colnames, optional_colnames)
+        if progress:
+            progress.update(len(df))
+        df, counts = filter_rows (df, filters, na_colnames=required_colnames, return_counts=True)
+        filtered_rows = merge_counts(filtered_rows, counts)
+        if read_id_keys:
+            df = split_read_id_keys (df)
+        arrays_list.append(OrderedDict((col, df[col].values) for col in df.columns))
+    if len(arrays_list) == 1:
+        return (arrays_list[0], filtered_rows)
+    df = concat_arrays(arrays_list)
+    # Release the chunks before the columns are reused
+    del arrays_list[:]
+    return (OrderedDict((col, df[col].values) for col in df.columns), filtered_rows)
+
+def read_file_to_df (fn, rename_colnames={}, required_colnames=None, optional_colnames=[], dtype_dict={}, threads=1, filters=None, read_id_keys=False, progress=None):
+    """
+    Read a tabulated file in a dataframe.
+    If required_colnames is given, the column names are resolved from the header and only the required and optional
+    columns are loaded, standardised and cast to the types defined in dtype_dict. Otherwise all columns are loaded.
+    Compressed files are decompressed with open_file using threads.
+    If filters is given (see filter_rows), rows are filtered while parsing and the number of rows discarded by each filtered
+    column is saved in the "filtered_rows" attribute of the dataframe. Rows with NA values in the required columns are kept.
+    If read_id_keys is True, the file is parsed by chunks and the UUID read_ids of each chunk are replaced by their binary
+    keys (see split_read_id_keys), so that the read_id strings of the whole file are never loaded at once.
+    If progress is given (see Progress), the file is parsed by chunks and the bytes read and rows parsed are added to it
+    """
+    read_kwargs, col_dict = _read_csv_kwargs (fn, rename_colnames, required_colnames, optional_colnames, dtype_dict)
+    with open_file(fn, threads=threads, progress=progress) as fp:
+        if filters or read_id_keys or progress:
+            arrays, filtered_rows = _read_filtered_arrays (fp, read_kwargs, col_dict, required_colnames, optional_colnames, filters, read_id_keys, progress)
+            df = pd.DataFrame(arrays, copy=False)
+            df.attrs["filtered_rows"] = filtered_rows
+            return df
+        df = pd.read_csv(fp, **read_kwargs)
+    return _standardise_df (df, col_dict, required_colnames, optional_colnames)
+
+def iter_file_chunks (fn, chunksize, rename_colnames={}, required_colnames=None, optional_colnames=[], dtype_dict={}, threads=1, file_range=None, filters=None, progress=None):
+    """
+    Read a tabulated file by chunks of chunksize lines.
+    Yield dataframes with the same columns selection and types as read_file_to_df.
+    If file_range is given, only the data between the (start, end) byte offsets of an uncompressed file is parsed.
+    Both offsets must be at the beginning of a line.
+    If filters is given (see filter_rows), each chunk is filtered and the number of rows discarded by each filtered column
+    is saved in its "filtered_rows" attribute. Rows with NA values in the required columns are kept.
+    If progress is given (see Progress), the bytes read and rows parsed are added to it after each chunk
+    """
+    read_kwargs, col_dict = _read_csv_kwargs (fn, rename_colnames, required_colnames, optional_colnames, dtype_dict)
+    if file_range:
+        start, end = file_range
+        if end <= start:
+            return
+        if start:
+            read_kwargs.update({"header":None, "names":get_file_header(fn)})
+        raw_fp = open(fn, "rb")
+        chunks = _iter_raw_chunks(raw_fp, start, end)
+        if progress:
+            chunks = _count_chunks(chunks, progress)
+        fp = io.BufferedReader(Iter_reader(chunks), buffer_size=1<<20)
+    else:
+        raw_fp = fp = open_file(fn, threads=threads, progress=progress)
+
+    with raw_fp, fp:
+        for df in pd.read_csv(fp, chunksize=chunksize, **read_kwargs):
+            df = _standardise_df (df, col_dict, required_colnames, optional_colnames)
+            if progress:
+                progress.update(len(df))
+            if filters:
+                df, filtered_rows = filter_rows (df, filters, na_colnames=required_colnames, return_counts=True)
+                df.attrs["filtered_rows"] = filtered_rows
+            yield df
+
+def _count_chunks (chunks, progress):
+    """Yield the bytes chunks of an iterator, adding their size to progress"""
+    for data in chunks:
+        progress.add_bytes(len(data))
+        yield data
+
+def complete_lines_end (fn):
+    """Return the byte offset following the last complete line of an uncompressed file"""
+    with open(fn, "rb") as fp:
+        end = fp.seek(0, 2)
+        while end > 0:
+            start = max(0, end-(1<<16))
+            fp.seek(start)
+            i = fp.read(end-start).rfind(b"\n")
+            if i != -1:
+                return start+i+1
+            end = start
+    return 0
+
+def _read_file_to_arrays (fn, kwargs, file_range=None, threads=1, progress=None):
+    """
+    Worker function returning the columns of a file as a dict of compact arrays and the OrderedDict of the number of rows
+    discarded by the filters in kwargs. If file_range is given, only the lines starting in this byte range (as defined by
+    split_file_ranges) are parsed. Otherwise the progress of the parsing is added to progress if given
+    """
+    if file_range:
+        kwargs = dict(kwargs)
+        filters = kwargs.pop("filters", None)
+        read_id_keys = kwargs.pop("read_id_keys", False)
+        read_kwargs, col_dict = _read_csv_kwargs (fn, **kwargs)
+        read_kwargs.update({"header":None, "names":get_file_header(fn)})
+        required_colnames, optional_colnames = kwargs.get("required_colnames"), kwargs.get("optional_colnames", [])
+        with io.BufferedReader(Iter_reader(iter_range_lines(fn, *file_range)), buffer_size=1<<20) as fp:
+            if filters or read_id_keys:
+                return _read_filtered_arrays (fp, read_kwargs, col_dict, required_colnames, optional_colnames, filters, read_id_keys)
+            df = pd.read_csv(fp, **read_kwargs)
+        df = _standardise_df (df, col_dict, required_colnames, optional_colnames)
+    else:
+        df = read_file_to_df(fn, threads=threads, progress=progress, **kwargs)
+    return (OrderedDict((col, df[col].values) for col in df.columns), df.attrs.get("filtered_rows", OrderedDict()))
+
+def _read_task (args):
+    """Worker function running the indexed task (i, args of _read_file_to_arrays) and returning i with the results"""
+    i, task = args
+    return (i, _read_file_to_arrays(*task))
+
+def _task_bytes (task):
+    """Number of bytes of the file or file range parsed by a task of merge_files_to_df"""
+    fn, kwargs, file_range, threads = task
+    return file_range[1]-file_range[0] if file_range else path.getsize(fn)
+
+#~~~~~~~ PARSED FILES CACHE ~~~~~~~#
+
+# Bump to invalidate all existing cache entries when the cache layout changes
+CACHE_VERSION = 2
+
+def _cache_paths (fn, kwargs, cache_dir):
+    """Return the cache directory of all entries for file fn and the directory of the entry matching its current state and kwargs"""
+    fn = path.abspath(fn)
+    st = stat(fn)
+    key = json.dumps([CACHE_VERSION, fn, st.st_size, st.st_mtime_ns, kwargs], sort_keys=True, default=str)
+    file_dir = path.join(cache_dir, hashlib.sha1(fn.encode()).hexdigest()[:16])
+    entry_dir = path.join(file_dir, hashlib.sha1(key.encode()).hexdigest()[:16])
+    return (file_dir, entry_dir)
+
+def load_cached_arrays (fn, kwargs, cache_dir):
+    """
+    Load the columns of a file previously parsed with the same kwargs from cache_dir, the OrderedDict of the number of rows
+    discarded by the parsing filters and the extra metadata saved with the columns. Arrays are memory mapped.
+    Return None if there is no valid cache entry
+    """
+    file_dir, entry_dir = _cache_paths(fn, kwargs, cache_dir)
+    try:
+        with open(path.join(entry_dir, "meta.json")) as fp:
+            meta = json.load(fp)
+        return (load_column_arrays(entry_dir, meta["columns"]), OrderedDict(meta.get("filtered_rows", [])), meta.get("extra", {}))
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_cached_arrays (arrays, fn, kwargs, cache_dir, filtered_rows={}, extra_meta={}):
+    """
+    Save the columns of a parsed file in cache_dir, one npy file per column, with a dict of JSON serialisable extra metadata.
+    Entries for previous versions of the same file are removed
+    """
+    file_dir, entry_dir = _cache_paths(fn, kwargs, cache_dir)
+    st = stat(fn)
+    meta = {"version":CACHE_VERSION, "source":path.abspath(fn), "size":st.st_size, "mtime_ns":st.st_mtime_ns,
+        "filtered_rows":list(filtered_rows.items()), "extra":extra_meta, "columns":[]}
+    try:
+        makedirs(file_dir, exist_ok=True)
+
+        # Remove stale entries of the same file
+        for entry in listdir(file_dir):
+            try:
+                with open(path.join(file_dir, entry, "meta.json")) as fp:
+                    entry_meta = json.load(fp)
+                if (entry_meta["size"], entry_meta["mtime_ns"]) == (st.st_size, st.st_mtime_ns):
+                    continue
+            except (OSError, ValueError, KeyError):
+                pass
+            if entry != path.basename(entry_dir):
+                shutil.rmtree(path.join(file_dir, entry), ignore_errors=True)
+
+        # Write in a temporary directory renamed at the end, so that incomplete entries are never read
+        tmp_dir = tempfile.mkdtemp(dir=file_dir, prefix=".tmp_")
+        meta["columns"] = save_column_arrays(arrays, tmp_dir)
+        with open(path.join(tmp_dir, "meta.json"), "w") as fp:
+            json.dump(meta, fp)
+        if path.isdir(entry_dir):
+            shutil.rmtree(tmp_dir)
+        else:
+            rename(tmp_dir, entry_dir)
+
+    except (OSError, ValueError) as E:
+        warnings.warn("Could not cache parsed file {}: {}".format(fn, E), pycoQCWarning)
+        if "tmp_dir" in locals():
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def save_column_arrays (arrays, dir_path):
+    """
+    Save a dict of column arrays in dir_path, one npy file per column. Categorical, nullable integer and string columns are
+    stored as fixed-width numpy arrays with their categories or NA masks. Return the list of column descriptions required
+    to load the columns with load_column_arrays. Raise a ValueError for object columns that are not strings
+    """
+    columns_meta = []
+    for i, (col, a) in enumerate(arrays.items()):
+        col_meta = {"name":col}
+        if isinstance(a, pd.Categorical):
+            col_meta["kind"] = "category"
+            col_meta["categories"] = a.categories.tolist()
+            values = a.codes
+        elif isinstance(a, pd.arrays.IntegerArray):
+            col_meta["kind"] = "integer"
+            values = a.to_numpy(dtype=a.dtype.numpy_dtype, na_value=0)
+            np.save(path.join(dir_path, "{}_mask.npy".format(i)), a.isna())
+        elif a.dtype == object:
+            if pd.api.types.infer_dtype(a, skipna=True) not in ("string", "empty"):
+                raise ValueError ("Column {} cannot be saved".format(col))
+            col_meta["kind"] = "string"
+            mask = pd.isna(a)
+            values = np.where(mask, "", a).astype("U")
+            try:
+                values = values.astype("S")
+            except UnicodeEncodeError:
+                pass
+            np.save(path.join(dir_path, "{}_mask.npy".format(i)), mask)
+        else:
+            col_meta["kind"] = "numpy"
+            values = a
+        np.save(path.join(dir_path, "{}.npy".format(i)), values)
+        columns_meta.append(col_meta)
+    return columns_meta
+
+def load_column_arrays (dir_path, columns_meta):
+    """
+    Load the columns saved in dir_path by save_column_arrays as an OrderedDict of arrays. Numeric and categorical columns
+    are memory mapped copy-on-write, so that the data is only read when accessed and is shared through the page cache
+    between processes. Changes to the arrays are private and never written to the files
+    """
+    arrays = OrderedDict()
+    for i, col_meta in enumerate(columns_meta):
+        values = np.load(path.join(dir_path, "{}.npy".format(i)), mmap_mode="c")
+        kind = col_meta["kind"]
+        if kind == "category":
+            arrays[col_meta["name"]] = pd.Categorical.from_codes(values, categories=col_meta["categories"])
+        elif kind == "integer":
+            mask = np.load(path.join(dir_path, "{}_mask.npy".format(i)))
+            arrays[col_meta["name"]] = pd.arrays.IntegerArray(np.array(values), mask)
+        elif kind == "string":
+            mask = np.load(path.join(dir_path, "{}_mask.npy".format(i)))
+            values = values.astype("U").astype(object)
+            values[mask] = np.nan
+            arrays[col_meta["name"]] = values
+        else:
+            arrays[col_meta["name"]] = values
+    return arrays
+
+def concat_arrays (arrays_list):
+    """
+    Concatenate a list of dicts of column arrays in a single dataframe with a single pre-sized allocation per column.
+    Only the columns shared by all dicts are kept. Categorical and nullable integer columns keep their types
+    """
+    shared_cols = [col for col in arrays_list[0] if all(col in arrays for arrays in arrays_list)]
+    lengths = [len(next(iter(arrays.values()))) if arrays else 0 for arrays in arrays_list]
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    n = int(offsets[-1])
+
+    col_dict = OrderedDict()
+    for col in shared_cols:
+        col_arrays = [arrays[col] for arrays in arrays_list]
+
+        # Categorical: remap codes of each array to the union of all categories
+        if all(isinstance(a, pd.Categorical) for a in col_arrays):
+            categories = pd.Index(pd.unique(np.concatenate([np.asarray(a.categories, dtype=object) for a in col_arrays])))
+            codes = np.empty(n, dtype=np.int32)
+            for a, start, end in zip(col_arrays, offsets[:-1], offsets[1:]):
+                remap = np.append(categories.get_indexer(a.categories), -1).astype(np.int32)
+                codes[start:end] = remap[a.codes]
+            col_dict[col] = pd.Categorical.from_codes(codes, categories=categories)
+
+        # Nullable integers: fill values and mask separately
+        elif all(isinstance(a, pd.arrays.IntegerArray) for a in col_arrays):
+            dtype = np.result_type(*[a.dtype.numpy_dtype for a in col_arrays])
+            values = np.empty(n, dtype=dtype)
+            mask = np.empty(n, dtype=bool)
+            for a, start, end in zip(col_arrays, offsets[:-1], offsets[1:]):
+                values[start:end] = a.to_numpy(dtype=dtype, na_value=0)
+                mask[start:end] = a.isna()
+            col_dict[col] = pd.arrays.IntegerArray(values, mask)
+
+        # Numpy arrays, falling back to object if types are not compatible
+        else:
+            col_arrays = [np.asarray(a) for a in col_arrays]
+            try:
+                dtype = np.result_type(*[a.dtype for a in col_arrays])
+            except TypeError:
+                dtype = object
+            values = np.empty(n, dtype=dtype)
+            for a, start, end in zip(col_arrays, offsets[:-1], offsets[1:]):
+                values[start:end] = a
+            col_dict[col] = values
+
+    return pd.DataFrame(col_dict, copy=False)
+
+def merge_files_to_df(fn_list, threads=1, cache_dir="", progress=None, **kwargs):
+    """
+    Read and merge a list of tabulated files in a single dataframe. Only the columns shared by all files are kept.
+    If threads > 1 files are parsed concurrently in a process pool. The output order always follows fn_list.
+    When there are more threads than files, uncompressed and BGZF files are split in byte ranges parsed concurrently,
+    and the remaining threads are used to decompress the other files.
+    If cache_dir is given, parsed columns are cached on disk and reloaded as long as the files and kwargs are unchanged.
+    If progress is given (see Progress), the bytes read and rows parsed are added to it as files are parsed, or as
+    tasks complete when files are parsed in a process pool. Cached files are counted at once.
+    Extra keyword arguments are passed to read_file_to_df. The total number of rows discarded by each column of the parsing
+    filters is saved in the "filtered_rows" attribute of the dataframe. A pycoQCError is raised if the files do not contain
+    any row, but an empty dataframe is returned if all the rows were discarded by the filters
+    """
+    # Reload cached files
+    cached_list = [load_cached_arrays(fn, kwargs, cache_dir) if cache_dir else None for fn in fn_list]
+    arrays_list = [cached[0] if cached else None for cached in cached_list]
+    filtered_list = [cached[1] if cached else OrderedDict() for cached in cached_list]
+    parse_idx = [i for i, arrays in enumerate(arrays_list) if arrays is None]
+    if progress:
+        for fn, cached in zip(fn_list, cached_list):
+            if cached:
+                progress.add_bytes(path.getsize(fn))
+                progress.update(len(next(iter(cached[0].values()), []))+sum(cached[1].values()))
+
+    # Define parsing tasks for the other files or file ranges
+    tasks = []
+    task_idx = []
+    for i in parse_idx:
+        file_threads = max(1, threads//len(parse_idx))
+        ranges = split_file_ranges(fn_list[i], file_threads) if file_threads > 1 else []
+        if ranges:
+            tasks.extend([(fn_list[i], kwargs, file_range, 1) for file_range in ranges])
+            task_idx.extend([i]*len(ranges))
+        else:
+            tasks.append((fn_list[i], kwargs, None, file_threads))
+            task_idx.append(i)
+
+    if len(fn_list) == 1 and len(tasks) == 1 and not cache_dir:
+        df = read_file_to_df(fn_list[0], threads=tasks[0][3], progress=progress, **kwargs)
+        filtered_list = [df.attrs.get("filtered_rows", OrderedDict())]
+
+    else:
+        if threads > 1 and len(tasks) > 1:
+            results = [None]*len(tasks)
+            with mp.Pool(processes=min(threads, len(tasks))) as pool:
+                for j, (arrays, filtered_rows) in pool.imap_unordered(_read_task, enumerate(tasks)):
+                    results[j] = (arrays, filtered_rows)
+                    if progress:
+                        progress.add_bytes(_task_bytes(tasks[j]))
+                        progress.update(len(next(iter(arrays.values()), []))+sum(filtered_rows.values()))
+        else:
+            results = [_read_file_to_arrays(*task, progress=progress) for task in tasks]
+
+        # Stitch the ranges of each file back together and update the cache
+        for i in parse_idx:
+            file_results = [arrays for j, (arrays, _) in zip(task_idx, results) if j == i]
+            filtered_list[i] = merge_counts(*[filtered_rows for j, (_, filtered_rows) in zip(task_idx, results) if j == i])
+            if len(file_results) == 1:
+                arrays_list[i] = file_results[0]
+            else:
+                df = concat_arrays(file_results)
+                arrays_list[i] = OrderedDict((col, df[col].values) for col in df.columns)
+            if cache_dir:
+                save_cached_arrays(arrays_list[i], fn_list[i], kwargs, cache_dir, filtered_rows=filtered_list[i])
+        df = concat_arrays(arrays_list)
+
+    # Without any row, only raise if the filters did not discard all the rows, which the caller reports
+    df.attrs["filtered_rows"] = merge_counts(*filtered_list)
+    if len(df) == 0 and not sum(df.attrs["filtered_rows"].values()):
         raise pycoQCError ("No valid read found in input file")
+    return df
+
+#~~~~~~~ READ IDS ~~~~~~~#
+
+# Positions of the hexadecimal digits in UUID strings (8-4-4-4-12)
+UUID_HEX_POS = np.r_[0:8, 9:13, 14:18, 19:23, 24:36]
+UUID_REGEX = "[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+
+def uuid_to_bytes (read_ids):
+    """
+    Convert an array of UUID strings to a numpy array of 16-byte fixed-width binary values.
+    Return None if any of the values is not a valid UUID
+    """
+    if len(read_ids) == 0:
+        return np.array([], dtype="S16")
+    try:
+        s = "".join(read_ids).encode("ascii")
+    except (TypeError, UnicodeEncodeError):
+        return None
+    if len(s) != 36*len(read_ids) or s != s.lower():
+        return None
+    a = np.frombuffer(s, dtype="S1").reshape(-1, 36)
+    if not (a[:, [8, 13, 18, 23]] == b"-").all():
+        return None
+    try:
+        return np.frombuffer(bytes.fromhex(a[:, UUID_HEX_POS].tobytes().decode()), dtype="S16")
+    except ValueError:
+        return None
 
+def bytes_to_uuid (values):
+    """Convert an array of 16-byte binary values back to an array of UUID strings"""
+    if len(values) == 0:
+        return np.array([], dtype=object)
+    hex_digits = np.frombuffer(np.ascontiguousarray(values, dtype="S16").tobytes().hex().encode(), dtype="S1").reshape(-1, 32)
+    a = np.full((len(values), 36), b"-", dtype="S1")
+    a[:, UUID_HEX_POS] = hex_digits
+    s = a.tobytes().decode()
+    return np.array([s[i:i+36] for i in range(0, len(s), 36)], dtype=object)
+
+def split_read_id_keys (df):
+    """
+    Replace the read_id column of df by the 16-byte binary values of its UUIDs, stored in 2 uint64 columns read_id_hi
+    and read_id_lo, instead of python strings. Missing read_ids are masked in read_id_hi.
+    Raise pycoQCError if some read_ids are not UUIDs
+    """
+    read_ids = np.asarray(df["read_id"].values, dtype=object)
+    valid = ~pd.isna(read_ids)
+    binary = uuid_to_bytes(read_ids[valid])
+    if binary is None:
+        raise pycoQCError ("Read_ids are not all UUIDs and cannot be stored as binary values")
+    keys = np.zeros((len(df), 2), dtype=np.uint64)
+    keys[valid] = np.frombuffer(binary.tobytes(), dtype=np.uint64).reshape(-1, 2)
+
+    pos = df.columns.get_loc("read_id")
+    df = df.drop(columns="read_id")
+    df.insert(pos, "read_id_lo", keys[:, 1])
+    df.insert(pos, "read_id_hi", pd.arrays.IntegerArray(keys[:, 0], ~valid))
     return df
 
+def join_read_id_keys (df):
+    """
+    Convert the read_id_hi and read_id_lo columns generated by split_read_id_keys back to a 16-byte binary array that can be
+    passed to encode_read_ids. Return (binary, valid) with valid flagging the rows with a read_id
+    """
+    hi = df["read_id_hi"].array
+    keys = np.empty((len(df), 2), dtype=np.uint64)
+    keys[:, 0] = hi.to_numpy(dtype=np.uint64, na_value=0)
+    keys[:, 1] = df["read_id_lo"].values
+    return (keys.view("S16").ravel(), ~np.asarray(hi.isna()))
+
+def encode_read_ids (read_ids, read_id_array=None):
+    """
+    Encode read_ids as integer codes indexing read_id_array, an array of unique read_ids stored as sorted 16-byte
+    binary values if all the read_ids are UUIDs or as python strings otherwise. read_ids can also be given directly as
+    16-byte binary values.
+    If read_id_array is not given it is built from read_ids. Missing values and read_ids absent from read_id_array are
+    encoded as -1. Return (codes, read_id_array)
+    """
+    is_binary = isinstance(read_ids, np.ndarray) and read_ids.dtype.kind == "S"
+    if is_binary and read_id_array is not None and read_id_array.dtype.kind != "S":
+        read_ids, is_binary = bytes_to_uuid(read_ids), False
+
+    if is_binary:
+        valid = np.ones(len(read_ids), dtype=bool)
+        values = binary = read_ids
+    else:
+        read_ids = np.asarray(read_ids, dtype=object)
+        valid = ~pd.isna(read_ids)
+        values = read_ids[valid]
+        binary = uuid_to_bytes(values)
+    codes = np.full(len(read_ids), -1, dtype=np.int64)
+
+    if read_id_array is None:
+        if binary is not None:
+            read_id_array, codes[valid] = np.unique(binary, return_inverse=True)
+        else:
+            codes[valid], read_id_array = pd.factorize(values)
+            read_id_array = np.asarray(read_id_array, dtype=object)
+
+    elif read_id_array.dtype.kind == "S" and binary is not None:
+        if len(read_id_array):
+            idx = np.minimum(np.searchsorted(read_id_array, binary), len(read_id_array)-1)
+            codes[valid] = np.where(read_id_array[idx] == binary, idx, -1)
+
+    else:
+        if read_id_array.dtype.kind == "S":
+            read_id_array = bytes_to_uuid(read_id_array)
+        codes[valid] = pd.Index(read_id_array).get_indexer(values)
+
+    return (codes, read_id_array)
+
+def decode_read_ids (codes, read_id_array):
+    """Convert integer codes generated by encode_read_ids back to an array of read_id strings"""
+    values = read_id_array[np.asarray(codes)]
+    return bytes_to_uuid(values) if read_id_array.dtype.kind == "S" else values
+
+def index_read_codes (codes, n_codes):
+    """
+    Build a lookup array mapping each read_id code in range(n_codes) to the row of its first occurrence in codes, or -1
+    if the code is absent. Negative codes are ignored
+    """
+    lookup = np.full(n_codes, -1, dtype=np.int64)
+    uniques, first = np.unique(np.asarray(codes, dtype=np.int64), return_index=True)
+    valid = uniques>=0
+    lookup[uniques[valid]] = first[valid]
+    return lookup
+
+def join_read_columns (codes, lookup, df, columns, fill_dict={}):
+    """
+    Gather columns of df for the rows identified by read_id codes, in a single take per column.
+    Return an OrderedDict of arrays aligned on codes
+    * codes
+        Array of read_id codes of the rows to fill. Negative codes have no match
+    * lookup
+        Array mapping codes to rows of df generated by index_read_codes
+    * df
+        Table to gather the columns from
+    * columns
+        List of columns of df to gather
+    * fill_dict
+        Dict of values used for rows without match. Other columns are filled with NA
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    rows = np.full(len(codes), -1, dtype=np.int64)
+    valid = codes>=0
+    rows[valid] = lookup[codes[valid]]
+
+    col_dict = OrderedDict()
+    for col in columns:
+        values = df[col].values
+        fill_value = fill_dict.get(col)
+        if isinstance(values, pd.Categorical) and fill_value is not None and not fill_value in values.categories:
+            values = values.add_categories([fill_value])
+        col_dict[col] = pd.api.extensions.take(values, rows, allow_fill=True, fill_value=fill_value)
+    return col_dict
+
+def hash_read_ids (read_ids):
+    """
+    Return a (n, 2) uint64 array of 128-bit keys identifying read_ids. UUIDs are used directly as their 16 binary bytes,
+    other read_ids are hashed with 2 independent 64-bit hash functions. The key of a read_id does not depend on the other
+    read_ids of the batch
+    """
+    read_ids = np.asarray(read_ids, dtype=object)
+    binary = uuid_to_bytes(read_ids)
+    if binary is not None:
+        return np.frombuffer(binary.tobytes(), dtype=np.uint64).reshape(-1, 2)
+    keys = np.empty((len(read_ids), 2), dtype=np.uint64)
+    keys[:, 0] = pd.util.hash_array(read_ids, hash_key="pycoQC_read_id_0", categorize=False)
+    keys[:, 1] = pd.util.hash_array(read_ids, hash_key="pycoQC_read_id_1", categorize=False)
+
+    # Mixed batches: UUIDs still use their binary bytes
+    is_uuid = pd.Series(read_ids, dtype=object).str.fullmatch(UUID_REGEX).fillna(False).values.astype(bool)
+    if is_uuid.any():
+        keys[is_uuid] = np.frombuffer(uuid_to_bytes(read_ids[is_uuid]).tobytes(), dtype=np.uint64).reshape(-1, 2)
+    return keys
+
+def read_id_sample_keys (read_ids):
+    """
+    Return a uint64 array of uniformly distributed sampling keys of read_ids. The key of a read only depends on its read_id,
+    so that samples drawn from the smallest keys of disjoint subsets of reads can be merged into a sample of all the reads
+    """
+    # A single 64-bit SipHash of the read_id string, about twice as fast as hash_read_ids for UUIDs and 3 times for other read_ids
+    return pd.util.hash_array(np.asarray(read_ids, dtype=object), hash_key="pycoQC_sample_id", categorize=False)
+
+class Read_id_set ():
+    """
+    Compact set of 128-bit read_id keys generated by hash_read_ids. Keys are mixed in a 64-bit hash, whose top bits select
+    one of n_partitions open addressing hash tables with linear probing and whose next bits select the home slot in that
+    partition. Keys are inserted and looked up by numpy batches. Partitions grow independently by doubling when their load
+    exceeds max_load, so that a resize only copies the keys of one partition. Slots take 17 bytes and partitions are loaded
+    between max_load/2 and max_load, so about 25 to 50 bytes per key with the default max_load of 0.7, plus the temporary
+    arrays of the batch being inserted
+    """
+    # Multiplier of the Fibonacci hashing of keys
+    hash_multiplier = np.uint64(0x9E3779B97F4A7C15)
+
+    def __init__ (self, capacity=1<<16, max_load=0.7, n_partitions=64):
+        """
+        * capacity
+            Expected number of keys. The partitions are resized as needed
+        * max_load
+            Maximal fraction of occupied slots of a partition before it is resized
+        * n_partitions
+            Number of independent hash tables. Has to be a power of 2
+        """
+        self.max_load = max_load
+        self.n_keys = 0
+        self.partition_bits = int(np.log2(n_partitions))
+        if 2**self.partition_bits != n_partitions:
+            raise pycoQCError ("The number of partitions of a Read_id_set has to be a power of 2")
+        n_slots = int(2**np.ceil(np.log2(max(capacity/max_load/n_partitions, 16))))
+        self._hi, self._lo, self._used = [], [], []
+        self._partition_keys = np.zeros(n_partitions, dtype=np.int64)
+        for p in range(n_partitions):
+            self._alloc(p, n_slots)
+
+    def __len__ (self):
+        return self.n_keys
+
+    def __repr__(self):
+        return "[{}] {:,} keys in {:,} slots".format(self.__class__.__name__, self.n_keys, self.n_slots)
+
+    @property
+    def n_slots (self):
+        return sum(len(used) for used in self._used)
+
+    @property
+    def n_partitions (self):
+        return len(self._used)
+
+    def add_new (self, keys):
+        """
+        Add a (n, 2) uint64 array of keys to the set. Return a boolean array flagging the keys that were already in the
+        set or that occur earlier in the same batch, so that only first occurences are False
+        """
+        keys = np.ascontiguousarray(keys, dtype=np.uint64).reshape(-1, 2)
+        hashes = self._hash(keys)
+        found = np.zeros(len(keys), dtype=bool)
+        for p, idx in self._partition_groups(hashes):
+            n_keys = self._partition_keys[p]+len(idx)
+            if n_keys > self.max_load*len(self._used[p]):
+                self._resize(p, n_keys)
+            found[idx] = self._insert(p, keys[idx, 0], keys[idx, 1], hashes[idx])
+        return found
+
+    def find (self, keys):
+        """
+        Look up a (n, 2) uint64 array of keys. Return the slot of each key in the table, numbered across partitions in
+        order, or -1 for absent keys
+        """
+        keys = np.ascontiguousarray(keys, dtype=np.uint64).reshape(-1, 2)
+        hashes = self._hash(keys)
+        offsets = np.cumsum([0]+[len(used) for used in self._used])
+        found = np.full(len(keys), -1, dtype=np.int64)
+        for p, idx in self._partition_groups(hashes):
+            hi_table, lo_table, used_table = self._hi[p], self._lo[p], self._used[p]
+            hi, lo = keys[idx, 0], keys[idx, 1]
+            slot_mask = len(used_table)-1
+            slots = self._home_slots(p, hashes[idx])
+            pending = np.arange(len(idx))
+            while len(pending):
+                s = slots[pending]
+                used = np.asarray(used_table[s])
+                same = used & (hi_table[s] == hi[pending]) & (lo_table[s] == lo[pending])
+                found[idx[pending[same]]] = offsets[p]+s[same]
+                # Keys meeting an empty slot are absent, the others probe the next slot
+                advance = used & ~same
+                slots[pending[advance]] = (s[advance]+1) & slot_mask
+                pending = pending[advance]
+        return found
+
+    def get_arrays (self):
+        """Return the hi, lo and used arrays of all the partitions concatenated in slot order, and the list of partition sizes"""
+        return (np.concatenate(self._hi), np.concatenate(self._lo), np.concatenate(self._used), [len(used) for used in self._used])
+
+    @classmethod
+    def from_arrays (cls, hi, lo, used, partition_slots, n_keys, max_load):
+        """Build a set from the arrays returned by get_arrays, possibly memory mapped. Partitions are views of the arrays"""
+        self = cls.__new__(cls)
+        self.max_load = max_load
+        self.n_keys = n_keys
+        self.partition_bits = int(np.log2(len(partition_slots)))
+        bounds = np.cumsum([0]+list(partition_slots))
+        self._hi = [hi[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        self._lo = [lo[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        self._used = [used[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        self._partition_keys = np.array([int(np.count_nonzero(u)) for u in self._used], dtype=np.int64)
+        return self
+
+    def _hash (self, keys):
+        """Mix the 2 halves of the keys in a 64-bit hash. The home slot only depends on the top bits of the product"""
+        with np.errstate(over="ignore"):
+            return (keys[:, 0]^(keys[:, 1]*self.hash_multiplier))*self.hash_multiplier
+
+    def _partition_groups (self, hashes):
+        """Yield the partition and the indices of the hashes falling in each non empty partition, in the order of hashes"""
+        if not self.partition_bits:
+            yield (0, np.arange(len(hashes)))
+            return
+        partitions = (hashes >> np.uint64(64-self.partition_bits)).astype(np.int64)
+        order = np.argsort(partitions, kind="stable")
+        bounds = np.searchsorted(partitions[order], np.arange(self.n_partitions+1))
+        for p in np.flatnonzero(np.diff(bounds)):
+            yield (p, order[bounds[p]:bounds[p+1]])
+
+    def _home_slots (self, p, hashes):
+        """Home slots in partition p, taken from the bits of the hashes following the partition bits"""
+        slot_bits = int(np.log2(len(self._used[p])))
+        return ((hashes << np.uint64(self.partition_bits)) >> np.uint64(64-slot_bits)).astype(np.int64)
+
+    def _alloc (self, p, n_slots):
+        arrays = (np.zeros(n_slots, dtype=np.uint64), np.zeros(n_slots, dtype=np.uint64), np.zeros(n_slots, dtype=bool))
+        if p < len(self._used):
+            self._hi[p], self._lo[p], self._used[p] = arrays
+        else:
+            self._hi.append(arrays[0]), self._lo.append(arrays[1]), self._used.append(arrays[2])
+
+    def _resize (self, p, n_keys):
+        """Grow partition p to hold n_keys and re-insert its current keys"""
+        used = self._used[p]
+        hi, lo = self._hi[p][used], self._lo[p][used]
+        n_slots = len(used)
+        while n_keys > self.max_load*n_slots:
+            n_slots *= 2
+        del used
+        self._alloc(p, n_slots)
+        self.n_keys -= self._partition_keys[p]
+        self._partition_keys[p] = 0
+        keys = np.column_stack((hi, lo))
+        self._insert(p, hi, lo, self._hash(keys))
+
+    def _insert (self, p, hi, lo, hashes):
+        """
+        Insert keys in partition p. Return a boolean array flagging the keys already present in the partition or earlier
+        in the batch. Equal keys of the batch probe the same slots, and the first one claims the empty slot
+        """
+        hi_table, lo_table, used_table = self._hi[p], self._lo[p], self._used[p]
+        slot_mask = len(used_table)-1
+        slots = self._home_slots(p, hashes)
+        found = np.zeros(len(hi), dtype=bool)
+        pending = np.arange(len(hi))
+        n_claimed = 0
+        while len(pending):
+            s = slots[pending]
+            used = used_table[s]
+
+            # Key found before reaching an empty slot
+            same = used & (hi_table[s] == hi[pending]) & (lo_table[s] == lo[pending])
+            found[pending[same]] = True
+
+            # Empty slot reached: the key is absent, the first key probing each empty slot takes it.
+            # The other keys probing it check the same slot again
+            empty_idx = np.flatnonzero(~used)
+            _, first = np.unique(s[empty_idx], return_index=True)
+            claimed = empty_idx[first]
+            ks, ss = pending[claimed], s[claimed]
+            hi_table[ss], lo_table[ss], used_table[ss] = hi[ks], lo[ks], True
+            n_claimed += len(claimed)
+
+            # Keys that met an occupied slot with another key probe the next slot
+            advance = used & ~same
+            slots[pending[advance]] = (slots[pending[advance]]+1) & slot_mask
+            done = same
+            done[claimed] = True
+            pending = pending[~done]
+        self._partition_keys[p] += n_claimed
+        self.n_keys += n_claimed
+        return found
+
+class Reads_index ():
+    """
+    Read-level index of a reads dataframe, used to select reads by read_id or by column values without scanning all the rows.
+    Read_ids are stored in a Read_id_set mapping each key to its first row. Columns are summarised per block of consecutive
+    rows by their min/max values, or by the categories present for categorical columns, so that only the blocks that can
+    contain matching rows are read. Indexes can be saved to a directory and loaded memory mapped
+    """
+
+    def __init__ (self, read_ids, df, block_size=1<<16):
+        """
+        * read_ids
+            Array of read_ids of the rows of df
+        * df
+            Reads dataframe to index
+        * block_size
+            Number of consecutive rows summarised together
+        """
+        self.n_rows = len(df)
+        self.block_size = block_size
+
+        # Read_id hash index
+        keys = hash_read_ids(read_ids)
+        self.read_id_set = Read_id_set(capacity=len(keys))
+        first = np.flatnonzero(~self.read_id_set.add_new(keys))
+        self.slot_rows = np.full(self.read_id_set.n_slots, -1, dtype=np.int64)
+        self.slot_rows[self.read_id_set.find(keys[first])] = first
+
+        # Per block column statistics
+        starts = np.arange(0, self.n_rows, block_size)
+        self.stats = OrderedDict()
+        for col in df.columns:
+            values = df[col].values
+            if isinstance(values, pd.Categorical):
+                present = np.zeros((len(starts), len(values.categories)), dtype=bool)
+                valid = np.flatnonzero(values.codes>=0)
+                present[valid//block_size, values.codes[valid]] = True
+                self.stats[col] = {"kind":"category", "categories":values.categories.tolist(), "present":present}
+            elif isinstance(values, np.ndarray) and values.dtype.kind in "biuf" and self.n_rows:
+                self.stats[col] = {"kind":"numeric",
+                    "min":np.fmin.reduceat(values, starts).astype(np.float64),
+                    "max":np.fmax.reduceat(values, starts).astype(np.float64)}
+
+    def __len__ (self):
+        return self.n_rows
+
+    def __repr__(self):
+        return "[{}] {:,} rows in {:,} blocks, {} indexed columns".format(
+            self.__class__.__name__, self.n_rows, self.n_blocks, len(self.stats))
+
+    @property
+    def n_blocks (self):
+        return -(-self.n_rows//self.block_size)
+
+    def get_rows (self, read_ids):
+        """Return the row of the first record of each read_id, or -1 for read_ids absent from the index"""
+        slots = self.read_id_set.find(hash_read_ids(read_ids))
+        return np.where(slots>=0, self.slot_rows[np.maximum(slots, 0)], -1)
+
+    def get_blocks (self, filters):
+        """
+        Return a boolean array flagging the blocks that may contain rows matching filters, given in the format of filter_rows.
+        Blocks are discarded based on the column statistics only, the rows still have to be filtered
+        """
+        blocks = np.ones(self.n_blocks, dtype=bool)
+        for col, cond in filters.items():
+            stats = self.stats.get(col)
+            if stats is None:
+                continue
+            if stats["kind"] == "category":
+                if "isin" in cond:
+                    isin = set(cond["isin"])
+                    idx = [i for i, c in enumerate(stats["categories"]) if c in isin]
+                    blocks &= stats["present"][:, idx].any(axis=1)
+                else:
+                    blocks &= stats["present"].any(axis=1)
+            else:
+                # Blocks with NA values only have NaN min/max and are always discarded
+                vmin, vmax = stats["min"], stats["max"]
+                lower, upper = cond.get("min"), cond.get("max")
+                if cond.get("isin") is not None:
+                    isin = [v for v in cond["isin"] if not pd.isna(v)]
+                    if not isin:
+                        blocks[:] = False
+                        continue
+                    lower = min(isin) if lower is None else max(lower, min(isin))
+                    upper = max(isin) if upper is None else min(upper, max(isin))
+                blocks &= ~np.isnan(vmax)
+                if lower is not None:
+                    blocks &= vmax >= lower
+                if upper is not None:
+                    blocks &= vmin <= upper
+        return blocks
+
+    def query (self, df, read_ids=None, filters={}):
+        """
+        Select the rows of the indexed dataframe df matching read_ids and filters, in the order of df.
+        Only the first record of each read_id is returned. Read_ids absent from the index are ignored
+        * df
+            Dataframe used to build the index
+        * read_ids
+            List of read_ids to select. By default all the reads are considered
+        * filters
+            Dict of column conditions in the format of filter_rows
+        """
+        if len(df) != self.n_rows:
+            raise pycoQCError ("The index does not match the dataframe ({:,} vs {:,} rows)".format(self.n_rows, len(df)))
+
+        if read_ids is not None:
+            rows = np.unique(self.get_rows(read_ids))
+            rows = rows[rows>=0]
+            if filters:
+                rows = rows[self.get_blocks(filters)[rows//self.block_size]]
+        else:
+            blocks = self.get_blocks(filters)
+            if blocks.all():
+                return filter_rows(df, filters)
+            rows = np.concatenate([np.arange(i*self.block_size, min((i+1)*self.block_size, self.n_rows))
+                for i in np.flatnonzero(blocks)] or [np.array([], dtype=np.int64)])
+
+        return filter_rows(df.iloc[rows], filters)
+
+    def save (self, dir_path):
+        """Save the index in dir_path as npy arrays and a json description. Existing files are overwritten"""
+        makedirs(dir_path, exist_ok=True)
+        meta = {"version":CACHE_VERSION, "n_rows":self.n_rows, "block_size":self.block_size,
+            "n_keys":int(self.read_id_set.n_keys), "max_load":self.read_id_set.max_load, "stats":OrderedDict()}
+        hi, lo, used, meta["partition_slots"] = self.read_id_set.get_arrays()
+        arrays = {"hi":hi, "lo":lo, "used":used, "slot_rows":self.slot_rows}
+        for i, (col, stats) in enumerate(self.stats.items()):
+            meta["stats"][col] = {"kind":stats["kind"], "categories":stats.get("categories")}
+            for k in ("present", "min", "max"):
+                if k in stats:
+                    arrays["{}_{}".format(i, k)] = stats[k]
+        for name, a in arrays.items():
+            np.save(path.join(dir_path, "{}.npy".format(name)), a)
+        # Write the description last so that incomplete indexes are never loaded
+        with open(path.join(dir_path, "meta.json"), "w") as fp:
+            json.dump(meta, fp)
+
+    @classmethod
+    def load (cls, dir_path):
+        """Load an index saved in dir_path with memory mapped arrays. Return None if there is no valid index"""
+        try:
+            with open(path.join(dir_path, "meta.json")) as fp:
+                meta = json.load(fp)
+            if meta["version"] != CACHE_VERSION:
+                return None
+            load = lambda name: np.load(path.join(dir_path, "{}.npy".format(name)), mmap_mode="r")
+            index = cls.__new__(cls)
+            index.n_rows, index.block_size = meta["n_rows"], meta["block_size"]
+            index.read_id_set = Read_id_set.from_arrays(load("hi"), load("lo"), load("used"), meta["partition_slots"],
+                meta["n_keys"], meta["max_load"])
+            index.slot_rows = load("slot_rows")
+            index.stats = OrderedDict()
+            for i, (col, col_meta) in enumerate(meta["stats"].items()):
+                stats = {"kind":col_meta["kind"]}
+                if col_meta["kind"] == "category":
+                    stats["categories"] = col_meta["categories"]
+                    stats["present"] = load("{}_present".format(i))
+                else:
+                    stats["min"], stats["max"] = load("{}_min".format(i)), load("{}_max".format(i))
+                index.stats[col] = stats
+            return index
+        except (OSError, ValueError, KeyError):
+            return None
+
+#~~~~~~~ ALIGNMENT STATISTICS ~~~~~~~#
+
+def _concat_strings (strings):
+    """Concatenate a list of ASCII strings in a uint8 array. Return the array and the index of the string of each byte"""
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+    data = np.frombuffer("".join(strings).encode("ascii"), dtype=np.uint8)
+    return (data, np.repeat(np.arange(len(strings)), lengths))
+
+def cigar_op_lengths (cigar_strings, ops="IDS"):
+    """
+    Sum the lengths of the operations ops in a batch of CIGAR strings, tokenized at once with numpy.
+    Return a (n strings, n ops) int64 array. Missing CIGAR strings have to be given as empty strings
+    """
+    n = len(cigar_strings)
+    data, owner = _concat_strings(cigar_strings)
+    is_op = (data < 48) | (data > 57)
+    op_pos = np.flatnonzero(is_op)
+
+    # Each digit belongs to the token ended by the following operation, with a power of 10 given by its distance to it
+    token = np.cumsum(is_op)-is_op
+    digit_pos = np.flatnonzero(~is_op)
+    digit_token = token[digit_pos]
+    power = op_pos[digit_token]-digit_pos-1
+    lengths = np.bincount(digit_token, weights=(data[digit_pos]-48)*10.0**power, minlength=len(op_pos))
+
+    op_codes = data[op_pos]
+    op_owner = owner[op_pos]
+    res = np.zeros((n, len(ops)), dtype=np.int64)
+    for j, op in enumerate(ops.encode("ascii")):
+        sel = op_codes == op
+        res[:, j] = np.bincount(op_owner[sel], weights=lengths[sel], minlength=n)
+    return res
+
+def count_chars (strings, chars):
+    """Count the occurrences of any of the characters in chars in each string of a batch. Return an int64 array"""
+    data, owner = _concat_strings(strings)
+    table = np.zeros(256, dtype=bool)
+    table[np.frombuffer(chars.encode("ascii"), dtype=np.uint8)] = True
+    return np.bincount(owner[table[data]], minlength=len(strings)).astype(np.int64)
+
+# Source of the error statistics of alignments in alignment_error_stats
+ERROR_TAG_NONE, ERROR_TAG_NM, ERROR_TAG_MD, ERROR_TAG_CS, ERROR_TAG_DE = range(5)
+
+def alignment_error_stats (align_len, insertion, deletion, tag_kind, nm, tag_strings, de):
+    """
+    Compute the mismatch counts and identity frequencies of a batch of alignments from their tags. The edit distance is
+    taken from the NM tag, else the mismatches are counted in the MD tag (letters minus deleted bases) or in the minimap2
+    cs tag (substitutions). With only the minimap2 de tag (gap-compressed divergence), the identity is 1-de and the
+    mismatches are unknown. Return 2 float64 arrays, NaN for alignments without any tag
+    * align_len, insertion, deletion
+        Arrays of aligned lengths and of inserted and deleted bases from the CIGAR strings
+    * tag_kind
+        Array of ERROR_TAG_* codes defining the tag used for each alignment
+    * nm
+        Array of NM values (ERROR_TAG_NM)
+    * tag_strings
+        List of MD or cs tag values (ERROR_TAG_MD or ERROR_TAG_CS), empty strings otherwise
+    * de
+        Array of de values (ERROR_TAG_DE)
+    """
+    align_len = np.asarray(align_len, dtype=np.float64)
+    indel = np.asarray(insertion, dtype=np.float64)+deletion
+    mismatch = np.full(len(tag_kind), np.nan)
+
+    sel = tag_kind == ERROR_TAG_NM
+    mismatch[sel] = nm[sel]-indel[sel]
+    sel = tag_kind == ERROR_TAG_MD
+    if sel.any():
+        mismatch[sel] = count_chars([tag_strings[i] for i in np.flatnonzero(sel)], "ATCGatcg")-np.asarray(deletion)[sel]
+    sel = tag_kind == ERROR_TAG_CS
+    if sel.any():
+        mismatch[sel] = count_chars([tag_strings[i] for i in np.flatnonzero(sel)], "*")
+    edit_dist = mismatch+indel
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        identity = np.where(align_len > 0, (align_len-edit_dist)/align_len, 0.0)
+    identity[tag_kind == ERROR_TAG_NONE] = np.nan
+    sel = tag_kind == ERROR_TAG_DE
+    identity[sel] = 1-np.asarray(de, dtype=np.float64)[sel]
+    return (mismatch, identity)
+
 def mkdir (fn, exist_ok=False):
     """ Create directory recursivelly. Raise IO error if path exist or if error at creation """
     try:
@@ -6,10 +6,12 @@
 from collections import *
 import warnings
 import datetime
+import time
 
 # Local lib import
 from pycoQC.common import *
 from pycoQC.pycoQC_parse import pycoQC_parse
+from pycoQC.pycoQC_stream import pycoQC_stream, QC_state
 from pycoQC.pycoQC_plot import pycoQC_plot
 from pycoQC.pycoQC_report import pycoQC_report
 from pycoQC import __name__ as package_name
@@ -29,6 +31,9 @@ def pycoQC (
     filter_calibration:bool=False,
     filter_duplicated:bool=False,
     min_barcode_percent:float=0.1,
+    min_time:float=0,
+    max_time:float=0,
+    pass_only:bool=False,
     min_pass_qual:float=7,
     min_pass_len:int=0,
     sample:int=100000,
@@ -38,6 +43,16 @@ def pycoQC (
     template_file:str="",
     json_outfile:str="",
     skip_coverage_plot:bool=False,
+    threads:int=1,
+    chunksize:int=0,
+    max_memory:str="",
+    cache_dir:str="",
+    progress_bar:bool=False,
+    progress_callback=None,
+    follow:bool=False,
+    follow_interval:int=900,
+    state_outfile:str="",
+    state_files:list=[],
     verbose:bool=False,
     quiet:bool=False):
     """
@@ -51,6 +66,7 @@ def pycoQC (
     * bam_file
         Path to a Bam file corresponding to reads in the summary_file. Preferably aligned with Minimap2
         One can also pass multiple space separated file paths or a UNIX style regex matching multiple files
+        Sorting and indexing are optional: unsorted SAM/BAM files are parsed sequentially and "-" reads alignments streamed from stdin
     * runid_list
         Select only specific runids to be analysed. Can also be used to force pycoQC to order the runids for
         temporal plots, if the sequencing_summary file contain several sucessive runs. By default pycoQC analyses
@@ -61,6 +77,12 @@ def pycoQC (
         If True duplicated read_ids are removed but the first occurence is kept (Guppy sometimes outputs the same read multiple times)
     * min_barcode_percent
         Minimal percent of total reads to retain barcode label. If below the barcode value is set as `unclassified`.
+    * min_time
+        Only select reads starting after min_time hours from the beginning of their run
+    * max_time
+        If not 0, only select reads starting before max_time hours from the beginning of their run
+    * pass_only
+        If True only the 'pass' reads are selected at parsing time, using min_pass_qual and min_pass_len
     * min_pass_qual
         Minimum quality to consider a read as 'pass'
     * min_pass_len
@@ -79,7 +101,39 @@ def pycoQC (
     * template_file
         Jinja2 html template for the html report
     * json_outfile
-        Path to an output json file report
+        Path to an output json file report. When output reports are requested, only the read fields needed by the
+        report methods are parsed, and the returned plotter may not support the other plotting methods
+    * threads
+        Number of processes to use to parse multiple summary or barcode files concurrently.
+        Remaining threads are used to decompress the input files
+    * chunksize
+        If given, summary files are streamed by chunks of chunksize reads with bounded memory instead of being fully loaded.
+        Plots are then generated from a random sample of the reads
+    * max_memory
+        If given, maximal memory to use, in bytes or with a K, M, G or T suffix (e.g. 8G). The peak memory is estimated from the
+        size of the input files and the first blocks of data, and the input files are either fully loaded ("full"), loaded
+        with compact read_ids ("compact") or streamed by chunks sized to fit in max_memory ("chunked"). The selected strategy
+        is logged and saved in the json report. An error is raised if even the smallest chunks do not fit in max_memory
+    * cache_dir
+        If given, parsed summary and barcode files are cached in this directory as binary columns.
+        Cache entries are reused as long as the input files are unchanged
+    * progress_bar
+        If True, display a progress bar of the bytes read for each parsing stage
+    * progress_callback
+        Function called about every second during each parsing stage with a dict describing its progress: stage,
+        bytes, total_bytes, records, elapsed, records_per_s, mb_per_s, eta (seconds remaining) and done
+    * follow
+        Follow growing summary files during a run. Reads appended to the files are parsed every follow_interval seconds
+        and the reports are re-generated, until interrupted. Summary files are streamed and must be uncompressed
+    * follow_interval
+        Number of seconds between 2 refreshes in follow mode
+    * state_outfile
+        Path to an output file where to save the partial QC state of the reads, that can be merged with the states of other
+        subsets of reads, for example other flowcells processed on other nodes. Summary files are streamed.
+        States keep a sample of 2000 reads for the time and channel plots and take about 120 KB
+    * state_files
+        List of partial QC state files to merge and report on instead of parsing summary files.
+        One can also pass a UNIX style regex matching multiple files
     * verbose
         Increase verbosity
     * quiet
@@ -99,6 +153,9 @@ def pycoQC (
     filter_calibration = check_arg("filter_calibration", filter_calibration, required_type=bool, allow_none=False)
     filter_duplicated = check_arg("filter_duplicated", filter_duplicated, required_type=bool, allow_none=False)
     min_barcode_percent = check_arg("min_barcode_percent", min_barcode_percent, required_type=float, min=0, max=100, allow_none=False)
+    min_time = check_arg("min_time", min_time, required_type=float, min=0, allow_none=False)
+    max_time = check_arg("max_time", max_time, required_type=float, min=0, allow_none=False)
+    pass_only = check_arg("pass_only", pass_only, required_type=bool, allow_none=False)
     min_pass_qual = check_arg("min_pass_qual", min_pass_qual, required_type=float, min=0, max=60, allow_none=False)
     min_pass_len = check_arg("min_pass_len", min_pass_len, required_type=int, min=0, allow_none=False)
     sample = check_arg("sample", sample, required_type=int, min=0, allow_none=True)
@@ -109,6 +166,14 @@ def pycoQC (
     template_file = check_arg("template_file", template_file, required_type=str, allow_none=True)
     json_outfile = check_arg("json_outfile", json_outfile, required_type=str, allow_none=True)
     skip_coverage_plot = check_arg("skip_coverage_plot", skip_coverage_plot, required_type=bool, allow_none=False)
+    threads = check_arg("threads", threads, required_type=int, min=1, allow_none=False)
+    chunksize = check_arg("chunksize", chunksize, required_type=int, min=0, allow_none=True)
+    cache_dir = check_arg("cache_dir", cache_dir, required_type=str, allow_none=True)
+    progress_bar = check_arg("progress_bar", progress_bar, required_type=bool, allow_none=False)
+    follow = check_arg("follow", follow, required_type=bool, allow_none=False)
+    follow_interval = check_arg("follow_interval", follow_interval, required_type=int, min=1, allow_none=False)
+    state_outfile = check_arg("state_outfile", state_outfile, required_type=str, allow_none=True)
+    max_memory = parse_memory_size(max_memory) if max_memory else 0
 
     # Print debug info
     logger.debug("General info")
@@ -116,53 +181,190 @@ def pycoQC (
     logger.debug("Runtime options")
     logger.debug(dict_to_str(options_d))
 
-    #~~~~~~~~~~pycoQC_parse~~~~~~~~~~#
-    parser = pycoQC_parse (
-        summary_file=summary_file,
-        barcode_file=barcode_file,
-        bam_file=bam_file,
-        runid_list=runid_list,
-        filter_calibration=filter_calibration,
-        filter_duplicated=filter_duplicated,
-        min_barcode_percent=min_barcode_percent,
-        verbose=verbose,
-        quiet=quiet)
-
-    logger.debug("Parser stats")
-    logger.debug(parser)
-
-    #~~~~~~~~~~pycoQC_plot~~~~~~~~~~#
-    plotter = pycoQC_plot(
-        parser=parser,
-        min_pass_qual=min_pass_qual,
-        min_pass_len=min_pass_len,
-        sample=sample,
-        verbose=verbose,
-        quiet=quiet)
-
-    logger.debug("Plotter stats")
-    logger.debug(plotter)
-
-    #~~~~~~~~~~pycoQC_report~~~~~~~~~~#
+    # Plan the read fields needed by the reports
+    read_fields = None
     if html_outfile or json_outfile:
-        reporter = pycoQC_report (
-            parser=parser,
-            plotter=plotter,
+        read_fields = pycoQC_report.get_read_fields(
+            html_report=bool(html_outfile),
+            json_report=bool(json_outfile),
+            config_file=config_file,
+            skip_coverage_plot=skip_coverage_plot)
+        logger.debug("Read fields needed by the reports: {}".format(" ".join(read_fields)))
+
+    # Select the parsing strategy fitting in max_memory
+    memory_plan = None
+    low_memory = False
+    if max_memory and not state_files:
+        logger.warning ("Selecting memory strategy")
+        estimate_dict = pycoQC_parse.estimate_memory(
+            summary_file=summary_file,
+            barcode_file=barcode_file,
+            bam_file=bam_file,
+            filter_duplicated=filter_duplicated,
+            read_fields=read_fields,
+            threads=threads,
             verbose=verbose,
             quiet=quiet)
+        memory_plan = _plan_memory(estimate_dict, max_memory, streaming=bool(follow or state_outfile), chunksize=chunksize)
+        logger.warning ("\tStrategy {}: estimated peak memory {} for {:,} reads (max_memory {})".format(
+            memory_plan["strategy"], format_memory_size(memory_plan["estimated_memory"]), memory_plan["estimated_reads"],
+            format_memory_size(max_memory)))
+        if memory_plan["estimated_memory"] > max_memory:
+            raise pycoQCError ("The estimated memory ({}) exceeds max_memory ({}) even with the smallest chunks".format(
+                format_memory_size(memory_plan["estimated_memory"]), format_memory_size(max_memory)))
+        if memory_plan["strategy"] == "compact":
+            low_memory = True
+        elif memory_plan["strategy"] == "chunked":
+            chunksize = memory_plan["chunksize"]
+            logger.info ("\tStreaming summary files by chunks of {:,} reads".format(chunksize))
+
+    # Follow mode and partial QC states rely on the streaming parser
+    if (follow or state_outfile) and not chunksize:
+        chunksize = 1000000
+
+    #~~~~~~~~~~pycoQC_parse~~~~~~~~~~#
+    if state_files:
+        logger.warning ("Merge partial QC states")
+        state_files = expand_file_names(state_files)
+        state = QC_state.load(state_files[0])
+        for fn in state_files[1:]:
+            logger.debug ("\tMerging state file {}".format(fn))
+            state.merge(QC_state.load(fn))
+        parser = pycoQC_stream.from_state(state, verbose=verbose, quiet=quiet)
+
+    elif chunksize:
+        parser = pycoQC_stream (
+            summary_file=summary_file,
+            barcode_file=barcode_file,
+            bam_file=bam_file,
+            runid_list=runid_list,
+            filter_calibration=filter_calibration,
+            filter_duplicated=filter_duplicated,
+            min_barcode_percent=min_barcode_percent,
+            min_time=min_time,
+            max_time=max_time,
+            pass_only=pass_only,
+            min_pass_qual=min_pass_qual,
+            min_pass_len=min_pass_len,
+            read_fields=read_fields,
+            sample=sample if sample else 100000,
+            chunksize=chunksize,
+            threads=threads,
+            follow=follow,
+            progress_bar=progress_bar,
+            progress_callback=progress_callback,
+            verbose=verbose,
+            quiet=quiet)
+    else:
+        parser = pycoQC_parse (
+            summary_file=summary_file,
+            barcode_file=barcode_file,
+            bam_file=bam_file,
+            runid_list=runid_list,
+            filter_calibration=filter_calibration,
+            filter_duplicated=filter_duplicated,
+            min_barcode_percent=min_barcode_percent,
+            min_time=min_time,
+            max_time=max_time,
+            pass_only=pass_only,
+            min_pass_qual=min_pass_qual,
+            min_pass_len=min_pass_len,
+            read_fields=read_fields,
+            low_memory=low_memory,
+            threads=threads,
+            cache_dir=cache_dir,
+            progress_bar=progress_bar,
+            progress_callback=progress_callback,
+            verbose=verbose,
+            quiet=quiet)
+
+    plotter = None
+    while True:
+        logger.debug("Parser stats")
+        logger.debug(parser)
 
-        if html_outfile:
-            reporter.html_report(
-                outfile=html_outfile,
-                config_file=config_file,
-                template_file=template_file,
-                report_title=report_title,
-                skip_coverage_plot=skip_coverage_plot)
+        #~~~~~~~~~~Partial QC state~~~~~~~~~~#
+        if state_outfile:
+            logger.warning ("Save partial QC state to {}".format(state_outfile))
+            parser.get_state().save(state_outfile)
 
-        # Run json output function
-        if json_outfile:
-            reporter.json_report(
-                outfile=json_outfile)
+        # Wait for enough reads in follow mode
+        if follow and len(parser.all_reads) < 2:
+            logger.warning ("Not enough valid reads to generate reports yet")
+
+        else:
+            #~~~~~~~~~~pycoQC_plot~~~~~~~~~~#
+            plotter = pycoQC_plot(
+                parser=parser,
+                min_pass_qual=min_pass_qual,
+                min_pass_len=min_pass_len,
+                sample=sample,
+                verbose=verbose,
+                quiet=quiet)
+
+            logger.debug("Plotter stats")
+            logger.debug(plotter)
+
+            #~~~~~~~~~~pycoQC_report~~~~~~~~~~#
+            if html_outfile or json_outfile:
+                reporter = pycoQC_report (
+                    parser=parser,
+                    plotter=plotter,
+                    memory_plan=memory_plan,
+                    verbose=verbose,
+                    quiet=quiet)
+
+                if html_outfile:
+                    reporter.html_report(
+                        outfile=html_outfile,
+                        config_file=config_file,
+                        template_file=template_file,
+                        report_title=report_title,
+                        skip_coverage_plot=skip_coverage_plot)
+
+                # Run json output function
+                if json_outfile:
+                    reporter.json_report(
+                        outfile=json_outfile)
+
+        if not follow:
+            break
+
+        #~~~~~~~~~~Follow mode refresh~~~~~~~~~~#
+        try:
+            logger.warning ("Waiting {} seconds for new reads. Press Ctrl+C to stop".format(follow_interval))
+            time.sleep(follow_interval)
+            n = parser.refresh()
+            logger.warning ("Found {:,} new reads".format(n))
+        except KeyboardInterrupt:
+            logger.warning ("Stop following summary files")
+            break
 
     #~~~~~~~~~~return plotting object for API~~~~~~~~~~#
     return plotter
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PRIVATE FUNCTIONS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+def _plan_memory (estimate_dict, max_memory, streaming=False, chunksize=0):
+    """
+    Select the first strategy fitting in max_memory, from the memory estimates of pycoQC_parse.estimate_memory: all the reads
+    loaded ("full"), loaded with compact read_ids ("compact"), or streamed by chunks ("chunked") with the largest chunks
+    fitting in the remaining memory, between 10,000 and 1,000,000 reads. Streaming is always used if streaming is True,
+    with chunksize if given. Return an OrderedDict describing the selected strategy
+    """
+    plan = OrderedDict()
+    if not streaming and not chunksize and estimate_dict["full"] <= max_memory:
+        plan["strategy"] = "full"
+        plan["estimated_memory"] = estimate_dict["full"]
+    elif not streaming and not chunksize and estimate_dict["compact"] is not None and estimate_dict["compact"] <= max_memory:
+        plan["strategy"] = "compact"
+        plan["estimated_memory"] = estimate_dict["compact"]
+    else:
+        if not chunksize:
+            chunksize = (max_memory-estimate_dict["chunked"])//estimate_dict["chunk_read"]
+            chunksize = int(min(max(chunksize//10000*10000, 10000), 1000000))
+        plan["strategy"] = "chunked"
+        plan["estimated_memory"] = estimate_dict["chunked"]+chunksize*estimate_dict["chunk_read"]
+        plan["chunksize"] = chunksize
+    plan["estimated_reads"] = estimate_dict["reads"]
+    plan["max_memory"] = max_memory
+    return plan
@@ -5,6 +5,9 @@
 # Standard library imports
 from collections import *
 import warnings
+import weakref
+import os
+from array import array
 
 # Third party imports
 import numpy as np
@@ -12,16 +15,100 @@ import pandas as pd
 import pysam as ps
 
 # Local lib import
+from pycoQC import __name__ as package_name
+from pycoQC import __version__ as package_version
 from pycoQC.common import *
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~GLOBAL SETTINGS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 
+# Directory of the temporary shared reads stores, in memory if possible
+SHARED_STORE_DIR = "/dev/shm" if path.isdir("/dev/shm") else tempfile.gettempdir()
+
 # Silence futurewarnings
 warnings.filterwarnings("ignore", category=FutureWarning)
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~MAIN CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 class pycoQC_parse ():
 
+    # Standardised column names for all types of summary files
+    summary_rename_colnames = {
+        "sequence_length_template":"read_len",
+        "sequence_length_2d":"read_len",
+        "sequence_length":"read_len",
+        "mean_qscore_template":"mean_qscore",
+        "mean_qscore_2d":"mean_qscore",
+        "calibration_strand_genome_template":"calibration",
+        "barcode_arrangement":"barcode"}
+    summary_required_colnames = ["read_id", "run_id", "channel", "start_time", "read_len", "mean_qscore"]
+    summary_optional_colnames = ["calibration", "barcode"]
+
+    # Compact types used at parsing time. NA values are only filtered during cleanup, so integer columns are parsed as
+    # float32, exact up to 2**24, rather than as nullable integers which pandas converts through its slow object path.
+    # start_time is kept in float64 until the run time offsets are added, and only cast to float32 after cleanup
+    summary_dtype_dict = {
+        "run_id":"category",
+        "channel":"float32",
+        "start_time":"float64",
+        "read_len":"float32",
+        "mean_qscore":"float32",
+        "calibration":"category",
+        "barcode":"category"}
+
+    # Final types of the summary columns after cleanup
+    clean_dtype_dict = {"channel":"uint16", "start_time":"float32", "read_len":"uint32", "mean_qscore":"float32"}
+
+    # Alignment fields extracted by Alignment_buffer from the read coordinates, the CIGAR string and the NM/MD tags
+    bam_coord_fields = ["ref_id", "ref_start", "ref_end", "align_len", "mapq"]
+    bam_cigar_fields = ["insertion", "deletion", "soft_clip"]
+    bam_tag_fields = ["mismatch", "identity_freq"]
+
+    # Minimal number of alignments of the reference regions parsed by each process when bam files are parsed concurrently
+    bam_task_alignments = 200000
+
+    # Attributes saved with the parsed data by save and restored by load
+    session_attributes = ["runid_list", "filter_calibration", "filter_duplicated", "min_barcode_percent", "min_time", "max_time",
+        "pass_only", "min_pass_qual", "min_pass_len", "read_fields", "cleanup", "summary_files_list", "barcode_files_list",
+        "bam_file_list", "ref_len_dict", "_parse_options"]
+    session_version = 1
+
+    # Approximate memory usage in bytes, fitted on the peak RSS of complete html and json reports of Guppy summary files of
+    # 0.4 to 1.2 million reads, used by estimate_memory: fixed memory of the interpreter and libraries and of the generation
+    # of the reports from a sample of reads, peak memory per summary read to parse and clean the files in the default mode
+    # and in low_memory mode (with and without read_ids), per barcode record, per alignment, per read of reads_df while
+    # reports are generated, per read of a streamed chunk and per read_id of the Read_id_set of streamed duplicated reads,
+    # including the resize of its partitions
+    memory_usage_dict = {
+        "overhead":215<<20,
+        "report_overhead":245<<20,
+        "full_read":180,
+        "compact_read":155,
+        "compact_read_no_read_id":100,
+        "full_barcode_read":100,
+        "compact_barcode_read":40,
+        "alignment":1500,
+        "report_read":70,
+        "chunk_read":120,
+        "stream_overhead":30<<20,
+        "seen_read_id":36}
+
+    # Counter label, log message and name used in errors for each read filter. Reads failing several filters are counted
+    # for the first one in this order
+    read_filters_dict = OrderedDict ([
+        ("Excluded runid reads discarded", ("Selecting run_ids passed by user", "run ID")),
+        ("Reads outside time window discarded", ("Selecting reads in the time window", "time window")),
+        ("Non pass reads discarded", ("Selecting pass reads", "pass reads")),
+        ("Reads with NA values discarded", ("Discarding lines containing NA values", "NA values")),
+        ("Zero length reads discarded", ("Filtering out zero length reads", "zero_len")),
+        ("Duplicated reads discarded", ("Filtering out duplicated reads", "duplicated reads")),
+        ("Calibration reads discarded", ("Filtering out calibration strand reads", "calibration strand"))])
+
+    # Counter label of the reads discarded at parsing time by the filter on each column (see _get_parse_filters)
+    parse_filter_labels = {
+        "run_id":"Excluded runid reads discarded",
+        "start_time":"Reads outside time window discarded",
+        "mean_qscore":"Non pass reads discarded",
+        "read_len":"Non pass reads discarded"}
+
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~INIT METHOD~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
     def __init__ (self,
         summary_file:str,
@@ -31,7 +118,18 @@ class pycoQC_parse ():
         filter_calibration:bool=False,
         filter_duplicated:bool=False,
         min_barcode_percent:float=0.1,
+        min_time:float=0,
+        max_time:float=0,
+        pass_only:bool=False,
+        min_pass_qual:float=7,
+        min_pass_len:int=0,
+        read_fields:list=None,
         cleanup:bool=True,
+        low_memory:bool=False,
+        threads:int=1,
+        cache_dir:str="",
+        progress_bar:bool=False,
+        progress_callback=None,
         verbose:bool=False,
         quiet:bool=False):
         """
@@ -45,6 +143,7 @@ class pycoQC_parse ():
         * bam_file
             Path to a Bam file corresponding to reads in the summary_file. Preferably aligned with Minimap2
             One can also pass multiple space separated file paths or a UNIX style regex matching multiple files
+            Sorting and indexing are optional: unsorted SAM/BAM files are parsed sequentially and "-" reads alignments streamed from stdin
         * runid_list
             Select only specific runids to be analysed. Can also be used to force pycoQC to order the runids for
             temporal plots, if the sequencing_summary file contain several sucessive runs. By default pycoQC analyses
@@ -55,7 +154,39 @@ class pycoQC_parse ():
             If True duplicated read_ids are removed but the first occurence is kept (Guppy sometimes outputs the same read multiple times)
         * min_barcode_percent
             Minimal percent of total reads to retain barcode label. If below the barcode value is set as `unclassified`.
+        * min_time
+            Only select reads starting after min_time hours from the beginning of their run
+        * max_time
+            If not 0, only select reads starting before max_time hours from the beginning of their run
+        * pass_only
+            If True only the 'pass' reads are selected, using min_pass_qual and min_pass_len
+        * min_pass_qual
+            Minimum quality to consider a read as 'pass'
+        * min_pass_len
+            Minimum read length to consider a read as 'pass'
+        * read_fields
+            List of optional read fields needed downstream (see pycoQC_plot.method_fields_dict). If given, the other
+            optional summary columns, the barcode files and the alignment statistics not needed are not parsed.
+            By default all the fields are parsed
+        * low_memory
+            If True, summary and barcode files are parsed by chunks and read_ids are stored as 16-byte binary values instead
+            of python strings. All read_ids have to be UUIDs. Read_ids are not parsed at all if they are not needed to join
+            barcode and alignment records or to filter duplicated reads, and reads_df is then indexed by row numbers
+        * threads
+            Number of processes to use to parse multiple summary or barcode files concurrently.
+            Remaining threads are used to decompress the input files
+        * cache_dir
+            If given, parsed summary and barcode files are cached in this directory as binary columns.
+            Cache entries are reused as long as the input files are unchanged
+        * progress_bar
+            If True, display a progress bar of the bytes read for each parsing stage
+        * progress_callback
+            Function called about every second during each parsing stage with a dict describing its progress: stage,
+            bytes, total_bytes, records, elapsed, records_per_s, mb_per_s, eta (seconds remaining) and done
         """
+        # Options defining the parsed reads, used to identify the persistent read index
+        self._parse_options = {k:v for k, v in locals().items() if not k in (
+            "self", "low_memory", "threads", "cache_dir", "progress_bar", "progress_callback", "verbose", "quiet")}
 
         # Set logging level
         self.logger = get_logger(name=__name__, verbose=verbose, quiet=quiet)
@@ -65,32 +196,34 @@ class pycoQC_parse ():
         self.filter_calibration = filter_calibration
         self.filter_duplicated = filter_duplicated
         self.min_barcode_percent = min_barcode_percent
+        self.min_time = min_time
+        self.max_time = max_time
+        self.pass_only = pass_only
+        self.min_pass_qual = min_pass_qual
+        self.min_pass_len = min_pass_len
+        self.read_fields = read_fields
         self.cleanup = cleanup
+        self.low_memory = low_memory and cleanup
+        self.threads = threads
+        self.cache_dir = cache_dir
+        self.progress_bar = progress_bar
+        self.progress_callback = progress_callback
+        self.read_id_array = None
+        self._reads_index = None
+        self._parse_filters = self._get_parse_filters() if cleanup else {}
+        self._parse_discarded = OrderedDict()
 
         # Init object counter
         self.counter = OrderedDict()
 
         # Check input files
         self.logger.warning ("Check input data files")
-
-        # Expand file names and test readability
-        self.summary_files_list = expand_file_names(summary_file)
-        self.logger.debug ("\t\tSequencing summary files found: {}".format(" ".join(self.summary_files_list)))
-        self.counter["Summary files found"] = len(self.summary_files_list)
-
-        if barcode_file:
-            self.barcode_files_list = expand_file_names(barcode_file)
-            self.logger.debug ("\t\tBarcode files found: {}".format(" ".join(self.barcode_files_list)))
-            self.counter["Barcode files found"] = len(self.barcode_files_list)
-        else:
-            self.barcode_files_list =[]
-
-        if bam_file:
-            self.bam_file_list = expand_file_names(bam_file, bam_check=True)
-            self.logger.debug ("\t\tBam files found: {}".format(" ".join(self.bam_file_list)))
-            self.counter["Bam files found"] = len(self.bam_file_list)
-        else:
-            self.bam_file_list =[]
+        self._check_input_files(summary_file, barcode_file, bam_file)
+        if self.cleanup:
+            self._prune_fields()
+        if self.low_memory and not self._read_ids_needed():
+            self.logger.debug ("\tRead_ids not needed, reads are identified by their row number")
+            self.summary_required_colnames = [col for col in self.summary_required_colnames if col != "read_id"]
 
         self.logger.warning ("Parse data files")
         summary_reads_df = self._parse_summary()
@@ -98,6 +231,8 @@ class pycoQC_parse ():
         bam_reads_df, self.alignments_df, self.ref_len_dict = self._parse_bam()
 
         self.logger.warning ("Merge data")
+        if self.cleanup:
+            summary_reads_df, barcode_reads_df, bam_reads_df = self._encode_read_ids(summary_reads_df, barcode_reads_df, bam_reads_df)
         self.reads_df = self._merge_reads_df(summary_reads_df, barcode_reads_df, bam_reads_df)
 
         # Cleanup data
@@ -108,66 +243,419 @@ class pycoQC_parse ():
     def __str__(self):
         return dict_to_str(self.counter)
 
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def get_read_ids (self, codes=None):
+        """
+        After cleanup, reads_df is indexed by integer read_id codes. Return the read_id strings corresponding to codes
+        * codes
+            Array of read_id codes. By default all the reads in reads_df
+        """
+        if codes is None:
+            codes = self.reads_df.index.values
+        if self.read_id_array is None:
+            return np.asarray(codes)
+        return decode_read_ids(codes, self.read_id_array)
+
+    def query (self, read_ids=None, filters={}, columns=None):
+        """
+        Select reads by read_id and/or by column values. The selection uses a read index built on first use, or loaded
+        from cache_dir if given, so that point lookups and selective filters do not scan all the reads.
+        Return a dataframe indexed by read_id strings
+        * read_ids
+            List of read_ids to select. Read_ids not found are ignored. By default all the reads are considered
+        * filters
+            Dict of column names to conditions, given as a dict with any of the keys "isin" (list of values to keep),
+            "min" and "max" (inclusive bounds). Example: {"channel":{"min":1, "max":256}, "barcode":{"isin":["barcode01"]}}
+        * columns
+            List of columns to return. By default all the columns of reads_df
+        """
+        df = self.reads_df if self.cleanup else self.reads_df.set_index("read_id")
+        for col in list(filters)+list(columns or []):
+            if not col in df:
+                raise pycoQCError ("Column {} not found in reads_df. Available columns: {}".format(col, ", ".join(df.columns)))
+
+        df = self._get_reads_index().query(df, read_ids=read_ids, filters=filters)
+        if columns is not None:
+            df = df[columns]
+        if self.cleanup:
+            df = df.set_axis(pd.Index(self.get_read_ids(df.index.values), name="read_id"), axis=0)
+        return df
+
+    def save (self, dir_path):
+        """
+        Save the parsed data in dir_path, so that it can be reloaded with pycoQC_parse.load without the raw files.
+        reads_df and alignments_df are stored as one npy file per column, with the counters, the reference lengths, the
+        source files lists and the parsing options in a json file. The read index is also saved if it was built.
+        An existing session in dir_path is replaced
+        * dir_path
+            Path to the output directory
+        """
+        self.logger.warning ("Save parsed data to {}".format(dir_path))
+        dir_path = path.abspath(dir_path)
+        makedirs(path.dirname(dir_path), exist_ok=True)
+
+        # Write in a temporary directory renamed at the end, so that incomplete sessions are never loaded
+        tmp_dir = tempfile.mkdtemp(dir=path.dirname(dir_path), prefix=".tmp_")
+        try:
+            meta = OrderedDict()
+            meta["version"] = self.session_version
+            meta["package_version"] = package_version
+            meta["counter"] = self.counter
+            meta["attributes"] = {attr:getattr(self, attr) for attr in self.session_attributes}
+
+            for name, df in (("reads", self.reads_df), ("alignments", self.alignments_df)):
+                makedirs(path.join(tmp_dir, name))
+                arrays = OrderedDict((col, df[col].values) for col in df.columns)
+                meta[name] = {"columns":save_column_arrays(arrays, path.join(tmp_dir, name))}
+                if not isinstance(df.index, pd.RangeIndex):
+                    index_dir = path.join(tmp_dir, name, "index")
+                    makedirs(index_dir)
+                    meta[name]["index"] = save_column_arrays({df.index.name:df.index.values}, index_dir)[0]
+
+            if self.read_id_array is not None:
+                makedirs(path.join(tmp_dir, "read_id_array"))
+                meta["read_id_array"] = save_column_arrays({"read_id":self.read_id_array}, path.join(tmp_dir, "read_id_array"))
+            if self._reads_index is not None:
+                self._reads_index.save(path.join(tmp_dir, "reads_index"))
+
+            with open(path.join(tmp_dir, "session.json"), "w") as fp:
+                json.dump(meta, fp, indent=2, default=lambda o: o.item() if hasattr(o, "item") else str(o))
+
+            if path.isdir(dir_path):
+                if not path.isfile(path.join(dir_path, "session.json")):
+                    raise pycoQCError ("{} exists and is not a pycoQC session directory".format(dir_path))
+                shutil.rmtree(dir_path)
+            rename(tmp_dir, dir_path)
+
+        except:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load (cls, dir_path, verbose:bool=False, quiet:bool=False):
+        """
+        Load parsed data saved with save. The numeric and categorical columns are memory mapped, so that loading is almost
+        instantaneous and the data is shared through the page cache between processes loading the same session.
+        Return a pycoQC_parse object that can be passed to pycoQC_plot and pycoQC_report
+        * dir_path
+            Path to a directory generated by save
+        """
+        self = cls.__new__(cls)
+        self.logger = get_logger(name=__name__, verbose=verbose, quiet=quiet)
+        self.logger.warning ("Load parsed data from {}".format(dir_path))
+
+        try:
+            with open(path.join(dir_path, "session.json")) as fp:
+                meta = json.load(fp, object_pairs_hook=OrderedDict)
+        except (OSError, ValueError) as E:
+            raise pycoQCError ("{} is not a valid pycoQC session directory: {}".format(dir_path, E))
+        if meta.get("version") != cls.session_version:
+            raise pycoQCError ("Session {} was saved with an incompatible version of {}".format(dir_path, package_name))
+
+        for attr, val in meta["attributes"].items():
+            setattr(self, attr, val)
+        self.counter = meta["counter"]
+        self.threads = 1
+        self.cache_dir = ""
+        self._parse_filters = {}
+
+        for name in ("reads", "alignments"):
+            arrays = load_column_arrays(path.join(dir_path, name), meta[name]["columns"])
+            index = None
+            if meta[name].get("index"):
+                index_meta = meta[name]["index"]
+                index = pd.Index(load_column_arrays(path.join(dir_path, name, "index"), [index_meta])[index_meta["name"]], name=index_meta["name"])
+            setattr(self, "{}_df".format(name), pd.DataFrame(arrays, index=index, copy=False))
+
+        self.read_id_array = None
+        if meta.get("read_id_array"):
+            self.read_id_array = load_column_arrays(path.join(dir_path, "read_id_array"), meta["read_id_array"])["read_id"]
+        self._reads_index = Reads_index.load(path.join(dir_path, "reads_index"))
+        self._session_dir = path.abspath(dir_path)
+
+        self.logger.debug ("\t{:,} reads loaded".format(len(self.reads_df)))
+        return self
+
+    def share (self, dir_path:str=""):
+        """
+        Share the parsed data between processes without serialisation or copy. The data is saved in a reads store and a
+        pycoQC_parse object reading it with memory mapped columns is returned. This object is pickled as a reference to the
+        store, so that worker processes, for example of a multiprocessing pool, attach to the same data in the page cache
+        instead of receiving a copy of reads_df. Parsers loaded with load are shared the same way.
+        By default the store is a temporary directory in shared memory (/dev/shm), removed when the returned object is
+        garbage collected in the process that created it. The object has to be kept alive while workers attach to the store
+        * dir_path
+            If given, the store is saved in this directory and kept, as with save
+        """
+        if not dir_path and getattr(self, "_session_dir", None):
+            return self
+
+        temporary = not dir_path
+        if temporary:
+            dir_path = path.join(tempfile.mkdtemp(dir=SHARED_STORE_DIR, prefix="pycoQC_"), "store")
+        self.save(dir_path)
+        shared = self.load(dir_path, *self._log_levels())
+        if temporary:
+            weakref.finalize(shared, self._remove_shared_store, path.dirname(dir_path), os.getpid())
+        return shared
+
+    def __reduce_ex__ (self, protocol):
+        """Parsers reading a saved session are pickled as a reference to the session directory"""
+        if getattr(self, "_session_dir", None):
+            return (self.__class__.load, (self._session_dir, *self._log_levels()))
+        return super().__reduce_ex__(protocol)
+
     def __repr__(self):
         return "[{}]\n".format(self.__class__.__name__)
 
+    @classmethod
+    def estimate_memory (cls,
+        summary_file:str,
+        barcode_file:str="",
+        bam_file:str="",
+        filter_duplicated:bool=False,
+        read_fields:list=None,
+        threads:int=1,
+        verbose:bool=False,
+        quiet:bool=False):
+        """
+        Estimate the peak memory needed to parse the input files and generate the reports, without parsing them. The number of
+        reads is extrapolated from the first blocks of each file and the number of alignments from the Bam indexes.
+        Return an OrderedDict with the estimated number of reads, the peak memory in bytes in the default mode ("full") and
+        in low_memory mode ("compact", None if the read_ids needed are not UUIDs), and for pycoQC_stream the fixed memory
+        ("chunked") and the memory per read of a chunk ("chunk_read")
+        * summary_file, barcode_file, bam_file, filter_duplicated, read_fields, threads
+            Same options as for pycoQC_parse
+        """
+        self = cls.__new__(cls)
+        self.logger = get_logger(name=__name__, verbose=verbose, quiet=quiet)
+        self.filter_duplicated = filter_duplicated
+        self.read_fields = read_fields
+        self.counter = OrderedDict()
+        self._check_input_files(summary_file, barcode_file, bam_file)
+        m = self.memory_usage_dict
+
+        n_reads = sum(estimate_file_rows(fn) for fn in self.summary_files_list)
+        n_barcodes = sum(estimate_file_rows(fn) for fn in self.barcode_files_list) if self._field_needed("barcode") else 0
+        n_alignments = 0
+        if self._field_needed(*self.bam_coord_fields, *self.bam_cigar_fields, *self.bam_tag_fields):
+            for fn in self.bam_file_list:
+                if not is_stream(fn):
+                    with ps.AlignmentFile(fn, "r") as bam:
+                        if bam.has_index():
+                            n_alignments += sum(s.total for s in bam.get_index_statistics())+bam.nocoordinate
+                            continue
+                # Without index, assume one alignment per read
+                n_alignments += n_reads
+        self.logger.debug ("\tEstimated {:,} reads, {:,} barcode records and {:,} alignments".format(n_reads, n_barcodes, n_alignments))
+
+        # Read_ids can only be stored as binary values if they are UUIDs
+        read_ids_needed = self._read_ids_needed()
+        uuid = True
+        if read_ids_needed:
+            for fn in self.summary_files_list+self.barcode_files_list:
+                read_id_col = "read_ID" if "read_ID" in get_file_header(fn) else "read_id"
+                with open_file(fn) as fp:
+                    read_ids = pd.read_csv(fp, sep="\t", usecols=[read_id_col], nrows=1000)[read_id_col].values
+                uuid &= uuid_to_bytes(read_ids) is not None
+
+        # Parsing processes hold their share of the reads in addition to the main process
+        parse_factor = 1.5 if threads > 1 else 1
+        report = m["report_overhead"]+n_reads*m["report_read"]
+        d = OrderedDict()
+        d["reads"] = n_reads
+        for mode in ("full", "compact"):
+            read_memory = m["compact_read_no_read_id"] if mode == "compact" and not read_ids_needed else m[mode+"_read"]
+            parse = m["overhead"]+n_reads*read_memory*parse_factor
+            tables = n_barcodes*m[mode+"_barcode_read"]+n_alignments*m["alignment"]
+            d[mode] = int(max(parse, report)+tables)
+        if read_ids_needed and not uuid:
+            d["compact"] = None
+        d["chunked"] = int(m["report_overhead"]+m["stream_overhead"]+n_barcodes*m["full_barcode_read"]+n_alignments*m["alignment"]+
+            (n_reads*m["seen_read_id"] if filter_duplicated else 0))
+        d["chunk_read"] = m["chunk_read"]
+        return d
+
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 
+    def _log_levels (self):
+        """Return the (verbose, quiet) options corresponding to the current log level"""
+        return (self.logger.level == logging.DEBUG, self.logger.level == logging.WARNING)
+
+    @staticmethod
+    def _remove_shared_store (dir_path, pid):
+        """Remove a temporary reads store, only from the process that created it and not from forked workers"""
+        if os.getpid() == pid:
+            shutil.rmtree(dir_path, ignore_errors=True)
+
+    def _get_reads_index (self):
+        """Return the read index of reads_df. If cache_dir is given the index is saved and reused for the same input files and options"""
+        if self._reads_index is not None and len(self._reads_index) == len(self.reads_df):
+            return self._reads_index
+
+        index_dir = ""
+        if self.cache_dir and not any(is_stream(fn) for fn in self.bam_file_list):
+            files = [(path.abspath(fn), stat(fn).st_size, stat(fn).st_mtime_ns)
+                for fn in self.summary_files_list+self.barcode_files_list+self.bam_file_list]
+            key = json.dumps([CACHE_VERSION, files, self._parse_options, len(self.reads_df)], sort_keys=True, default=str)
+            index_dir = path.join(self.cache_dir, "reads_index", hashlib.sha1(key.encode()).hexdigest()[:16])
+            self._reads_index = Reads_index.load(index_dir)
+            if self._reads_index is not None and len(self._reads_index) == len(self.reads_df):
+                self.logger.debug ("\tRead index loaded from {}".format(index_dir))
+                return self._reads_index
+
+        self.logger.debug ("\tBuilding read index")
+        read_ids = self.get_read_ids() if self.cleanup else self.reads_df["read_id"].values
+        df = self.reads_df if self.cleanup else self.reads_df.drop(columns="read_id")
+        self._reads_index = Reads_index(read_ids, df)
+        if index_dir:
+            try:
+                self._reads_index.save(index_dir)
+            except OSError as E:
+                warnings.warn("Could not save the read index in {}: {}".format(index_dir, E), pycoQCWarning)
+        return self._reads_index
+
+    def _check_input_files (self, summary_file, barcode_file, bam_file):
+        """Expand file names and test readability"""
+        self.summary_files_list = expand_file_names(summary_file)
+        self.logger.debug ("\t\tSequencing summary files found: {}".format(" ".join(self.summary_files_list)))
+        self.counter["Summary files found"] = len(self.summary_files_list)
+
+        if barcode_file:
+            self.barcode_files_list = expand_file_names(barcode_file)
+            self.logger.debug ("\t\tBarcode files found: {}".format(" ".join(self.barcode_files_list)))
+            self.counter["Barcode files found"] = len(self.barcode_files_list)
+        else:
+            self.barcode_files_list =[]
+
+        if bam_file:
+            self.bam_file_list = expand_file_names(bam_file, bam_check=True)
+            self.logger.debug ("\t\tBam files found: {}".format(" ".join(self.bam_file_list)))
+            self.counter["Bam files found"] = len(self.bam_file_list)
+        else:
+            self.bam_file_list =[]
+
+    def _field_needed (self, *fields):
+        """Return True if any of the fields is needed downstream"""
+        return self.read_fields is None or any(field in self.read_fields for field in fields)
+
+    def _prune_fields (self):
+        """Restrict the summary columns to parse to the read fields needed downstream and to the columns used by filters"""
+        if self.read_fields is None:
+            return
+        self.logger.debug ("\tRead fields needed: {}".format(" ".join(self.read_fields)))
+        needed = set(self.read_fields)
+        if self.filter_calibration:
+            needed.add("calibration")
+        self.summary_required_colnames = [col for col in self.summary_required_colnames if col != "channel" or col in needed]
+        self.summary_optional_colnames = [col for col in self.summary_optional_colnames if col in needed]
+
+    def _progress (self, stage, fn_list=[], total_bytes=None, unit="reads"):
+        """Return a Progress object reporting a parsing stage of the files in fn_list"""
+        if total_bytes is None:
+            total_bytes = 0 if any(is_stream(fn) for fn in fn_list) else sum(path.getsize(fn) for fn in fn_list)
+        return Progress (stage, total_bytes=total_bytes, unit=unit, logger=self.logger,
+            progress_bar=self.progress_bar, callback=self.progress_callback)
+
+    def _get_parse_filters (self):
+        """
+        Define the filters on run_id, start_time and pass reads that are applied while parsing the summary files,
+        so that the rows of excluded reads are never loaded. See filter_rows for the format
+        """
+        filters = OrderedDict()
+        if self.runid_list:
+            filters["run_id"] = {"isin":list(self.runid_list)}
+        if self.min_time or self.max_time:
+            filters["start_time"] = {"min":self.min_time*3600 if self.min_time else None, "max":self.max_time*3600 if self.max_time else None}
+        if self.pass_only:
+            filters["mean_qscore"] = {"min":self.min_pass_qual}
+            filters["read_len"] = {"min":self.min_pass_len}
+        return filters
+
+    def _get_parse_discarded (self, filtered_rows):
+        """Convert the number of rows discarded by the parsing filter of each column to counts per read filter label"""
+        discarded_dict = OrderedDict()
+        for col, n in filtered_rows.items():
+            label = self.parse_filter_labels[col]
+            discarded_dict[label] = discarded_dict.get(label, 0)+n
+        return discarded_dict
+
     def _parse_summary (self):
         """"""
         self.logger.debug ("\tParse summary files")
-        df = merge_files_to_df (self.summary_files_list)
 
         if self.cleanup:
-            # Standardise col names for all types of files
-            self.logger.debug ("\tRename summary sequencing columns")
-            rename_colmanes = {
-                "sequence_length_template":"read_len",
-                "sequence_length_2d":"read_len",
-                "sequence_length":"read_len",
-                "mean_qscore_template":"mean_qscore",
-                "mean_qscore_2d":"mean_qscore",
-                "calibration_strand_genome_template":"calibration",
-                "barcode_arrangement":"barcode"}
-            df = df.rename(columns=rename_colmanes)
-
-            # Verify the required and optional columns, Drop unused fields
-            self.logger.debug ("\tVerifying fields and discarding unused columns")
-            df = self._select_df_columns (
-                df = df,
-                required_colnames = ["read_id", "run_id", "channel", "start_time", "read_len", "mean_qscore"],
-                optional_colnames = ["calibration", "barcode"])
+            # Only load the required and optional columns with standardised names and compact types
+            self.logger.debug ("\tResolve summary sequencing columns from file headers")
+            with self._progress("Parse summary files", self.summary_files_list) as progress:
+                df = merge_files_to_df (
+                    self.summary_files_list,
+                    threads = self.threads,
+                    cache_dir = self.cache_dir,
+                    progress = progress,
+                    rename_colnames = self.summary_rename_colnames,
+                    required_colnames = self.summary_required_colnames,
+                    optional_colnames = self.summary_optional_colnames,
+                    dtype_dict = self.summary_dtype_dict,
+                    filters = self._parse_filters,
+                    **self._read_id_kwargs())
+        else:
+            with self._progress("Parse summary files", self.summary_files_list) as progress:
+                df = merge_files_to_df (self.summary_files_list, threads=self.threads, cache_dir=self.cache_dir, progress=progress)
 
         # Collect stats
-        n = len(df)
+        self._parse_discarded = df.attrs.get("filtered_rows", OrderedDict())
+        n = len(df)+sum(self._parse_discarded.values())
         self.logger.debug ("\t\t{:,} reads found in initial file".format(n))
         self.counter["Initial reads"] = n
 
+        # Name the parsing filter that discarded all the reads
+        if df.empty:
+            discarded_dict = self._get_parse_discarded(self._parse_discarded)
+            for label, (msg, filter_name) in self.read_filters_dict.items():
+                n -= discarded_dict.get(label, 0)
+                if n <= 0:
+                    raise pycoQCError("No valid read left after {} filtering".format(filter_name))
+
         return df
 
     def _parse_barcode (self):
         """"""
         if not self.barcode_files_list:
             return pd.DataFrame()
+        if not self._field_needed("barcode"):
+            self.logger.debug ("\tSkipping barcode files not needed")
+            return pd.DataFrame()
 
         self.logger.debug ("\tParse barcode files")
-        df = merge_files_to_df (self.barcode_files_list)
 
-        # check presence of barcode details
-        if "read_id" in df and "barcode_arrangement" in df:
+        # check presence of barcode details in the header to only load the read_id and barcode columns
+        fn = self.barcode_files_list[0]
+        header = get_file_header (fn)
+        if "read_id" in header and "barcode_arrangement" in header:
             self.logger.debug ("\t\tFound valid Guppy barcode file")
-            df = df [["read_id", "barcode_arrangement"]]
-            df = df.rename(columns={"barcode_arrangement":"barcode"})
-
-        elif "read_ID" in df and "barcode_call" in df:
+            rename_colnames = {"barcode_arrangement":"barcode"}
+        elif "read_ID" in header and "barcode_call" in header:
             self.logger.debug ("\t\tFound valid Deepbinner barcode file")
-            df = df [["read_ID", "barcode_call"]]
-            df = df.rename(columns={"read_ID":"read_id", "barcode_call":"barcode"})
-            df['barcode'].replace("none", "unclassified", inplace=True)
+            rename_colnames = {"read_ID":"read_id", "barcode_call":"barcode"}
         else:
-            raise pycoQCError ("File {} does not contain required barcode information".format(fp))
+            raise pycoQCError ("File {} does not contain required barcode information".format(fn))
+
+        with self._progress("Parse barcode files", self.barcode_files_list) as progress:
+            df = merge_files_to_df (self.barcode_files_list, threads=self.threads, cache_dir=self.cache_dir, progress=progress,
+                rename_colnames=rename_colnames, required_colnames=["read_id", "barcode"], dtype_dict={"barcode":"category"},
+                **self._read_id_kwargs())
+
+        # Deepbinner reports unassigned reads as none
+        barcodes = df["barcode"].cat.categories
+        if "none" in barcodes:
+            if "unclassified" in barcodes:
+                df["barcode"] = df["barcode"].replace("none", "unclassified").cat.remove_unused_categories()
+            else:
+                df["barcode"] = df["barcode"].cat.rename_categories({"none":"unclassified"})
 
-        n = len(df[df['barcode']!="unclassified"])
+        n = int((df['barcode']!="unclassified").sum())
         self.logger.debug ("\t\t{:,} reads with barcodes assigned".format(n))
         self.counter["Reads with barcodes"] = n
 
@@ -177,33 +665,64 @@ class pycoQC_parse ():
         """"""
         if not self.bam_file_list:
             return (pd.DataFrame(), pd.DataFrame(), OrderedDict())
+        if not self._field_needed(*self.bam_coord_fields, *self.bam_cigar_fields, *self.bam_tag_fields):
+            self.logger.debug ("\tSkipping bam files not needed")
+            return (pd.DataFrame(), pd.DataFrame(), OrderedDict())
 
-        # Init collections
-        ref_len_dict = OrderedDict()
-        alignments_dict = Counter()
-        read_dict = OrderedDict ()
+        # Only extract the CIGAR and tag based statistics if needed
+        self._cigar_stats = self._field_needed(*self.bam_cigar_fields, *self.bam_tag_fields)
+        self._tag_stats = self._field_needed(*self.bam_tag_fields)
 
+        # Reload the statistics of bam files cached by previous runs. Streams are never cached
+        file_result_dict = OrderedDict()
         for bam_fn in self.bam_file_list:
-            with ps.AlignmentFile(bam_fn, "rb") as bam:
-
-                # Save reference lengths information
-                for ref_id, ref_len in zip(bam.references, bam.lengths):
-                    if not ref_id in ref_len_dict:
-                        ref_len_dict[ref_id] = ref_len
-
-                # Parse reads
-                for read in bam:
-                    if read.is_unmapped:
-                        alignments_dict["Unmapped"]+=1
-                    elif read.is_secondary:
-                        alignments_dict["Secondary"]+=1
-                    elif read.is_supplementary:
-                        alignments_dict["Suplementary"]+=1
-                    elif read.query_name in read_dict:
-                        alignments_dict["Duplicated"]+=1
-                    else:
-                        alignments_dict["Primary"]+=1
-                        read_dict[read.query_name] = self._get_read_stats(read)
+            cached = load_cached_arrays(bam_fn, self._bam_cache_kwargs(bam_fn), self.cache_dir) if self.cache_dir and not is_stream(bam_fn) else None
+            if cached:
+                col_dict, _, meta = cached
+                ordinals = np.asarray(col_dict.pop("ordinal"))
+                file_result_dict[bam_fn] = (Counter(OrderedDict(meta["counts"])), OrderedDict(meta["first"]), col_dict, ordinals,
+                    [tuple(ref) for ref in meta["references"]])
+        parse_list = [bam_fn for bam_fn in self.bam_file_list if not bam_fn in file_result_dict]
+        if file_result_dict:
+            self.logger.debug ("\t\tReusing cached statistics of {} bam files".format(len(file_result_dict)))
+
+        # Parse reads, by reference regions in a process pool if threads > 1
+        tasks = self._get_bam_tasks(parse_list)
+        with self._progress("Parse bam files", self.bam_file_list, unit="alignments") as progress:
+            for bam_fn, (counts, _, _, _, _) in file_result_dict.items():
+                progress.add_bytes(path.getsize(bam_fn))
+                progress.update(sum(counts.values()))
+            if len(tasks) > 1:
+                self.logger.debug ("\t\tParsing {} bam regions with {} processes".format(len(tasks), min(self.threads, len(tasks))))
+                task_threads = max(1, self.threads//len(tasks))
+                args_list = [(i, (bam_fn, regions, self._cigar_stats, self._tag_stats, task_threads)) for i, (bam_fn, regions, _) in enumerate(tasks)]
+                results = [None]*len(tasks)
+                with mp.Pool(processes=min(self.threads, len(tasks))) as pool:
+                    for i, res in pool.imap_unordered(self._parse_bam_indexed_task, args_list):
+                        results[i] = res
+                        progress.add_bytes(tasks[i][2])
+                        progress.update(sum(res[0].values()))
+            else:
+                results = []
+                for bam_fn, regions, n_bytes in tasks:
+                    results.append(self._parse_bam_task(bam_fn, regions, self._cigar_stats, self._tag_stats, threads=self.threads,
+                        progress=progress, file_offset=progress.bytes))
+
+        # Merge the regions of each file and cache the results
+        for bam_fn in parse_list:
+            file_result_dict[bam_fn] = self._merge_bam_results([res for task, res in zip(tasks, results) if task[0] == bam_fn])
+            if self.cache_dir and not is_stream(bam_fn):
+                counts, first_dict, col_dict, ordinals, references = file_result_dict[bam_fn]
+                extra_meta = {
+                    "counts":[(category, int(n)) for category, n in counts.items()],
+                    "first":[(category, int(ordinal)) for category, ordinal in first_dict.items()],
+                    "references":references}
+                save_cached_arrays(OrderedDict(col_dict, ordinal=ordinals), bam_fn, self._bam_cache_kwargs(bam_fn), self.cache_dir,
+                    extra_meta=extra_meta)
+
+        # Merge all files
+        alignments_dict, _, col_dict, _, references = self._merge_bam_results([file_result_dict[bam_fn] for bam_fn in self.bam_file_list])
+        ref_len_dict = OrderedDict(references)
 
         # Convert aligments_dict to df
         if alignments_dict:
@@ -214,128 +733,349 @@ class pycoQC_parse ():
         else:
             alignments_df = pd.DataFrame()
 
-        # Convert read_dict to df
-        if read_dict:
-            read_df = pd.DataFrame.from_dict(read_dict, orient="index")
-            read_df.index.name="read_id"
-            read_df.reset_index(inplace=True)
+        # Convert the alignment columns to df. Tag fields are only reported if NM, MD, cs or de tags were found
+        if len(col_dict["read_id"]):
+            read_df = pd.DataFrame(col_dict, copy=False)
+            read_df["ref_id"] = read_df["ref_id"].cat.set_categories(list(ref_len_dict.keys()))
+            if "identity_freq" in read_df and read_df["identity_freq"].isna().all():
+                read_df = read_df.drop(columns=self.bam_tag_fields)
         else:
             read_df = pd.DataFrame()
 
         return (read_df, alignments_df, ref_len_dict)
 
-    def _merge_reads_df(self, summary_reads_df, barcode_reads_df, bam_reads_df):
-        """"""
-        df = summary_reads_df
-
-        # Merge df and fill in missing barcode values
-        if not barcode_reads_df.empty:
-            df = pd.merge(df, barcode_reads_df, on="read_id", how="left")
-            df['barcode'].fillna('unclassified', inplace=True)
+    def _bam_cache_kwargs (self, bam_fn):
+        """Options identifying the cached statistics of a bam file: the fields extracted and the state of the bam index"""
+        index_state = None
+        for index_fn in (bam_fn+".bai", bam_fn+".csi", path.splitext(bam_fn)[0]+".bai"):
+            if path.isfile(index_fn):
+                st = stat(index_fn)
+                index_state = [path.abspath(index_fn), st.st_size, st.st_mtime_ns]
+                break
+        return {"bam_stats":{"cigar_stats":self._cigar_stats, "tag_stats":self._tag_stats}, "index":index_state}
+
+    def _get_bam_tasks (self, bam_file_list):
+        """
+        Split bam files in tasks of consecutive reference regions with similar numbers of alignments, estimated from the
+        index statistics. Return a list of (bam_fn, regions, n_bytes) tuples in the order of the files, where regions is a list
+        of (contig, start, end) regions or None to parse the whole file, and n_bytes the estimated size of the task.
+        Contig "*" stands for the unmapped reads without coordinates. Streams are only read once, sequentially in the main process,
+        so all the files are parsed as a whole if any of them is a stream
+        """
+        if any(is_stream(bam_fn) for bam_fn in bam_file_list):
+            return [(bam_fn, None, 0 if is_stream(bam_fn) else path.getsize(bam_fn)) for bam_fn in bam_file_list]
+        if self.threads == 1:
+            return [(bam_fn, None, path.getsize(bam_fn)) for bam_fn in bam_file_list]
+
+        # Count the alignments of each contig. Unindexed files, for example unsorted bam or sam files, have no statistics
+        file_stats_list = []
+        for bam_fn in bam_file_list:
+            with ps.AlignmentFile(bam_fn, "r") as bam:
+                if not bam.has_index():
+                    file_stats_list.append((bam_fn, []))
+                    continue
+                contig_stats = [(s.contig, None, s.total) for s in bam.get_index_statistics() if s.total]
+                if bam.nocoordinate:
+                    contig_stats.append(("*", None, bam.nocoordinate))
+                file_stats_list.append((bam_fn, [(contig, bam.get_reference_length(contig) if contig != "*" else 0, n) for contig, _, n in contig_stats]))
+        total = sum(n for _, contig_stats in file_stats_list for _, _, n in contig_stats)
+        task_size = max(self.bam_task_alignments, total//(self.threads*4)+1)
+
+        # Group small contigs and split large contigs in regions of equal lengths
+        tasks = []
+        for bam_fn, contig_stats in file_stats_list:
+            bytes_per_alignment = path.getsize(bam_fn)/max(1, sum(n for _, _, n in contig_stats))
+            # Files without index statistics are parsed as a whole
+            if not contig_stats:
+                tasks.append((bam_fn, None, path.getsize(bam_fn)))
+                continue
+            regions, n_task = [], 0
+            for contig, length, n in contig_stats:
+                n_parts = -(-n//task_size) if contig != "*" else 1
+                if regions and (n_task+n > task_size or n_parts > 1):
+                    tasks.append((bam_fn, regions, int(n_task*bytes_per_alignment)))
+                    regions, n_task = [], 0
+                if n_parts == 1:
+                    regions.append((contig, 0, None))
+                    n_task += n
+                else:
+                    bounds = np.linspace(0, length, n_parts+1).astype(int).tolist()
+                    for start, end in zip(bounds[:-1], bounds[1:-1]+[None]):
+                        tasks.append((bam_fn, [(contig, start, end)], int(n/n_parts*bytes_per_alignment)))
+            if regions:
+                tasks.append((bam_fn, regions, int(n_task*bytes_per_alignment)))
+        return tasks
+
+    @classmethod
+    def _parse_bam_indexed_task (cls, args):
+        """Worker function running the indexed task (i, args of _parse_bam_task) and returning i with the results"""
+        i, task = args
+        return (i, cls._parse_bam_task(*task))
+
+    @classmethod
+    def _parse_bam_task (cls, bam_fn, regions, cigar_stats, tag_stats, threads=1, progress=None, file_offset=0):
+        """
+        Worker function parsing the alignments of a bam file, or only the alignments starting in a list of (contig, start, end)
+        regions. bam_fn can be any SAM/BAM file or stream. Return a Counter of the alignment categories, a dict of the ordinal of
+        the first record of each category, an OrderedDict of the columns of the first primary alignment of each read (see
+        Alignment_buffer.get_columns), the array of the ordinals of these records and the list of (reference, length) of the header.
+        If progress is given, the bytes read from the file (starting at file_offset) and the records parsed are added to it.
+        Only records are counted for streams
+        """
+        stream = is_stream(bam_fn)
+        alignments_dict = Counter()
+        first_dict = OrderedDict()
+        read_id_set = set()
+        ordinals = array("q")
+        n = 0
+        with ps.AlignmentFile(bam_fn, "r", threads=threads) as bam:
+            references = list(zip(bam.references, bam.lengths))
+            buffer = Alignment_buffer(bam.references, cigar_stats, tag_stats)
+            bgzf = bam.compression == "BGZF"
+            if regions is None:
+                iter_list = [(bam, 0)]
+            else:
+                iter_list = [(bam.fetch(contig) if contig == "*" else bam.fetch(contig, start, end), start) for contig, start, end in regions]
 
-        # Merge df and fill in missing barcode values
-        if not bam_reads_df.empty:
-            df = pd.merge(df, bam_reads_df, on="read_id", how="left")
+            for reads, start in iter_list:
+                for read in reads:
+                    # Alignments overlapping the region start are parsed with the previous region
+                    if start and read.reference_start < start:
+                        continue
+                    if read.is_unmapped:
+                        category = "Unmapped"
+                    elif read.is_secondary:
+                        category = "Secondary"
+                    elif read.is_supplementary:
+                        category = "Suplementary"
+                    elif read.query_name in read_id_set:
+                        category = "Duplicated"
+                    else:
+                        category = "Primary"
+                        read_id_set.add(read.query_name)
+                        buffer.append(read)
+                        ordinals.append(n)
+                    alignments_dict[category] += 1
+                    if not category in first_dict:
+                        first_dict[category] = n
+                    n += 1
+                    if progress and n%10000 == 0:
+                        # Compressed offset of the BGZF virtual offset, or offset in uncompressed sam files
+                        if not stream:
+                            progress.set_bytes(file_offset+(bam.tell()>>16 if bgzf else bam.tell()))
+                        progress.update(10000)
+
+        if progress:
+            if not stream:
+                progress.set_bytes(file_offset+path.getsize(bam_fn))
+            progress.update(n%10000)
+        return (alignments_dict, first_dict, buffer.get_columns(buffer.references), np.array(ordinals, dtype=np.int64), references)
+
+    def _merge_bam_results (self, results):
+        """
+        Merge bam parsing results in order, as if their records were parsed serially. Each result is a tuple of a Counter of
+        the alignment categories, a dict of the ordinal of the first record of each category, an OrderedDict of the columns
+        of the first primary alignment of each read, the array of the ordinals of these records and the list of (reference, length).
+        Ordinals are offset by the number of records of the previous results, reads with primary alignments in several results are
+        only kept from the first one and counted as duplicated, and the categories and references are ordered by first occurrence.
+        Return the merged result
+        """
+        if len(results) == 1:
+            return results[0]
 
-        return df
+        counts = Counter()
+        first_dict = {}
+        ordinals_list = []
+        ref_len_dict = OrderedDict()
+        offset = 0
+        for alignments_dict, result_first_dict, _, ordinals, references in results:
+            counts.update(alignments_dict)
+            for ref_id, ref_len in references:
+                ref_len_dict.setdefault(ref_id, ref_len)
+            for category, ordinal in result_first_dict.items():
+                first_dict[category] = min(first_dict.get(category, offset+ordinal), offset+ordinal)
+            ordinals_list.append(np.asarray(ordinals)+offset)
+            offset += sum(alignments_dict.values())
+
+        # Primary alignments of reads already found in a previous result are duplicated
+        ordinals = np.concatenate(ordinals_list)
+        duplicated = pd.Index(np.concatenate([res[2]["read_id"] for res in results])).duplicated(keep="first")
+        n_duplicated = int(duplicated.sum())
+        columns_list = [res[2] for res in results]
+        if n_duplicated:
+            counts["Primary"] -= n_duplicated
+            counts["Duplicated"] += n_duplicated
+            first_ordinal = int(ordinals[duplicated].min())
+            first_dict["Duplicated"] = min(first_dict.get("Duplicated", first_ordinal), first_ordinal)
+            bounds = np.cumsum([0]+[len(res[3]) for res in results])
+            columns_list = [OrderedDict((col, a[~duplicated[start:end]]) for col, a in col_dict.items())
+                for col_dict, start, end in zip(columns_list, bounds[:-1], bounds[1:])]
+            ordinals = ordinals[~duplicated]
 
-    def _clean_reads_df (self, df):
-        """"""
-        # Drop lines containing NA values
-        self.logger.info ("\tDiscarding lines containing NA values")
-        l = len(df)
-        df = df.dropna(subset=["read_id", "run_id", "channel", "start_time", "read_len", "mean_qscore"])
-        n=l-len(df)
-        self.logger.info ("\t\t{:,} reads discarded".format(n))
-        self.counter["Reads with NA values discarded"] = n
-        if len(df) <= 1:
-            raise pycoQCError("No valid read left after NA values filtering")
+        alignments_dict = Counter()
+        for category in sorted(first_dict, key=first_dict.get):
+            alignments_dict[category] = counts[category]
+        df = concat_arrays(columns_list)
+        col_dict = OrderedDict((col, df[col].values) for col in df.columns)
+        first_dict = OrderedDict((category, first_dict[category]) for category in alignments_dict)
+        return (alignments_dict, first_dict, col_dict, ordinals, list(ref_len_dict.items()))
+
+    def _encode_read_ids (self, summary_reads_df, barcode_reads_df, bam_reads_df):
+        """
+        Replace read_ids by integer codes indexing read_id_array, the unique read_ids of the summary files stored as
+        16-byte binary UUIDs. Barcode and alignment records of reads absent from the summary files are dropped
+        """
+        if not "read_id" in summary_reads_df and not "read_id_hi" in summary_reads_df:
+            summary_reads_df.insert(0, "read_id", np.arange(len(summary_reads_df)))
+            return (summary_reads_df, barcode_reads_df, bam_reads_df)
+
+        self.logger.debug ("\tEncoding read_ids")
+        codes, self.read_id_array = self._read_id_codes(summary_reads_df)
+        if "read_id_hi" in summary_reads_df:
+            del summary_reads_df["read_id_hi"], summary_reads_df["read_id_lo"]
+            summary_reads_df.insert(0, "read_id", pd.arrays.IntegerArray(codes, codes<0))
+        else:
+            summary_reads_df["read_id"] = pd.arrays.IntegerArray(codes, codes<0)
+        self.logger.debug ("\t\t{:,} unique read_ids stored as {}".format(len(self.read_id_array), self.read_id_array.dtype))
+
+        df_list = []
+        for df in (barcode_reads_df, bam_reads_df):
+            if not df.empty:
+                codes, _ = self._read_id_codes(df, self.read_id_array)
+                df = df.drop(columns=["read_id_hi", "read_id_lo"], errors="ignore").assign(read_id=codes)[codes>=0]
+            df_list.append(df)
+
+        return (summary_reads_df, *df_list)
+
+    def _read_ids_needed (self):
+        """Read_ids are only needed to join the barcode and alignment records, and to filter duplicated reads"""
+        return bool(self.filter_duplicated or
+            (self.barcode_files_list and self._field_needed("barcode")) or
+            (self.bam_file_list and self._field_needed(*self.bam_coord_fields, *self.bam_cigar_fields, *self.bam_tag_fields)))
+
+    def _read_id_kwargs (self):
+        """Parsing options storing read_ids as binary keys in low_memory mode"""
+        return {"read_id_keys":True} if self.low_memory and "read_id" in self.summary_required_colnames else {}
+
+    def _read_id_codes (self, df, read_id_array=None):
+        """Encode the read_ids of df, given as strings or as binary keys in low_memory mode. Return (codes, read_id_array)"""
+        if not "read_id_hi" in df:
+            return encode_read_ids(df["read_id"], read_id_array)
+        binary, valid = join_read_id_keys(df)
+        codes = np.full(len(df), -1, dtype=np.int64)
+        codes[valid], read_id_array = encode_read_ids(binary[valid], read_id_array)
+        return (codes, read_id_array)
 
-        # Filter out zero length reads
-        self.logger.info ("\tFiltering out zero length reads")
-        l = len(df)
-        df = df[(df["read_len"] > 0)]
-        n=l-len(df)
-        self.logger.info ("\t\t{:,} reads discarded".format(n))
-        self.counter["Zero length reads discarded"] = n
-        if len(df) <= 1:
-            raise pycoQCError("No valid read left after zero_len filtering")
+    def _merge_reads_df(self, summary_reads_df, barcode_reads_df, bam_reads_df):
+        """
+        Join the barcode and alignment tables to the summary reads through integer read_id codes. Each table is indexed
+        once and its columns are filled by code lookup, without intermediate copies of the summary reads. Only the first
+        record of each read is used and reads without barcode record are set as `unclassified`
+        """
+        df = summary_reads_df
+        if barcode_reads_df.empty and bam_reads_df.empty:
+            return df
 
-        # Filter out reads with duplicated read_id
-        if self.filter_duplicated:
-            self.logger.info ("\tFiltering out duplicated reads")
-            l = len(df)
-            df = df[~df.duplicated(subset="read_id", keep='first')]
-            n=l-len(df)
-            self.logger.info ("\t\t{:,} reads discarded".format(n))
-            self.counter["Duplicated reads discarded"] = n
-            if len(df) <= 1:
-                raise pycoQCError("No valid read left after calibration strand filtering")
+        # Read_ids are already encoded after cleanup
+        encoded = pd.api.types.is_integer_dtype(df["read_id"])
+        if encoded:
+            codes, read_id_array = df["read_id"].to_numpy(dtype=np.int64, na_value=-1), self.read_id_array
+        else:
+            codes, read_id_array = encode_read_ids(df["read_id"])
 
-        # Filter out calibration strand reads if the "calibration_strand_genome_template" field is available
-        if self.filter_calibration and "calibration" in df:
-            self.logger.info ("\tFiltering out calibration strand reads")
-            l = len(df)
-            df = df[(df["calibration"].isin(["filtered_out", "no_match", "*"]))]
-            n=l-len(df)
-            self.logger.info ("\t\t{:,} reads discarded".format(n))
-            self.counter["Calibration reads discarded"] = n
-            if len(df) <= 1:
-                raise pycoQCError("No valid read left after calibration strand filtering")
-
-        # Filter and reorder based on runid_list list if passed by user
-        if self.runid_list:
-            self.logger.info ("\tSelecting run_ids passed by user")
-            l = len(df)
-            df = df[(df["run_id"].isin(self.runid_list))]
-            n=l-len(df)
-            self.logger.debug ("\t\t{:,} reads discarded".format(n))
-            self.counter["Excluded runid reads discarded"] = n
-            if len(df) <= 1:
-                raise pycoQCError("No valid read left after run ID filtering")
-            runid_list = self.runid_list
+        for table_df, fill_dict in ((barcode_reads_df, {"barcode":"unclassified"}), (bam_reads_df, {})):
+            if not table_df.empty:
+                table_codes = table_df["read_id"].values if encoded else encode_read_ids(table_df["read_id"], read_id_array)[0]
+                lookup = index_read_codes (table_codes, len(read_id_array))
+                columns = [col for col in table_df.columns if col != "read_id"]
+                for col, values in join_read_columns(codes, lookup, table_df, columns, fill_dict).items():
+                    df[col] = values
 
-        # Else sort the runids by output per time assuming that the throughput decreases over time
-        else:
-            self.logger.info ("\tSorting run IDs by decreasing throughput")
-            d = {}
-            for run_id, sdf in df.groupby("run_id"):
-                d[run_id] = len(sdf)/np.ptp(sdf["start_time"])
-            runid_list = [i for i, j in sorted (d.items(), key=lambda t: t[1], reverse=True)]
-            self.logger.info ("\t\tRun-id order {}".format(runid_list))
+        return df
 
-        # Modify start time per run ids to order them following the runid_list
+    def _clean_reads_df (self, df):
+        """
+        Filter, reorder and cast the reads in a single pass. All the read filters are composed in a single boolean mask,
+        and the valid reads are then copied once, sorted by start_time, in their final types and indexed by read_id. The run_id,
+        barcode and calibration columns are kept as pandas categoricals, restricted to the values of the valid reads, instead of
+        the object columns of previous versions
+        """
+        # Compose read filters
+        l = self.counter["Initial reads"]
+        mask, discarded_dict = self._filter_mask(df)
+        discarded_dict.update(self._get_parse_discarded(self._parse_discarded))
+        for label, (msg, filter_name) in self.read_filters_dict.items():
+            if label in discarded_dict:
+                n = discarded_dict[label]
+                self.logger.info ("\t{}".format(msg))
+                self.logger.info ("\t\t{:,} reads discarded".format(n))
+                self.counter[label] = n
+                l-=n
+                if l <= 1:
+                    raise pycoQCError("No valid read left after {} filtering".format(filter_name))
+
+        # Define the run_ids order and time offsets from the valid reads only, with a single aggregation over run codes
+        idx = np.flatnonzero(mask)
+        del mask
+        codes, uniques = pd.factorize(df["run_id"].array.take(idx))
+        start_time = df["start_time"].to_numpy(dtype="float64", na_value=np.nan)[idx]
+        run_stats_df = pd.Series(start_time).groupby(codes).agg(["count", "min", "max"])
+        run_stats_df.index = pd.Index(uniques)[run_stats_df.index]
+        runid_offset_dict = self._get_runid_offsets(run_stats_df.sort_index())
+
+        # Sort the reads by run following runid_offset_dict then by start_time, and offset start time per run ids
         self.logger.info ("\tReordering runids")
-        increment_time = 0
-        runid_start = OrderedDict()
-        for runid in runid_list:
+        for runid, increment_time in runid_offset_dict.items():
             self.logger.info ("\t\tProcessing reads with Run_ID {} / time offset: {}".format(runid, increment_time))
-            max_val = df['start_time'][df["run_id"] == runid].max()
-            df.loc[df["run_id"] == runid, 'start_time'] += increment_time
-            runid_start[runid] = increment_time
-            increment_time += max_val+1
-        df = df.sort_values ("start_time")
+        runid_list = list(runid_offset_dict.keys())
+        rank_list = [runid_list.index(runid) if runid in runid_offset_dict else len(runid_list) for runid in uniques]
+        ranks = np.array(rank_list, dtype=np.min_scalar_type(len(runid_list)))[codes]
+        del codes
+        order = self._run_time_order(ranks, start_time)
+        idx = idx[order]
+        offsets = np.array([runid_offset_dict[runid] for runid in runid_list]+[0], dtype="float64")
+        start_time = (start_time[order]+offsets[ranks[order]]).astype("float32")
+        del order, ranks
+
+        # Materialise the valid reads once, in their final order and types
+        self.logger.info ("\tCast value to appropriate type")
+        col_dict = OrderedDict()
+        for col in df.columns:
+            if col == "read_id":
+                continue
+            elif col == "start_time":
+                col_dict[col] = start_time
+            elif col in self.clean_dtype_dict:
+                col_dict[col] = df[col].array.take(idx).to_numpy(dtype=self.clean_dtype_dict[col])
+            else:
+                col_dict[col] = df[col].array.take(idx)
+        read_ids = df["read_id"].array.take(idx)
+        if pd.api.types.is_integer_dtype(read_ids.dtype):
+            read_ids = read_ids.to_numpy(dtype="int64")
+        del idx
 
         #  Unset low frequency barcodes
-        if "barcode" in df and self.min_barcode_percent:
+        if "barcode" in col_dict and self.min_barcode_percent:
             self.logger.info ("\tCleaning up low frequency barcodes")
-            l = (df["barcode"]=="unclassified").sum()
-            barcode_counts = df["barcode"][df["barcode"]!="unclassified"].value_counts()
-            cutoff = int(barcode_counts.sum()*self.min_barcode_percent/100)
-            low_barcode = barcode_counts[barcode_counts<cutoff].index
-            df.loc[df["barcode"].isin(low_barcode), "barcode"] = "unclassified"
-            n= int((df["barcode"]=="unclassified").sum()-l)
+            barcodes = pd.Series(col_dict["barcode"], copy=False)
+            l = (barcodes=="unclassified").sum()
+            low_barcode = self._get_low_frequency_barcodes(barcodes.value_counts())
+            if isinstance(barcodes.dtype, pd.CategoricalDtype) and not "unclassified" in barcodes.cat.categories:
+                barcodes = barcodes.cat.add_categories("unclassified")
+            barcodes[barcodes.isin(low_barcode)] = "unclassified"
+            col_dict["barcode"] = barcodes.values
+            n= int((barcodes=="unclassified").sum()-l)
             self.logger.info ("\t\t{:,} reads with low frequency barcode unset".format(n))
             self.counter["Reads with low frequency barcode unset"] = n
 
-        # Cast values to required types
-        self.logger.info ("\tCast value to appropriate type")
-        df = df.astype({'channel':"uint16","start_time":"float32","read_len":"uint32","mean_qscore":"float32"})
+        for col in ["run_id", "barcode", "calibration"]:
+            if col in col_dict and isinstance(col_dict[col].dtype, pd.CategoricalDtype):
+                col_dict[col] = col_dict[col].remove_unused_categories()
 
-        # Reindex final df
+        # Assemble the final df from the column arrays without copy
         self.logger.info ("\tReindexing dataframe by read_ids")
-        df = df.reset_index (drop=True)
-        df = df.set_index ("read_id")
+        df = pd.DataFrame(col_dict, index=pd.Index(read_ids, name="read_id"), copy=False)
+
         self.logger.info ("\t\t{:,} Final valid reads".format(len(df)))
 
         # Save final df
@@ -345,58 +1085,237 @@ class pycoQC_parse ():
 
         return df
 
-    def _get_read_stats(self, read):
-        """"""
-        d = OrderedDict()
+    def _run_time_order (self, ranks, start_time):
+        """
+        Indices sorting reads by run rank, then by start_time within each run. Reads are first grouped in per-run blocks
+        with a linear time radix sort on the small integer ranks, then each block is sorted independently
+        """
+        order = np.argsort(ranks, kind="stable")
+        bounds = np.cumsum(np.bincount(ranks))
+        start = 0
+        for end in bounds:
+            block = order[start:end]
+            order[start:end] = block[np.argsort(start_time[block], kind="stable")]
+            start = end
+        return order
+
+    def _filter_mask (self, df):
+        """
+        Compose all the read level filters in a single boolean mask of the valid reads of df.
+        Return the mask and an OrderedDict with the number of reads discarded by each filter, in order
+        """
+        discarded_dict = OrderedDict()
 
-        # Extract general stats
-        d["ref_id"] = read.reference_name
-        d["ref_start"] = read.reference_start
-        d["ref_end"] = read.reference_end
-        d["align_len"] = read.query_alignment_length
-        d["mapq"] = read.mapping_quality
-
-        # Extract indel and soft_clip from cigar
-        c_stat = read.get_cigar_stats()[0]
-        d["insertion"] = c_stat[1]
-        d["deletion"] = c_stat[2]
-        d["soft_clip"] = c_stat[4]
-
-        # Compute alignment score from NM field if available
-        if read.has_tag("NM"):
-            edit_dist = read.get_tag("NM")
-            d["mismatch"] = edit_dist-(d["deletion"]+d["insertion"])
-            try:
-                d["identity_freq"] = (d["align_len"]-edit_dist)/d["align_len"]
-            except ZeroDivisionError:
-                d["identity_freq"] = 0
-
-        # If not NM try to compute score from MD field
-        elif read.has_tag("MD"):
-            md_err = 0
-            for i in read.get_tag("MD"):
-                if i in ["A","T","C","G","a","t","c","g"]:
-                    md_err += 1
-            d["mismatch"] = md_err-d["deletion"]
-            edit_dist = d["mismatch"]+d["insertion"]+d["deletion"]
-            try:
-                d["identity_freq"] = (d["align_len"]-edit_dist)/d["align_len"]
-            except ZeroDivisionError:
-                d["identity_freq"] = 0
+        # Drop lines containing NA values
+        mask = np.ones(len(df), dtype=bool)
+        for col in self.summary_required_colnames:
+            mask &= df[col].notna().values
+        discarded_dict["Reads with NA values discarded"] = len(df)-int(mask.sum())
 
-        return d
+        # Filter out zero length reads
+        l = int(mask.sum())
+        mask &= (df["read_len"] > 0).fillna(False).values.astype(bool)
+        discarded_dict["Zero length reads discarded"] = l-int(mask.sum())
 
-    def _select_df_columns(self, df, required_colnames, optional_colnames):
-        """"""
-        col_found = []
-        # Verify the presence of the columns required for pycoQC
-        for col in required_colnames:
-            if col in df:
-                col_found.append(col)
-            else:
-                raise pycoQCError("Column {} not found in the provided sequence_summary file".format(col))
-        for col in optional_colnames:
-            if col in df:
-                col_found.append(col)
+        # Filter out reads with duplicated read_id
+        if self.filter_duplicated:
+            l = int(mask.sum())
+            idx = np.flatnonzero(mask)
+            mask[idx[self._duplicated_mask(df["read_id"].iloc[idx])]] = False
+            discarded_dict["Duplicated reads discarded"] = l-int(mask.sum())
+
+        # Filter out calibration strand reads if the "calibration_strand_genome_template" field is available
+        if self.filter_calibration and "calibration" in df:
+            l = int(mask.sum())
+            mask &= df["calibration"].isin(["filtered_out", "no_match", "*"]).values
+            discarded_dict["Calibration reads discarded"] = l-int(mask.sum())
+
+        return (mask, discarded_dict)
+
+    def _filter_reads_df (self, df):
+        """
+        Apply all the read level filters to df.
+        Return the filtered df and an OrderedDict with the number of reads discarded by each filter
+        """
+        mask, discarded_dict = self._filter_mask(df)
+        return (df if mask.all() else df[mask], discarded_dict)
+
+    def _duplicated_mask (self, read_ids):
+        """
+        Boolean array flagging the read_ids already seen. The first occurence is kept.
+        All the reads are loaded at once and read_ids are already encoded as integer codes of the unique read_ids of all
+        the summary files, needed to join the barcode and alignment records, so duplicates within and across files are
+        found by comparing codes without an extra hash set. The streaming parser uses a Read_id_set instead
+        """
+        return read_ids.duplicated(keep='first').values
+
+    def _get_runid_offsets (self, run_stats_df):
+        """
+        Define the run_ids order and the time offset to apply to each one
+        * run_stats_df
+            Dataframe indexed by run_id with the number of reads ("count") and the "min" and "max" start_time per run
+        """
+        # Follow the order of runid_list if passed by user
+        if self.runid_list:
+            runid_list = [runid for runid in self.runid_list if runid in run_stats_df.index]
 
-        return df[col_found]
+        # Else sort the runids by output per time assuming that the throughput decreases over time
+        else:
+            self.logger.info ("\tSorting run IDs by decreasing throughput")
+            d = {}
+            for run_id, line in run_stats_df.iterrows():
+                d[run_id] = line["count"]/(line["max"]-line["min"])
+            runid_list = [i for i, j in sorted (d.items(), key=lambda t: t[1], reverse=True)]
+            self.logger.info ("\t\tRun-id order {}".format(runid_list))
+
+        increment_time = 0
+        runid_offset_dict = OrderedDict()
+        for runid in runid_list:
+            runid_offset_dict[runid] = increment_time
+            increment_time += run_stats_df.loc[runid, "max"]+1
+
+        return runid_offset_dict
+
+    def _get_low_frequency_barcodes (self, barcode_counts):
+        """List the barcodes found in less than min_barcode_percent of the classified reads"""
+        barcode_counts = barcode_counts[barcode_counts.index!="unclassified"]
+        cutoff = int(barcode_counts.sum()*self.min_barcode_percent/100)
+        return barcode_counts[barcode_counts<cutoff].index
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~HELPER CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class Alignment_buffer ():
+    """
+    Growable typed column buffers accumulating the statistics of primary alignments, at a few dozen bytes per alignment
+    instead of a dict per read. References are stored as int32 codes indexing the references of the bam file.
+    The CIGAR strings and the error tags (NM, MD, cs or de) are buffered and the CIGAR and error statistics are computed by
+    batches of batch_size alignments with cigar_op_lengths and alignment_error_stats
+    """
+    # Typecodes of the array buffers of each alignment field
+    typecode_dict = OrderedDict ([
+        ("ref_id", "i"),
+        ("ref_start", "q"),
+        ("ref_end", "q"),
+        ("align_len", "I"),
+        ("mapq", "B"),
+        ("insertion", "I"),
+        ("deletion", "I"),
+        ("soft_clip", "I"),
+        ("mismatch", "f"),
+        ("identity_freq", "f")])
+
+    def __init__ (self, references, cigar_stats=True, tag_stats=True, batch_size=16384):
+        """
+        * references
+            Reference names of the bam file
+        * cigar_stats
+            If True, extract the insertion, deletion and soft_clip fields from the CIGAR string
+        * tag_stats
+            If True, extract the mismatch and identity_freq fields from the NM, MD, cs or de tags
+        * batch_size
+            Number of alignments of the batches processed by the statistics kernels
+        """
+        self.references = list(references)
+        self.cigar_stats = cigar_stats
+        self.tag_stats = cigar_stats and tag_stats
+        fields = pycoQC_parse.bam_coord_fields
+        if self.cigar_stats:
+            fields = fields+pycoQC_parse.bam_cigar_fields
+        if self.tag_stats:
+            fields = fields+pycoQC_parse.bam_tag_fields
+        self.batch_size = batch_size
+        self.read_ids = []
+        self.buffers = OrderedDict((field, array(self.typecode_dict[field])) for field in fields)
+        self._init_batch()
+
+        # Bound append methods of the coordinate buffers, filled for each alignment
+        self._coord_appends = tuple(self.buffers[field].append for field in pycoQC_parse.bam_coord_fields)
+
+    def __len__ (self):
+        return len(self.read_ids)
+
+    def append (self, read):
+        """Add the statistics of an aligned read"""
+        self.read_ids.append(read.query_name)
+        ref_id_append, ref_start_append, ref_end_append, align_len_append, mapq_append = self._coord_appends
+        ref_id_append(read.reference_id)
+        ref_start = read.reference_start
+        ref_start_append(ref_start)
+        # Alignments without CIGAR string end at their start
+        ref_end_append(read.reference_end or ref_start)
+        align_len_append(read.query_alignment_length)
+        mapq_append(read.mapping_quality)
+        if not self.cigar_stats:
+            return
+
+        # Buffer the CIGAR string and the first error tag available
+        self._cigar_strings.append(read.cigarstring or "")
+        if self.tag_stats:
+            if read.has_tag("NM"):
+                self._tag_kind.append(ERROR_TAG_NM)
+                self._nm.append(read.get_tag("NM"))
+            elif read.has_tag("MD"):
+                self._tag_kind.append(ERROR_TAG_MD)
+                self._tag_strings.append(read.get_tag("MD"))
+            elif read.has_tag("cs"):
+                self._tag_kind.append(ERROR_TAG_CS)
+                self._tag_strings.append(read.get_tag("cs"))
+            elif read.has_tag("de"):
+                self._tag_kind.append(ERROR_TAG_DE)
+                self._de.append(read.get_tag("de"))
+            else:
+                self._tag_kind.append(ERROR_TAG_NONE)
+        if len(self._cigar_strings) >= self.batch_size:
+            self.flush()
+
+    def flush (self):
+        """Compute the CIGAR and error statistics of the buffered alignments"""
+        n = len(self._cigar_strings)
+        if not n:
+            return
+        b = self.buffers
+        insertion, deletion, soft_clip = cigar_op_lengths(self._cigar_strings, "IDS").T
+        for field, values in (("insertion", insertion), ("deletion", deletion), ("soft_clip", soft_clip)):
+            b[field].frombytes(values.astype(np.uint32).tobytes())
+
+        if self.tag_stats:
+            # Values of the NM, MD/cs and de tags are only buffered for the alignments using them
+            tag_kind = np.frombuffer(self._tag_kind, dtype=np.uint8).copy()
+            nm = np.zeros(n, dtype=np.int64)
+            nm[tag_kind == ERROR_TAG_NM] = np.frombuffer(self._nm, dtype=np.int64) if len(self._nm) else 0
+            de = np.zeros(n, dtype=np.float64)
+            de[tag_kind == ERROR_TAG_DE] = np.frombuffer(self._de, dtype=np.float32) if len(self._de) else 0
+            tag_strings = [""]*n
+            for i, s in zip(np.flatnonzero((tag_kind == ERROR_TAG_MD) | (tag_kind == ERROR_TAG_CS)), self._tag_strings):
+                tag_strings[i] = s
+            align_len = np.frombuffer(b["align_len"], dtype=np.uint32)[-n:].copy()
+            mismatch, identity = alignment_error_stats(align_len, insertion, deletion, tag_kind, nm, tag_strings, de)
+            b["mismatch"].frombytes(mismatch.astype(np.float32).tobytes())
+            b["identity_freq"].frombytes(identity.astype(np.float32).tobytes())
+        self._init_batch()
+
+    def _init_batch (self):
+        """Reset the buffers of the alignments waiting for the statistics kernels"""
+        self._cigar_strings = []
+        self._tag_kind = array("B")
+        self._nm = array("q")
+        self._tag_strings = []
+        self._de = array("f")
+
+    def get_columns (self, references=None, keep=None):
+        """
+        Return the buffers as an OrderedDict of numpy arrays sharing their memory, starting with read_id.
+        ref_id is returned as a categorical of references if given, otherwise as reference codes.
+        If keep is given, only the rows selected by this boolean mask are returned
+        """
+        self.flush()
+        col_dict = OrderedDict()
+        col_dict["read_id"] = np.array(self.read_ids, dtype=object)
+        for field, buffer in self.buffers.items():
+            col_dict[field] = np.frombuffer(buffer, dtype=buffer.typecode) if len(buffer) else np.array([], dtype=buffer.typecode)
+        if keep is not None:
+            col_dict = OrderedDict((col, a[keep]) for col, a in col_dict.items())
+        if references is not None:
+            ref_index = {ref:i for i, ref in enumerate(references)}
+            remap = np.array([ref_index[ref] for ref in self.references]+[-1], dtype=np.int32)
+            col_dict["ref_id"] = pd.Categorical.from_codes(remap[col_dict["ref_id"]], categories=references)
+        return col_dict
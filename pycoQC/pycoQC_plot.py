@@ -17,6 +17,7 @@ from plotly.subplots import make_subplots
 # Local lib import
 from pycoQC.common import *
 from pycoQC.pycoQC_parse import pycoQC_parse
+from pycoQC.pycoQC_stream import pycoQC_stream, Column_accumulator, QC_state
 from pycoQC import __name__ as package_name
 from pycoQC import __version__ as package_version
 
@@ -31,6 +32,31 @@ warnings.filterwarnings("ignore", category=FutureWarning)
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~MAIN CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 class pycoQC_plot ():
 
+    # Optional read fields used by each reporting method. run_id, start_time, read_len and mean_qscore are always needed
+    method_fields_dict = {
+        "summary_stats_dict": ["channel", "barcode", "ref_id", "align_len", "insertion", "deletion", "mismatch", "identity_freq"],
+        "run_summary": ["channel", "barcode"],
+        "basecall_summary": [],
+        "alignment_summary": ["ref_id", "align_len", "insertion", "deletion", "mismatch", "identity_freq"],
+        "read_len_1D": [],
+        "read_qual_1D": [],
+        "align_len_1D": ["ref_id", "align_len"],
+        "identity_freq_1D": ["ref_id", "identity_freq"],
+        "read_len_read_qual_2D": [],
+        "read_len_align_len_2D": ["ref_id", "align_len"],
+        "align_len_identity_freq_2D": ["ref_id", "align_len", "identity_freq"],
+        "read_qual_identity_freq_2D": ["ref_id", "identity_freq"],
+        "output_over_time": [],
+        "read_len_over_time": [],
+        "read_qual_over_time": [],
+        "align_len_over_time": ["ref_id", "align_len"],
+        "identity_freq_over_time": ["ref_id", "identity_freq"],
+        "barcode_counts": ["barcode"],
+        "channels_activity": ["channel"],
+        "alignment_reads_status": ["ref_id"],
+        "alignment_rate": ["ref_id", "align_len", "soft_clip", "insertion", "deletion", "mismatch", "identity_freq"],
+        "alignment_coverage": ["ref_id", "ref_start", "ref_end", "align_len"]}
+
     def __init__ (self,
         parser:pycoQC_parse,
         min_pass_qual:int=7,
@@ -40,7 +66,8 @@ class pycoQC_plot ():
         quiet:bool=False):
         """
         * parser
-            A pycoQC_parse object
+            A pycoQC_parse object. With a pycoQC_stream object, the read accumulators and samples collected while
+            streaming are used instead of the reads dataframe. A partial or merged QC_state object can also be given
         * min_pass_qual
             Minimum quality to consider a read as 'pass'
         * min_pass_len
@@ -58,10 +85,17 @@ class pycoQC_plot ():
         self.sample = sample
 
         # Check that parser is a valid instance of pycoQC_parse
+        if isinstance(parser, QC_state):
+            parser = pycoQC_stream.from_state(parser, verbose=verbose, quiet=quiet)
         if not isinstance(parser, pycoQC_parse):
             raise pycoQCError ("{} is not a valid pycoQC_parse object".format(parser))
         self.parser = parser
 
+        # Streamed data were already summarised and sampled by the parser
+        if isinstance(parser, pycoQC_stream):
+            self._init_from_stream(parser, min_pass_qual, min_pass_len)
+            return
+
         # Extract values from parser object
         self.all_df = parser.reads_df
         if self.has_alignment:
@@ -86,6 +120,25 @@ class pycoQC_plot ():
             self.pass_scaling_factor = 1
         self.logger.info ("\tFound {:,} pass reads (qual >= {} and length >= {})".format(len(self.pass_df), min_pass_qual, min_pass_len))
 
+    def _init_from_stream (self, parser, min_pass_qual, min_pass_len):
+        """Use the accumulators of a pycoQC_stream parser in place of the reads dataframes"""
+        if parser.min_pass_qual != min_pass_qual or parser.min_pass_len != min_pass_len:
+            self.logger.warning ("WARNING: Pass reads were defined by the parser with qual >= {} and length >= {}".format(parser.min_pass_qual, parser.min_pass_len))
+        self.min_pass_qual = min_pass_qual = parser.min_pass_qual
+
+        self.all_df = parser.all_reads
+        if self.has_alignment:
+            self.ref_len_dict = parser.ref_len_dict
+            self.alignments_df = parser.alignments_df
+        self.logger.info ("\tFound {:,} total reads".format(len(self.all_df)))
+        self.all_sample_df = self.all_df.sample_df
+        self.all_scaling_factor = len(self.all_df)/len(self.all_sample_df)
+
+        self.pass_df = parser.pass_reads
+        self.pass_sample_df = self.pass_df.sample_df if len(self.pass_df) else self.all_sample_df.iloc[0:0]
+        self.pass_scaling_factor = len(self.pass_df)/len(self.pass_sample_df) if len(self.pass_df) else 1
+        self.logger.info ("\tFound {:,} pass reads (qual >= {} and length >= {})".format(len(self.pass_df), min_pass_qual, parser.min_pass_len))
+
     def __str__(self):
         m = ""
         m+= "\tBarcode: {}\n".format(self.has_barcodes)
@@ -93,10 +146,10 @@ class pycoQC_plot ():
         m+= "\tPromethion: {}\n".format(self.is_promethion)
         m+= "\tAll reads: {:,}\n".format(len(self.all_df))
         m+= "\tAll bases: {:,}\n".format(int(self.all_df["read_len"].sum()))
-        m+= "\tAll median read length: {:,}\n".format(np.median(self.all_df["read_len"]))
+        m+= "\tAll median read length: {:,}\n".format(self.all_df["read_len"].median())
         m+= "\tPass reads: {:,}\n".format(len(self.pass_df))
         m+= "\tPass bases: {:,}\n".format(int(self.pass_df["read_len"].sum()))
-        m+= "\tPass median read length: {:,}\n".format(np.median(self.pass_df["read_len"]))
+        m+= "\tPass median read length: {:,}\n".format(self.pass_df["read_len"].median())
         return m
 
     def __repr__(self):
@@ -117,7 +170,7 @@ class pycoQC_plot ():
 
     @property
     def is_promethion (self):
-        return self.all_df["channel"].max() > 512
+        return "channel" in self.all_df and self.all_df["channel"].max() > 512
 
     @property
     def total_ref_len (self):
@@ -125,7 +178,7 @@ class pycoQC_plot ():
             return np.sum(list(self.ref_len_dict.values()))
 
     def _run_duration(self, df):
-        return float(np.ptp(df["start_time"])/3600)
+        return float((df["start_time"].max()-df["start_time"].min())/3600)
 
     def _active_channels(self, df):
         return int(df["channel"].nunique())
@@ -146,16 +199,16 @@ class pycoQC_plot ():
         return self._compute_N50(df["read_len"])
 
     def _basecall_median_read_len(self, df):
-        return np.median(df["read_len"])
+        return df["read_len"].median()
 
     def _basecall_median_read_qscore(self, df):
-        return np.median(df["mean_qscore"])
+        return df["mean_qscore"].median()
 
     def _alignment_mean_coverage(self, df):
         return df["align_len"].dropna().sum()/self.total_ref_len if self.has_alignment else np.nan
 
     def _aligned_reads(self, df):
-        return len(df["align_len"].dropna()) if self.has_alignment else np.nan
+        return int(df["align_len"].count()) if self.has_alignment else np.nan
 
     def _aligned_bases(self, df):
         return int(df["align_len"].dropna().sum()) if self.has_alignment else np.nan
@@ -164,10 +217,10 @@ class pycoQC_plot ():
         return self._compute_N50(df["align_len"]) if self.has_alignment else np.nan
 
     def _alignment_median_read_len(self, df):
-        return np.median(df["align_len"].dropna()) if self.has_alignment else np.nan
+        return df["align_len"].dropna().median() if self.has_alignment else np.nan
 
     def _alignment_median_identity(self, df):
-        return np.median(df["identity_freq"].dropna()) if self.has_identity_freq else np.nan
+        return df["identity_freq"].dropna().median() if self.has_identity_freq else np.nan
 
     def _alignment_insertion_rate(self, df):
         return df["insertion"].dropna().sum()/self._aligned_bases(df) if self.has_identity_freq else np.nan
@@ -1337,7 +1390,8 @@ class pycoQC_plot ():
         # get data
         df = self.pass_df if df_level == "pass" else self.all_df
         counts = df["barcode"].value_counts()
-        counts = counts.sort_index()
+        counts = counts[counts>0].sort_index()
+        counts.index = counts.index.astype(object)
 
         # Extract label and values
         data_dict = dict (
@@ -1528,7 +1582,10 @@ class pycoQC_plot ():
 
         # Extract Data
         bc_bases = self.all_df["read_len"].sum()
-        s = self.all_df[[ "read_len", "align_len", "insertion", "deletion", "soft_clip", "mismatch"]].dropna().sum()
+        if isinstance(self.all_df, pd.DataFrame):
+            s = self.all_df[[ "read_len", "align_len", "insertion", "deletion", "soft_clip", "mismatch"]].dropna().sum()
+        else:
+            s = self.all_df.alignment_sums
         total_error = s["insertion"]+s["deletion"]+s["mismatch"]
         matching = s["align_len"]-total_error
         unmapped = bc_bases-s["read_len"]
@@ -1611,19 +1668,25 @@ class pycoQC_plot ():
             raise pycoQCError ("No Alignment information available")
         self.logger.info ("\t\tComputing plot")
 
-        ref_offset_dict = self._ref_offset(self.ref_len_dict, "left", ret_type="dict")
-        df = self.all_df[["ref_id", "ref_start", "ref_end", "align_len"]].dropna()
         steps = self.total_ref_len//nbins
-        mean_cov = round(df["align_len"].sum()/self.total_ref_len, 2)
+        mean_cov = round(self._alignment_mean_coverage(self.all_df), 2)
 
         # Compute coverage by interval
-        l = []
-        for line in df.itertuples():
-            l.append(int(ref_offset_dict[line.ref_id]+line.ref_start))
-        l = np.array(l)
+        if isinstance(self.all_df, pd.DataFrame):
+            ref_offset_dict = self._ref_offset(self.ref_len_dict, "left", ret_type="dict")
+            df = self.all_df[["ref_id", "ref_start", "ref_end", "align_len"]].dropna()
+            l = []
+            for line in df.itertuples():
+                l.append(int(ref_offset_dict[line.ref_id]+line.ref_start))
+            l = np.array(l)
+            weights = df["align_len"]
+        # Use the fine grained coverage bins of the accumulator
+        else:
+            l = np.arange(len(self.all_df.coverage))*self.all_df.coverage_bin_size
+            weights = self.all_df.coverage
         bins = np.arange(0, self.total_ref_len, steps)
         l = np.digitize(l,bins)
-        y = np.bincount(l, weights=df["align_len"])/steps
+        y = np.bincount(l, weights=weights)/steps
 
         # Time series smoothing
         if smooth_sigma:
@@ -1704,12 +1767,15 @@ class pycoQC_plot ():
     #~~~~~~~PRIVATE METHODS~~~~~~~#
     @staticmethod
     def _compute_percentiles (data):
+        if isinstance(data, Column_accumulator):
+            return list(data.quantile(q=np.linspace(0,1,101)))
         return list(np.quantile(data.dropna(), q=np.linspace(0,1,101)))
 
     @staticmethod
     def _compute_N50 (data):
-        data = data.dropna().values
-        data.sort()
+        if isinstance(data, Column_accumulator):
+            return int(data.N50())
+        data = np.sort(data.dropna().values)
         half_sum = data.sum()/2
         cum_sum = 0
         for v in data:
@@ -1721,13 +1787,19 @@ class pycoQC_plot ():
     def _compute_hist (data, x_scale="linear", smooth_sigma=2, nbins=200):
 
         # Count each categories in log or linear space
-        min = np.nanmin(data)
-        max = np.nanmax(data)
+        if isinstance(data, Column_accumulator):
+            min = data.min()
+            max = data.max()
+            histogram = data.histogram
+        else:
+            min = np.nanmin(data)
+            max = np.nanmax(data)
+            histogram = lambda bins: np.histogram (a=data, bins=bins)
 
         if x_scale == "log":
-            count_y, bins = np.histogram (a=data, bins=np.logspace (np.log10(min), np.log10(max)+0.1, nbins))
+            count_y, bins = histogram (bins=np.logspace (np.log10(min), np.log10(max)+0.1, nbins))
         elif x_scale == "linear":
-            count_y, bins = np.histogram (a=data, bins= np.linspace (min, max, nbins))
+            count_y, bins = histogram (bins= np.linspace (min, max, nbins))
 
         # Remove last bin from labels
         count_x = bins[1:]
@@ -7,6 +7,7 @@ import json
 from pkg_resources import resource_filename
 import datetime
 import os
+import logging
 
 # Third party imports
 import plotly.offline as py
@@ -16,6 +17,7 @@ import jinja2
 from pycoQC.common import *
 from pycoQC.pycoQC_parse import pycoQC_parse
 from pycoQC.pycoQC_plot import pycoQC_plot
+from pycoQC.pycoQC_stream import pycoQC_stream, QC_state
 from pycoQC import __version__ as package_version
 from pycoQC import __name__ as package_name
 
@@ -26,13 +28,16 @@ class pycoQC_report ():
     def __init__ (self,
         parser:pycoQC_parse,
         plotter:pycoQC_plot,
+        memory_plan:dict=None,
         verbose:bool=False,
         quiet:bool=False):
         """
         * parser
-            A pycoQC_parse object
+            A pycoQC_parse object, or a QC_state object
         * plotter
             A pycoQC_plot object
+        * memory_plan
+            Memory strategy selected by pycoQC with max_memory, saved in the json report
         * verbose
             Increase verbosity
         * quiet
@@ -42,6 +47,8 @@ class pycoQC_report ():
         self.logger = get_logger (name=__name__, verbose=verbose, quiet=quiet)
 
         # Check that parser is a valid instance of pycoQC_parse
+        if isinstance(parser, QC_state):
+            parser = pycoQC_stream.from_state(parser, verbose=verbose, quiet=quiet)
         if not isinstance(parser, pycoQC_parse):
             raise pycoQCError ("{} is not a valid pycoQC_parse object".format(parser))
         self.parser = parser
@@ -50,11 +57,43 @@ class pycoQC_report ():
         if not isinstance(plotter, pycoQC_plot):
             raise pycoQCError ("{} is not a valid pycoQC_plot object".format(plotter))
         self.plotter = plotter
+        self.memory_plan = memory_plan
 
     def __repr__(self):
         return "[{}]\n".format(self.__class__.__name__)
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+    @classmethod
+    def get_read_fields (cls,
+        html_report:bool=True,
+        json_report:bool=True,
+        config_file:str="",
+        skip_coverage_plot:bool=False):
+        """
+        Plan the optional read fields needed to generate the reports, from the methods listed in the html config file and
+        the json report. The other fields, and the input files providing them, do not have to be parsed
+        * html_report
+            Whether an html report will be generated
+        * json_report
+            Whether a json report will be generated
+        * config_file
+            Path to the JSON configuration file of the html report
+        * skip_coverage_plot
+            Whether the coverage plot is skipped in the html report
+        """
+        method_list = []
+        if html_report:
+            method_list.extend([m for m in cls._get_config(config_file) if not (skip_coverage_plot and m == "alignment_coverage")])
+        if json_report:
+            method_list.append("summary_stats_dict")
+
+        read_fields = []
+        for method_name in method_list:
+            for field in pycoQC_plot.method_fields_dict.get(method_name, []):
+                if not field in read_fields:
+                    read_fields.append(field)
+        return read_fields
+
     def html_report( self,
         outfile:str,
         config_file:str="",
@@ -123,7 +162,7 @@ class pycoQC_report ():
             if files_list:
                 src_files += "<h4>Source {} files</h4><ul>".format(name)
                 for f in files_list:
-                    f = os.path.abspath(f)
+                    f = f if is_stream(f) else os.path.abspath(f)
                     src_files += "<li>{}</li>".format(f)
                 src_files += "</ul>"
 
@@ -149,6 +188,8 @@ class pycoQC_report ():
         self.logger.info("Generating JSON report")
         self.logger.info("\tRunning summary_stats_dict method")
         res_dict = self.plotter.summary_stats_dict ()
+        if self.memory_plan:
+            res_dict["pycoqc"]["memory_strategy"] = self.memory_plan
 
         self.logger.info("\tWriting to JSON file")
         mkbasedir(outfile, exist_ok=True)
@@ -157,19 +198,22 @@ class pycoQC_report ():
 
     #~~~~~~~~~~~~~~PRIVATE FUNCTION~~~~~~~~~~~~~~#
 
-    def _get_config(self, config_file=None):
+    @staticmethod
+    def _get_config(config_file=None):
         """"""
+        logger = logging.getLogger(__name__)
+
         # First, try to read provided configuration file if given
         if config_file:
-            self.logger.debug ("\tTry to read provided config file")
+            logger.debug ("\tTry to read provided config file")
             try:
                 with open(config_file, 'r') as cf:
                     return json.load(cf)
             except (FileNotFoundError, IOError, json.JSONDecodeError):
-                self.logger.debug ("\t\tConfiguration file not found, non-readable or invalid")
+                logger.debug ("\t\tConfiguration file not found, non-readable or invalid")
 
         # Last use the default harcoded config_dict
-        self.logger.debug ("\tRead default configuration file")
+        logger.debug ("\tRead default configuration file")
         config_file = resource_filename("pycoQC", "templates/pycoQC_config.json")
         with open(config_file, 'r') as cf:
             return json.load(cf)
@@ -0,0 +1,947 @@
+# -*- coding: utf-8 -*-
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~IMPORTS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+# Standard library imports
+from collections import *
+import warnings
+import copy
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+# Local lib import
+from pycoQC.common import *
+from pycoQC.pycoQC_parse import pycoQC_parse
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~GLOBAL SETTINGS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+# Silence futurewarnings
+warnings.filterwarnings("ignore", category=FutureWarning)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~MAIN CLASS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class pycoQC_stream (pycoQC_parse):
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~INIT METHOD~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+    def __init__ (self,
+        summary_file:str,
+        barcode_file:str="",
+        bam_file:str="",
+        runid_list:list=[],
+        filter_calibration:bool=False,
+        filter_duplicated:bool=False,
+        min_barcode_percent:float=0.1,
+        min_time:float=0,
+        max_time:float=0,
+        pass_only:bool=False,
+        min_pass_qual:float=7,
+        min_pass_len:int=0,
+        read_fields:list=None,
+        sample:int=100000,
+        chunksize:int=1000000,
+        threads:int=1,
+        follow:bool=False,
+        progress_bar:bool=False,
+        progress_callback=None,
+        verbose:bool=False,
+        quiet:bool=False):
+        """
+        Parse Albacore sequencing_summary.txt files by chunks and clean-up the data with bounded memory.
+        Instead of a reads_df dataframe, reads are summarised in 2 mergeable accumulators (all_reads and pass_reads)
+        that can be passed to pycoQC_plot
+        * summary_file
+            Path to the sequencing_summary generated by Albacore 1.0.0 + (read_fast5_basecaller.py) / Guppy 2.1.3+ (guppy_basecaller).
+            One can also pass multiple space separated file paths or a UNIX style regex matching multiple files
+        * barcode_file
+            Path to the barcode_file generated by Guppy 2.1.3+ (guppy_barcoder) or Deepbinner 0.2.0+. This is not a required file.
+            One can also pass multiple space separated file paths or a UNIX style regex matching multiple files
+        * bam_file
+            Path to a Bam file corresponding to reads in the summary_file. Preferably aligned with Minimap2
+            One can also pass multiple space separated file paths or a UNIX style regex matching multiple files
+            Sorting and indexing are optional: unsorted SAM/BAM files are parsed sequentially and "-" reads alignments streamed from stdin
+        * runid_list
+            Select only specific runids to be analysed. Can also be used to force pycoQC to order the runids for
+            temporal plots, if the sequencing_summary file contain several sucessive runs. By default pycoQC analyses
+            all the runids in the file and uses the runid order as defined in the file.
+        * filter_calibration
+            If True read flagged as calibration strand by the software are removed
+        * filter_duplicated
+            If True duplicated read_ids are removed but the first occurence is kept (Guppy sometimes outputs the same read multiple times)
+        * min_barcode_percent
+            Minimal percent of total reads to retain barcode label. If below the barcode value is set as `unclassified`.
+        * min_time
+            Only select reads starting after min_time hours from the beginning of their run
+        * max_time
+            If not 0, only select reads starting before max_time hours from the beginning of their run
+        * pass_only
+            If True only the 'pass' reads are selected, using min_pass_qual and min_pass_len
+        * min_pass_qual
+            Minimum quality to consider a read as 'pass'
+        * min_pass_len
+            Minimum read length to consider a read as 'pass'
+        * read_fields
+            List of optional read fields needed downstream (see pycoQC_plot.method_fields_dict). If given, the other
+            optional summary columns, the barcode files and the alignment statistics not needed are not parsed.
+            By default all the fields are parsed
+        * sample
+            Number of reads randomly selected for the plotting functions (deterministic sampling). Required in streaming mode
+        * chunksize
+            Number of lines of summary file parsed at once
+        * threads
+            Number of threads used to decompress the summary files and number of processes to parse barcode files
+        * follow
+            If True, the summary files are expected to grow. Reads appended after the initial parsing are added with refresh().
+            Summary files must be uncompressed. Barcode and bam files are only parsed once
+        * progress_bar
+            If True, display a progress bar of the bytes read for each parsing stage
+        * progress_callback
+            Function called about every second during each parsing stage with a dict describing its progress
+            (see pycoQC_parse)
+        """
+        # Set logging level
+        self.logger = get_logger(name=__name__, verbose=verbose, quiet=quiet)
+
+        # Save self variables
+        self.runid_list = runid_list
+        self.filter_calibration = filter_calibration
+        self.filter_duplicated = filter_duplicated
+        self.min_barcode_percent = min_barcode_percent
+        self.min_time = min_time
+        self.max_time = max_time
+        self.pass_only = pass_only
+        self.min_pass_qual = min_pass_qual
+        self.min_pass_len = min_pass_len
+        self.read_fields = read_fields
+        self.sample = sample
+        self.chunksize = chunksize
+        self.cleanup = True
+        self.threads = threads
+        self.follow = follow
+        self.cache_dir = ""
+        self.low_memory = False
+        self.progress_bar = progress_bar
+        self.progress_callback = progress_callback
+        self.read_id_array = None
+        self._parse_filters = self._get_parse_filters()
+
+        if not sample:
+            raise pycoQCError ("A sample size is required to stream summary files")
+        if not chunksize:
+            raise pycoQCError ("A chunk size is required to stream summary files")
+
+        # Init object counter
+        self.counter = OrderedDict()
+
+        # Check input files
+        self.logger.warning ("Check input data files")
+        self._check_input_files(summary_file, barcode_file, bam_file)
+        self._prune_fields()
+        self._optional_colnames = self._get_shared_optional_colnames()
+        if follow:
+            for fn in self.summary_files_list:
+                with open(fn, "rb") as fp:
+                    if fp.read(2) == b"\x1f\x8b":
+                        raise pycoQCError ("Summary file {} is compressed and cannot be followed".format(fn))
+
+        self.logger.warning ("Parse barcode and alignment files")
+        barcode_reads_df = self._parse_barcode()
+        bam_reads_df, self.alignments_df, self.ref_len_dict = self._parse_bam()
+        self._read_tables = self._index_read_tables(barcode_reads_df, bam_reads_df)
+
+        self.logger.warning ("Stream summary files")
+        self._all_acc = Reads_accumulator (sample=sample, ref_len_dict=self.ref_len_dict)
+        self._pass_acc = Reads_accumulator (sample=sample, ref_len_dict=self.ref_len_dict)
+        self._seen_read_ids = Read_id_set()
+        self._discarded_dict = OrderedDict()
+        self._file_offsets = OrderedDict()
+        self.counter["Initial reads"] = 0
+        self._parse_new_reads()
+
+        self.logger.warning("Cleaning data")
+        self._finalise()
+
+    def get_state (self, sample:int=2000):
+        """
+        Return the partial QC state of the reads parsed so far, as a QC_state object that can be merged with the states
+        of other subsets of reads, saved and rendered by pycoQC_plot and pycoQC_report
+        * sample
+            Maximal number of sampled reads kept in the state for the time and channel plots. The sample is the same
+            as the one that would be drawn from the reads of all the merged states with this size
+        """
+        final_labels = list(self.read_filters_dict)+["Reads with low frequency barcode unset", "Valid reads"]
+        all_reads, pass_reads = copy.deepcopy(self._all_acc), copy.deepcopy(self._pass_acc)
+        for acc in (all_reads, pass_reads):
+            acc.truncate_sample(sample)
+        return QC_state (
+            all_reads = all_reads,
+            pass_reads = pass_reads,
+            counter = OrderedDict((k, v) for k, v in self.counter.items() if not k in final_labels),
+            discarded_dict = OrderedDict(self._discarded_dict),
+            alignments_df = self.alignments_df.copy(),
+            ref_len_dict = OrderedDict(self.ref_len_dict),
+            files_dict = OrderedDict((attr, list(getattr(self, attr))) for attr in QC_state.files_attributes),
+            options = OrderedDict((attr, getattr(self, attr)) for attr in QC_state.options_attributes))
+
+    @classmethod
+    def from_state (cls, state, verbose:bool=False, quiet:bool=False):
+        """
+        Build a parser from a partial or merged QC_state, without parsing any file. The run_ids are ordered and the low
+        frequency barcodes are unset over all the reads of the state. The parser can be passed to pycoQC_plot and pycoQC_report
+        * state
+            A QC_state object
+        """
+        if not isinstance(state, QC_state):
+            raise pycoQCError ("{} is not a valid QC_state object".format(state))
+        self = cls.__new__(cls)
+        self.logger = get_logger(name=__name__, verbose=verbose, quiet=quiet)
+
+        for attr, val in list(state.options.items())+list(state.files_dict.items()):
+            setattr(self, attr, copy.copy(val))
+        self.sample = state.all_reads.sample
+        self.chunksize = 0
+        self.cleanup = True
+        self.threads = 1
+        self.follow = False
+        self.cache_dir = ""
+        self.read_id_array = None
+        self._parse_filters = {}
+        self.alignments_df = state.alignments_df.copy()
+        self.ref_len_dict = OrderedDict(state.ref_len_dict)
+        self.counter = OrderedDict(state.counter)
+        self._discarded_dict = OrderedDict(state.discarded_dict)
+        self._all_acc = state.all_reads
+        self._pass_acc = state.pass_reads
+
+        self.logger.warning("Cleaning data")
+        self._finalise()
+        return self
+
+    def save (self, dir_path):
+        """Streamed reads are not kept in memory, so the parsed data cannot be saved. See get_state instead"""
+        raise pycoQCError ("Streamed summary files cannot be saved. Parse them without chunksize to save the parsed data")
+
+    def __repr__(self):
+        return "[{}]\n".format(self.__class__.__name__)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def refresh (self):
+        """
+        In follow mode, parse the complete lines appended to the summary files since the last call and update all_reads
+        and pass_reads. The cost only depends on the number of new reads. Return the number of new lines parsed
+        """
+        if not self.follow:
+            raise pycoQCError ("Summary files can only be refreshed in follow mode")
+        n = self.counter["Initial reads"]
+        self._parse_new_reads()
+        self._finalise()
+        return self.counter["Initial reads"]-n
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def _get_shared_optional_colnames (self):
+        """List the optional columns found in all summary files"""
+        optional_colnames = list(self.summary_optional_colnames)
+        for fn in self.summary_files_list:
+            col_dict = select_file_columns (
+                header = get_file_header(fn),
+                rename_colnames = self.summary_rename_colnames,
+                required_colnames = self.summary_required_colnames,
+                optional_colnames = self.summary_optional_colnames,
+                fn = fn)
+            optional_colnames = [col for col in optional_colnames if col in col_dict.values()]
+        return optional_colnames
+
+    def _parse_new_reads (self):
+        """Stream the summary files. In follow mode, start after the last complete line previously parsed"""
+        if self.follow:
+            range_list = []
+            for fn in self.summary_files_list:
+                start = self._file_offsets.get(fn, 0)
+                end = complete_lines_end(fn)
+                range_list.append((start, end))
+                self._file_offsets[fn] = end
+        else:
+            range_list = [None]*len(self.summary_files_list)
+
+        total_bytes = sum(end-start for start, end in range_list) if self.follow else None
+        with self._progress("Stream summary files", self.summary_files_list, total_bytes=total_bytes) as progress:
+            for fn, file_range in zip(self.summary_files_list, range_list):
+                self.logger.debug ("\tStreaming file {}".format(fn))
+                for df in iter_file_chunks (
+                    fn,
+                    chunksize = self.chunksize,
+                    rename_colnames = self.summary_rename_colnames,
+                    required_colnames = self.summary_required_colnames,
+                    optional_colnames = self._optional_colnames,
+                    dtype_dict = self.summary_dtype_dict,
+                    threads = self.threads,
+                    file_range = file_range,
+                    filters = self._parse_filters,
+                    progress = progress):
+                    self._update(df)
+
+    def _index_read_tables (self, barcode_reads_df, bam_reads_df):
+        """
+        Index the barcode and alignment tables by read_id codes, with read_id_array built from the read_ids of both tables.
+        Return a list of (table, lookup, fill_dict) used to join the chunks of reads. Only the first record of each read is used
+        """
+        table_list = []
+        df_list = [df for df in (barcode_reads_df, bam_reads_df) if not df.empty]
+        if df_list:
+            self.logger.debug ("\tEncoding read_ids")
+            _, self.read_id_array = encode_read_ids(np.concatenate([df["read_id"].values for df in df_list]))
+
+        for df, fill_dict in ((barcode_reads_df, {"barcode":"unclassified"}), (bam_reads_df, {})):
+            if not df.empty:
+                codes, _ = encode_read_ids(df["read_id"], self.read_id_array)
+                table_list.append((df, index_read_codes(codes, len(self.read_id_array)), fill_dict))
+        return table_list
+
+    def _merge_reads_df (self, df, read_tables):
+        """Join a chunk of reads with the barcode and alignment tables by read_id code lookup"""
+        if not read_tables:
+            return df
+
+        codes, _ = encode_read_ids(df["read_id"], self.read_id_array)
+        for table_df, lookup, fill_dict in read_tables:
+            columns = [col for col in table_df.columns if col != "read_id"]
+            for col, values in join_read_columns(codes, lookup, table_df, columns, fill_dict).items():
+                df[col] = values
+        return df
+
+    def _update (self, df):
+        """Merge, filter and accumulate a chunk of reads"""
+        filtered_rows = df.attrs.get("filtered_rows", OrderedDict())
+        self.counter["Initial reads"] += len(df)+sum(filtered_rows.values())
+        self.logger.debug ("\t\t{:,} reads parsed".format(self.counter["Initial reads"]))
+
+        df = self._merge_reads_df(df, self._read_tables)
+        df, discarded_dict = self._filter_reads_df(df)
+        self._discarded_dict = merge_counts(self._discarded_dict, self._get_parse_discarded(filtered_rows), discarded_dict)
+        df = df.astype({col:dtype for col, dtype in self.clean_dtype_dict.items() if col in df})
+
+        self._all_acc.update(df)
+        self._pass_acc.update(df[(df["mean_qscore"]>=self.min_pass_qual) & (df["read_len"]>=self.min_pass_len)])
+
+    def _duplicated_mask (self, read_ids):
+        """
+        Boolean array flagging the read_ids already seen in the current or previous chunks.
+        Read_ids are kept as 128-bit keys in a compact hash set, so memory is bounded by the number of unique reads
+        """
+        return self._seen_read_ids.add_new(hash_read_ids(read_ids.values))
+
+    def _finalise (self):
+        """
+        Collect filter stats, reorder the run_ids and cleanup low frequency barcodes in all_reads and pass_reads.
+        These are copies of the accumulators, so that new reads can still be added in follow mode and the partial QC
+        state remains available
+        """
+        self.all_reads = copy.deepcopy(self._all_acc)
+        self.pass_reads = copy.deepcopy(self._pass_acc)
+
+        l = self.counter["Initial reads"]
+        self.logger.info ("\t\t{:,} reads found in initial file".format(l))
+        for label, (msg, filter_name) in self.read_filters_dict.items():
+            if label in self._discarded_dict:
+                n = self._discarded_dict[label]
+                self.logger.info ("\t{}".format(msg))
+                self.logger.info ("\t\t{:,} reads discarded".format(n))
+                self.counter[label] = n
+                l-=n
+                if l <= 1 and not self.follow:
+                    raise pycoQCError("No valid read left after {} filtering".format(filter_name))
+
+        # Define the run_ids order and time offsets from all reads
+        runid_offset_dict = self._get_runid_offsets(self.all_reads.run_stats_df)
+        self.logger.info ("\tReordering runids")
+        for runid, increment_time in runid_offset_dict.items():
+            self.logger.info ("\t\tProcessing reads with Run_ID {} / time offset: {}".format(runid, increment_time))
+        for acc in (self.all_reads, self.pass_reads):
+            acc.set_time_offsets(runid_offset_dict)
+
+        #  Unset low frequency barcodes
+        if "barcode" in self.all_reads and self.min_barcode_percent:
+            self.logger.info ("\tCleaning up low frequency barcodes")
+            barcode_counts = self.all_reads["barcode"].value_counts()
+            low_barcode = self._get_low_frequency_barcodes(barcode_counts)
+            for acc in (self.all_reads, self.pass_reads):
+                acc.unset_barcodes(low_barcode)
+            n = int(barcode_counts[low_barcode].sum())
+            self.logger.info ("\t\t{:,} reads with low frequency barcode unset".format(n))
+            self.counter["Reads with low frequency barcode unset"] = n
+
+        self.logger.info ("\t\t{:,} Final valid reads".format(len(self.all_reads)))
+        self.counter["Valid reads"] = len(self.all_reads)
+        if len(self.all_reads) < 500:
+            self.logger.warning ("WARNING: Low number of reads found. This is likely to lead to errors when trying to generate plots")
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ACCUMULATORS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class Reads_accumulator ():
+    """
+    Mergeable summary of a set of reads with bounded memory. Keeps exact read counts, the distribution of values
+    of the main columns, per run_id time ranges, alignment totals, binned coverage and a deterministic random sample of reads.
+    The sample holds the reads with the smallest sampling keys derived from their read_ids (bottom-k sampling), so that the
+    sample of merged accumulators is the sample of all their reads. Implements the subset of the pandas.DataFrame interface used by pycoQC_plot
+    """
+    # Columns for which the distribution of values is kept. Float values are rounded to the given resolution
+    values_resolution_dict = {
+        "run_id":None,
+        "channel":None,
+        "read_len":None,
+        "barcode":None,
+        "align_len":None,
+        "mean_qscore":0.001,
+        "identity_freq":0.0001}
+
+    # Columns summed over reads with a complete alignment record
+    alignment_colnames = ["read_len", "align_len", "insertion", "deletion", "soft_clip", "mismatch"]
+
+    # Types of the sampled reads
+    sample_dtype_dict = {"channel":"uint16", "start_time":"float32", "read_len":"uint32", "mean_qscore":"float32"}
+
+    def __init__ (self, sample=100000, ref_len_dict={}, coverage_bins=100000):
+        """
+        * sample
+            Maximal number of reads to keep in the random sample
+        * ref_len_dict
+            Dict of reference lengths used to compute the binned coverage
+        * coverage_bins
+            Number of bins to divide the concatenated references in
+        """
+        self.sample = sample
+        self.n_reads = 0
+        self.columns_dict = OrderedDict()
+        self.run_stats_df = pd.DataFrame(columns=["count", "min", "max"], dtype="float64")
+        self.alignment_sums = None
+        self.sample_df = None
+        self._sample_keys = np.array([], dtype=np.uint64)
+
+        # Coverage of the concatenated references
+        self.ref_offset_dict = OrderedDict()
+        cumsum = 0
+        for ref, ref_len in ref_len_dict.items():
+            self.ref_offset_dict[ref] = cumsum
+            cumsum += ref_len
+        self.total_ref_len = cumsum
+        self.coverage_bin_size = max(1, int(np.ceil(cumsum/coverage_bins)))
+        self.coverage = np.zeros(cumsum//self.coverage_bin_size+1, dtype=np.float64)
+
+    def __len__ (self):
+        return self.n_reads
+
+    def __contains__ (self, col):
+        return col in self.columns_dict
+
+    def __getitem__ (self, col):
+        return self.columns_dict[col]
+
+    def __repr__(self):
+        return "[{}] {:,} reads".format(self.__class__.__name__, self.n_reads)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def update (self, df):
+        """Add a dataframe of cleaned reads to the accumulator"""
+        if df.empty:
+            return
+        self.n_reads += len(df)
+
+        # Per column stats
+        for col in df.columns:
+            if col == "read_id":
+                continue
+            if not col in self.columns_dict:
+                self.columns_dict[col] = Column_accumulator (
+                    keep_values = col in self.values_resolution_dict,
+                    resolution = self.values_resolution_dict.get(col))
+            self.columns_dict[col].update(df[col])
+
+        # Per run_id time range
+        run_stats_df = df.groupby("run_id", observed=True)["start_time"].agg(["count", "min", "max"])
+        self._merge_run_stats(run_stats_df)
+
+        # Alignment totals
+        if all(col in df for col in self.alignment_colnames):
+            s = df[self.alignment_colnames].dropna().astype("float64").sum()
+            self.alignment_sums = s if self.alignment_sums is None else self.alignment_sums+s
+
+        # Binned coverage
+        if "ref_id" in df and self.ref_offset_dict:
+            cov_df = df[["ref_id", "ref_start", "align_len"]].dropna()
+            pos = cov_df["ref_id"].map(self.ref_offset_dict).values.astype(np.int64) + cov_df["ref_start"].values.astype(np.int64)
+            self.coverage += np.bincount(pos//self.coverage_bin_size, weights=cov_df["align_len"].values, minlength=len(self.coverage))
+
+        # Random sample
+        if "read_id" in df:
+            keys = read_id_sample_keys(df["read_id"].values)
+        else:
+            keys = pd.util.hash_pandas_object(df, index=False).values
+        self._update_sample(df.drop(columns="read_id", errors="ignore"), keys)
+
+    def merge (self, other):
+        """Merge another Reads_accumulator in the current one. Both need to be defined with the same references"""
+        if not isinstance(other, Reads_accumulator):
+            raise pycoQCError ("{} is not a valid Reads_accumulator object".format(other))
+        if len(self.coverage) != len(other.coverage):
+            raise pycoQCError ("Cannot merge accumulators built with different references")
+
+        self.n_reads += other.n_reads
+        for col, col_acc in other.columns_dict.items():
+            if col in self.columns_dict:
+                self.columns_dict[col].merge(col_acc)
+            else:
+                self.columns_dict[col] = copy.deepcopy(col_acc)
+        self._merge_run_stats(other.run_stats_df)
+        if other.alignment_sums is not None:
+            self.alignment_sums = other.alignment_sums if self.alignment_sums is None else self.alignment_sums+other.alignment_sums
+        self.coverage += other.coverage
+        if other.sample_df is not None:
+            self._update_sample(other.sample_df, other._sample_keys)
+        return self
+
+    def get_state (self):
+        """Return a json serialisable dict describing the accumulator and a dict of numpy arrays holding its data"""
+        meta = OrderedDict()
+        meta["sample"] = self.sample
+        meta["n_reads"] = self.n_reads
+        meta["ref_offset_dict"] = self.ref_offset_dict
+        meta["total_ref_len"] = self.total_ref_len
+        meta["coverage_bin_size"] = self.coverage_bin_size
+        meta["run_ids"] = [str(i) for i in self.run_stats_df.index]
+        meta["alignment_sums"] = None if self.alignment_sums is None else self.alignment_sums.to_dict()
+        meta["columns"] = OrderedDict()
+        meta["sample_columns"] = []
+        arrays = OrderedDict()
+        arrays["coverage"] = self.coverage
+        arrays["run_stats"] = self.run_stats_df[["count", "min", "max"]].values.astype(np.float64)
+        arrays["sample_keys"] = self._sample_keys
+
+        for i, (col, col_acc) in enumerate(self.columns_dict.items()):
+            col_meta, col_arrays = col_acc.get_state()
+            meta["columns"][col] = col_meta
+            for name, a in col_arrays.items():
+                arrays["column_{}_{}".format(i, name)] = a
+
+        if self.sample_df is not None:
+            for i, col in enumerate(self.sample_df.columns):
+                a = self.sample_df[col].values
+                if a.dtype == object:
+                    # Strings are saved as codes of their distinct values, -1 for NA
+                    codes, categories = pd.factorize(a)
+                    arrays["sample_{}".format(i)] = codes.astype(np.int32)
+                    arrays["sample_{}_categories".format(i)] = categories.astype(str)
+                    meta["sample_columns"].append({"name":col, "kind":"string"})
+                else:
+                    arrays["sample_{}".format(i)] = a
+                    meta["sample_columns"].append({"name":col, "kind":"numpy"})
+        return (meta, arrays)
+
+    @classmethod
+    def from_state (cls, meta, arrays):
+        """Rebuild an accumulator from the dicts generated by get_state"""
+        self = cls.__new__(cls)
+        self.sample = meta["sample"]
+        self.n_reads = meta["n_reads"]
+        self.ref_offset_dict = OrderedDict(meta["ref_offset_dict"])
+        self.total_ref_len = meta["total_ref_len"]
+        self.coverage_bin_size = meta["coverage_bin_size"]
+        self.coverage = np.array(arrays["coverage"], dtype=np.float64)
+        self.run_stats_df = pd.DataFrame(arrays["run_stats"].reshape(-1, 3), index=pd.Index(meta["run_ids"], dtype=object),
+            columns=["count", "min", "max"], dtype="float64")
+        self.alignment_sums = None if meta["alignment_sums"] is None else pd.Series(meta["alignment_sums"], dtype="float64")
+        self._sample_keys = np.array(arrays["sample_keys"], dtype=np.uint64)
+
+        self.columns_dict = OrderedDict()
+        for i, (col, col_meta) in enumerate(meta["columns"].items()):
+            prefix = "column_{}_".format(i)
+            col_arrays = {k[len(prefix):]:v for k, v in arrays.items() if k.startswith(prefix)}
+            self.columns_dict[col] = Column_accumulator.from_state(col_meta, col_arrays)
+
+        self.sample_df = None
+        if meta["sample_columns"]:
+            col_dict = OrderedDict()
+            for i, col_meta in enumerate(meta["sample_columns"]):
+                a = arrays["sample_{}".format(i)]
+                if col_meta["kind"] == "string":
+                    a = np.asarray(pd.Categorical.from_codes(a, arrays["sample_{}_categories".format(i)].astype(object)), dtype=object)
+                col_dict[col_meta["name"]] = a
+            self.sample_df = pd.DataFrame(col_dict)
+        return self
+
+    def truncate_sample (self, sample):
+        """Keep at most sample reads in the sample, the ones that would have been drawn with this sample size"""
+        self.sample = min(self.sample, sample)
+        if self.sample_df is not None and len(self._sample_keys) > self.sample:
+            idx = np.sort(np.argpartition(self._sample_keys, self.sample)[:self.sample])
+            self.sample_df = self.sample_df.iloc[idx].reset_index(drop=True)
+            self._sample_keys = self._sample_keys[idx]
+
+    def drop_columns (self, columns):
+        """Remove columns from the summarised columns and from the sample"""
+        for col in columns:
+            self.columns_dict.pop(col, None)
+        if self.sample_df is not None:
+            self.sample_df = self.sample_df.drop(columns=columns, errors="ignore")
+
+    def set_time_offsets (self, runid_offset_dict):
+        """Shift start times per run_id and update the start_time range accordingly"""
+        if not self.n_reads:
+            return
+        offsets = pd.Series(runid_offset_dict, dtype="float64")
+        run_stats_df = self.run_stats_df[self.run_stats_df.index.isin(offsets.index)]
+        start_time = self.columns_dict["start_time"]
+        start_time._min = float((run_stats_df["min"]+offsets[run_stats_df.index]).min())
+        start_time._max = float((run_stats_df["max"]+offsets[run_stats_df.index]).max())
+
+        self.sample_df["start_time"] += self.sample_df["run_id"].map(offsets).astype("float32").values
+        self.sample_df = self.sample_df.sort_values("start_time")
+
+    def unset_barcodes (self, barcode_list, label="unclassified"):
+        """Replace the barcodes in barcode_list by label"""
+        if "barcode" in self:
+            self.columns_dict["barcode"].replace(barcode_list, label)
+            self.sample_df.loc[self.sample_df["barcode"].isin(barcode_list), "barcode"] = label
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def _merge_run_stats (self, run_stats_df):
+        """Combine per run_id counts and time ranges"""
+        df = pd.concat([self.run_stats_df, run_stats_df.astype("float64")])
+        self.run_stats_df = df.groupby(level=0).agg({"count":"sum", "min":"min", "max":"max"})
+
+    def _update_sample (self, df, keys):
+        """Bottom-k sampling: keep the reads with the smallest sampling keys. Samples are mergeable and deterministic"""
+        if self.sample_df is not None and len(self._sample_keys) >= self.sample:
+            mask = keys < self._sample_keys.max()
+            df, keys = df[mask], keys[mask]
+        if df.empty:
+            return
+
+        # Categories differ between chunks, keep plain python objects in sample
+        df = df.astype({col:object for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)})
+        df = df.astype({col:dtype for col, dtype in self.sample_dtype_dict.items() if col in df})
+
+        if self.sample_df is not None:
+            df = pd.concat([self.sample_df, df], ignore_index=True, sort=False)
+            keys = np.concatenate([self._sample_keys, keys])
+        if len(keys) > self.sample:
+            idx = np.sort(np.argpartition(keys, self.sample)[:self.sample])
+            df = df.iloc[idx]
+            keys = keys[idx]
+        self.sample_df = df.reset_index(drop=True)
+        self._sample_keys = keys
+
+class Column_accumulator ():
+    """
+    Mergeable summary of the values of a column, with memory bounded by the number of distinct values.
+    Implements the subset of the pandas.Series interface used by pycoQC_plot
+    """
+
+    def __init__ (self, keep_values=True, resolution=None):
+        """
+        * keep_values
+            If True the count of each distinct value is kept, allowing to compute exact quantiles, N50 and histograms
+        * resolution
+            If given, values are rounded to this resolution before counting
+        """
+        self.keep_values = keep_values
+        self.resolution = resolution
+        self.n_values = 0
+        self.n_na = 0
+        self._sum = 0
+        self._min = None
+        self._max = None
+        self._counts = pd.Series(dtype="int64")
+
+    def __len__ (self):
+        return self.n_values+self.n_na
+
+    def __repr__(self):
+        return "[{}] {:,} values".format(self.__class__.__name__, self.n_values)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def update (self, s):
+        """Add the values of a pandas Series"""
+        n = len(s)
+        s = s.dropna()
+        self.n_na += n-len(s)
+        self.n_values += len(s)
+        if s.empty:
+            return
+
+        is_numeric = pd.api.types.is_numeric_dtype(s.dtype)
+        if is_numeric:
+            self._sum += s.sum()
+            self._update_range(s.min(), s.max())
+
+        if self.keep_values:
+            if is_numeric:
+                if self.resolution:
+                    values = np.round(s.to_numpy(dtype=np.float64)/self.resolution).astype(np.int64)
+                else:
+                    values = s.to_numpy(dtype=np.int64)
+                values, counts = np.unique(values, return_counts=True)
+                counts = pd.Series(counts, index=values)
+            else:
+                counts = s.value_counts()
+                counts = counts[counts>0]
+                counts.index = counts.index.astype(object)
+            self._counts = self._counts.add(counts, fill_value=0).astype("int64")
+
+    def merge (self, other):
+        """Merge another Column_accumulator in the current one"""
+        self.n_values += other.n_values
+        self.n_na += other.n_na
+        self._sum += other._sum
+        if other._min is not None:
+            self._update_range(other._min, other._max)
+        self._counts = self._counts.add(other._counts, fill_value=0).astype("int64")
+        return self
+
+    def get_state (self):
+        """Return a json serialisable dict describing the accumulator and a dict of the arrays of distinct values and counts"""
+        to_python = lambda v: v.item() if hasattr(v, "item") else v
+        meta = OrderedDict()
+        meta["keep_values"] = self.keep_values
+        meta["resolution"] = self.resolution
+        meta["n_values"] = self.n_values
+        meta["n_na"] = self.n_na
+        meta["sum"] = to_python(self._sum)
+        meta["min"] = to_python(self._min)
+        meta["max"] = to_python(self._max)
+        meta["values_name"] = self._counts.index.name
+        if pd.api.types.is_numeric_dtype(self._counts.index.dtype):
+            meta["values_kind"] = "numeric"
+            values = self._counts.index.values.astype(np.int64)
+        else:
+            meta["values_kind"] = "string"
+            values = self._counts.index.values.astype(str)
+        return (meta, {"values":values, "counts":self._counts.values.astype(np.int64)})
+
+    @classmethod
+    def from_state (cls, meta, arrays):
+        """Rebuild an accumulator from the dicts generated by get_state"""
+        self = cls(keep_values=meta["keep_values"], resolution=meta["resolution"])
+        self.n_values = meta["n_values"]
+        self.n_na = meta["n_na"]
+        self._sum = meta["sum"]
+        self._min = meta["min"]
+        self._max = meta["max"]
+        values = arrays["values"]
+        if meta["values_kind"] == "string":
+            values = values.astype(object)
+        self._counts = pd.Series(np.asarray(arrays["counts"], dtype=np.int64), index=pd.Index(values, name=meta["values_name"]))
+        return self
+
+    def replace (self, value_list, new_value):
+        """Reassign the counts of all values in value_list to new_value"""
+        moved = self._counts[self._counts.index.isin(value_list)]
+        self._counts = self._counts[~self._counts.index.isin(value_list)]
+        if moved.sum():
+            self._counts = self._counts.add(pd.Series({new_value:moved.sum()}), fill_value=0).astype("int64")
+
+    def dropna (self):
+        c = copy.copy(self)
+        c.n_na = 0
+        return c
+
+    def count (self):
+        return self.n_values
+
+    def sum (self):
+        return self._sum
+
+    def min (self):
+        return self._min
+
+    def max (self):
+        return self._max
+
+    def nunique (self):
+        return len(self._counts)
+
+    def value_counts (self):
+        return self._counts.sort_values(ascending=False)
+
+    def median (self):
+        return self.quantile(0.5)
+
+    def quantile (self, q=0.5):
+        """Quantiles with the same linear interpolation as numpy and pandas"""
+        values, counts = self._values_counts()
+        cum_counts = np.cumsum(counts)
+        h = (cum_counts[-1]-1)*np.asarray(q, dtype=np.float64)
+        lo_val = values[np.searchsorted(cum_counts, np.floor(h), side="right")]
+        hi_val = values[np.searchsorted(cum_counts, np.ceil(h), side="right")]
+        return lo_val+(h-np.floor(h))*(hi_val-lo_val)
+
+    def N50 (self):
+        values, counts = self._values_counts()
+        cum_sum = np.cumsum(values*counts)
+        return values[np.searchsorted(cum_sum, cum_sum[-1]/2, side="left")]
+
+    def histogram (self, bins):
+        """Same as numpy.histogram"""
+        values, counts = self._values_counts()
+        return np.histogram(a=values, bins=bins, weights=counts)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PRIVATE METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def _update_range (self, min_val, max_val):
+        self._min = min_val if self._min is None else min(self._min, min_val)
+        self._max = max_val if self._max is None else max(self._max, max_val)
+
+    def _values_counts (self):
+        """Sorted distinct values and their counts"""
+        if not self.keep_values:
+            raise pycoQCError ("Values distribution not available for this column")
+        counts = self._counts.sort_index()
+        values = counts.index.values.astype(np.float64)
+        if self.resolution:
+            values = values*self.resolution
+        return (values, counts.values)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~QC STATE~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class QC_state ():
+    """
+    Partial QC state of a subset of reads, generated by pycoQC_stream.get_state. Holds the read accumulators before the
+    run_ids ordering and the barcode cleanup (value distributions, run time ranges, alignment totals, binned coverage and
+    random sample), the exact read counters and the alignment counts. States of disjoint subsets of reads, for example
+    one per flowcell, can be saved in compact files, merged, and rendered by pycoQC_plot and pycoQC_report.
+    The size of a saved state does not depend on the number of reads: the value distributions take a few tens of KB and
+    each sampled read about 18 bytes per accumulator, so about 120 KB with the default sample of 2000 reads
+    """
+    # Parser attributes saved with the state. The pass reads definition has to be identical to merge states
+    options_attributes = ["runid_list", "filter_calibration", "filter_duplicated", "min_barcode_percent", "min_time",
+        "max_time", "pass_only", "min_pass_qual", "min_pass_len", "read_fields"]
+    merge_options = ["min_pass_qual", "min_pass_len"]
+    files_attributes = ["summary_files_list", "barcode_files_list", "bam_file_list"]
+    state_version = 2
+
+    def __init__ (self, all_reads, pass_reads, counter, discarded_dict, alignments_df, ref_len_dict, files_dict, options):
+        """
+        * all_reads
+            Reads_accumulator of all the valid reads
+        * pass_reads
+            Reads_accumulator of the pass reads
+        * counter
+            Dict of read and file counts collected during parsing
+        * discarded_dict
+            Dict of counts of reads discarded by each filter
+        * alignments_df
+            Dataframe of alignments counts per category
+        * ref_len_dict
+            Dict of reference lengths
+        * files_dict
+            Dict of source files lists
+        * options
+            Dict of parsing options
+        """
+        self.all_reads = all_reads
+        self.pass_reads = pass_reads
+        self.counter = counter
+        self.discarded_dict = discarded_dict
+        self.alignments_df = alignments_df
+        self.ref_len_dict = ref_len_dict
+        self.files_dict = files_dict
+        self.options = options
+
+    def __len__ (self):
+        return len(self.all_reads)
+
+    def __repr__(self):
+        return "[{}] {:,} reads from {:,} summary files".format(self.__class__.__name__, len(self), len(self.files_dict["summary_files_list"]))
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~PUBLIC METHODS~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def merge (self, *others):
+        """
+        Merge the states of other disjoint subsets of reads in the current one. Reads present in several states are
+        counted several times. Return the current state
+        """
+        for other in others:
+            if not isinstance(other, QC_state):
+                raise pycoQCError ("{} is not a valid QC_state object".format(other))
+            for attr in self.merge_options:
+                if self.options[attr] != other.options[attr]:
+                    raise pycoQCError ("Cannot merge states with different {} ({} and {})".format(attr, self.options[attr], other.options[attr]))
+            for ref, ref_len in other.ref_len_dict.items():
+                if self.ref_len_dict.setdefault(ref, ref_len) != ref_len:
+                    raise pycoQCError ("Cannot merge states with different lengths for reference {}".format(ref))
+
+            # Only keep the columns found in both states, as when parsing summary files with different optional columns
+            if len(self.all_reads) and len(other.all_reads):
+                self_only = [col for col in self.all_reads.columns_dict if not col in other.all_reads]
+                other_only = [col for col in other.all_reads.columns_dict if not col in self.all_reads]
+                for acc in (self.all_reads, self.pass_reads):
+                    acc.drop_columns(self_only)
+                if other_only:
+                    other = copy.deepcopy(other)
+                    for acc in (other.all_reads, other.pass_reads):
+                        acc.drop_columns(other_only)
+
+            self.all_reads.merge(other.all_reads)
+            self.pass_reads.merge(other.pass_reads)
+            for d, other_d in ((self.counter, other.counter), (self.discarded_dict, other.discarded_dict)):
+                for k, v in other_d.items():
+                    d[k] = d.get(k, 0)+v
+            for attr, files_list in other.files_dict.items():
+                self.files_dict[attr] = self.files_dict[attr]+files_list
+
+            # Sum alignment counts per category
+            if not other.alignments_df.empty:
+                df = pd.concat([self.alignments_df, other.alignments_df]).groupby("Alignments", sort=False)["Counts"].sum().reset_index()
+                df["Percents"] = (df["Counts"]/df["Counts"].sum()*100).round(2)
+                self.alignments_df = df
+        return self
+
+    def save (self, fn):
+        """Save the state in a single compressed npz file"""
+        meta = OrderedDict()
+        meta["version"] = self.state_version
+        meta["counter"] = self.counter
+        meta["discarded_dict"] = self.discarded_dict
+        meta["alignments"] = self.alignments_df.to_dict(orient="list")
+        meta["ref_len_dict"] = self.ref_len_dict
+        meta["files_dict"] = self.files_dict
+        meta["options"] = self.options
+        arrays = OrderedDict()
+        for name in ("all_reads", "pass_reads"):
+            meta[name], acc_arrays = getattr(self, name).get_state()
+            for k, a in acc_arrays.items():
+                arrays["{}/{}".format(name, k)] = a
+
+        meta = json.dumps(meta, default=lambda o: o.item() if hasattr(o, "item") else str(o))
+        mkbasedir(fn, exist_ok=True)
+        with open(fn, "wb") as fp:
+            np.savez_compressed(fp, meta=np.frombuffer(meta.encode(), dtype=np.uint8), **arrays)
+
+    @classmethod
+    def load (cls, fn):
+        """Load a state saved with save"""
+        try:
+            with np.load(fn, allow_pickle=False) as npz:
+                arrays = {k:npz[k] for k in npz.files}
+            meta = json.loads(arrays.pop("meta").tobytes().decode(), object_pairs_hook=OrderedDict)
+        except (OSError, ValueError, KeyError) as E:
+            raise pycoQCError ("{} is not a valid QC state file: {}".format(fn, E))
+        if meta.get("version") != cls.state_version:
+            raise pycoQCError ("QC state file {} was saved with an incompatible version".format(fn))
+
+        acc_dict = {}
+        for name in ("all_reads", "pass_reads"):
+            prefix = name+"/"
+            acc_arrays = {k[len(prefix):]:v for k, v in arrays.items() if k.startswith(prefix)}
+            acc_dict[name] = Reads_accumulator.from_state(meta[name], acc_arrays)
+
+        return cls (
+            all_reads = acc_dict["all_reads"],
+            pass_reads = acc_dict["pass_reads"],
+            counter = meta["counter"],
+            discarded_dict = meta["discarded_dict"],
+            alignments_df = pd.DataFrame(meta["alignments"]),
+            ref_len_dict = meta["ref_len_dict"],
+            files_dict = meta["files_dict"],
+            options = meta["options"])
@@ -33,6 +33,9 @@ setup(
         'h5py>=3.1',
         'tqdm>=4.54',
         'pysam>=0.16'],
+    extras_require = {
+        'zstd': ['zstandard'],
+        'lz4': ['lz4']},
     packages = ['pycoQC'],
     package_dir = {'pycoQC': 'pycoQC'},
     package_data = {'pycoQC': ['templates/*']},
@@ -40,5 +43,6 @@ setup(
         'console_scripts': [
             'pycoQC=pycoQC.__main__:main_pycoQC',
             'Fast5_to_seq_summary=pycoQC.__main__:main_Fast5_to_seq_summary',
-            'Barcode_split=pycoQC.__main__:main_Barcode_split']}
+            'Barcode_split=pycoQC.__main__:main_Barcode_split',
+            'Reads_query=pycoQC.__main__:main_Reads_query']}
 )
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+# Standard library imports
+import re
+
+# Third party imports
+import numpy as np
+
+# Local imports
+from pycoQC.common import *
+
+#~~~~~~~ TESTS ~~~~~~~#
+
+def test_cigar_op_lengths ():
+    cigars = ["10S5M2I3M1D20M", "", "100M", "3H12S1I1I104M4D7S"]
+    res = cigar_op_lengths(cigars, "IDS")
+    assert res.tolist() == [[2, 1, 10], [0, 0, 0], [0, 0, 0], [2, 4, 19]]
+
+def test_cigar_op_lengths_random ():
+    rng = np.random.default_rng(0)
+    ops = "MIDNSHP=X"
+    cigars = []
+    for _ in range(500):
+        n_ops = rng.integers(0, 20)
+        cigars.append("".join("{}{}".format(rng.integers(1, 100000), ops[rng.integers(len(ops))]) for _ in range(n_ops)))
+    res = cigar_op_lengths(cigars, ops)
+    for cigar, row in zip(cigars, res):
+        expected = [sum(int(n) for n, op in re.findall(r"(\d+)([A-Z=])", cigar) if op == o) for o in ops]
+        assert row.tolist() == expected
+
+def test_count_chars ():
+    assert count_chars(["20A10^CGT30G0t35", "", "ACGT"], "ATCGatcg").tolist() == [6, 0, 4]
+    assert count_chars([":20*ag:10-cgt:30*ga*tc+aa:35", ":100"], "*").tolist() == [3, 0]
+
+def test_alignment_error_stats ():
+    # 100 aligned bases with 2 inserted and 3 deleted bases, 3 substitutions
+    tag_kind = np.array([ERROR_TAG_NM, ERROR_TAG_MD, ERROR_TAG_CS, ERROR_TAG_DE, ERROR_TAG_NONE, ERROR_TAG_NM])
+    align_len = np.array([100, 100, 100, 100, 100, 0])
+    insertion = np.array([2, 2, 2, 2, 2, 0])
+    deletion = np.array([3, 3, 3, 3, 3, 0])
+    nm = np.array([8, 0, 0, 0, 0, 0])
+    tag_strings = ["", "20A10^CGT30G0T35", ":20*ag:10-cgt:30*ga*tc+aa:35", "", "", ""]
+    de = np.array([0, 0, 0, 0.05, 0, 0])
+    mismatch, identity = alignment_error_stats(align_len, insertion, deletion, tag_kind, nm, tag_strings, de)
+    assert mismatch[:3].tolist() == [3, 3, 3] and mismatch[5] == 0
+    assert np.isnan(mismatch[3]) and np.isnan(mismatch[4])
+    assert np.allclose(identity[[0, 1, 2, 3, 5]], [0.92, 0.92, 0.92, 0.95, 0.0])
+    assert np.isnan(identity[4])
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# Standard library imports
+import bz2
+import gzip
+import lzma
+import sys
+import zipfile
+
+# Third party imports
+import numpy as np
+import pysam as ps
+import pytest
+
+# Local imports
+from pycoQC.common import *
+
+#~~~~~~~ HELPERS ~~~~~~~#
+
+def make_data (n_lines, seed=0):
+    """Deterministic tabulated lines of variable lengths, preceded by a header line"""
+    rng = np.random.default_rng(seed)
+    lines = [b"read_id\tvalue\n"]
+    for i, n in enumerate(rng.integers(1, 200, n_lines)):
+        lines.append("read_{}\t{}\n".format(i, "x"*n).encode("ascii"))
+    return lines
+
+#~~~~~~~ TESTS ~~~~~~~#
+
+def test_open_file_plain (tmp_path):
+    data = b"".join(make_data(1000))
+    fn = tmp_path/"plain.txt"
+    fn.write_bytes(data)
+    for threads in (1, 2):
+        with open_file(str(fn), threads=threads) as fp:
+            assert fp.read() == data
+
+def test_open_file_multi_member_gzip (tmp_path):
+    lines = make_data(20000)
+    fn = tmp_path/"multi.txt.gz"
+    with open(fn, "wb") as fp:
+        for i in range(0, len(lines), 7000):
+            fp.write(gzip.compress(b"".join(lines[i:i+7000])))
+    assert not is_bgzf(fn.read_bytes()[:18])
+    for threads in (1, 2):
+        with open_file(str(fn), threads=threads) as fp:
+            assert fp.read() == b"".join(lines)
+
+def test_open_file_bgzf (tmp_path):
+    # BGZF blocks hold up to 64 KB of uncompressed data
+    data = b"".join(make_data(20000))
+    assert len(data) > 10*65536
+    fn = tmp_path/"blocks.txt.gz"
+    with ps.BGZFile(str(fn), "wb") as fp:
+        fp.write(data)
+    assert is_bgzf(fn.read_bytes()[:18])
+    for threads in (1, 3):
+        with open_file(str(fn), threads=threads) as fp:
+            assert fp.read() == data
+
+    # Batches smaller than the number of blocks and reads smaller than the blocks
+    with BGZF_reader(str(fn), threads=2, batch_size=1) as fp:
+        chunks = []
+        while True:
+            chunk = fp.read(1000)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    assert b"".join(chunks) == data
+
+def test_bgzf_reader_crc_check (tmp_path):
+    fn = tmp_path/"blocks.txt.gz"
+    with ps.BGZFile(str(fn), "wb") as fp:
+        fp.write(b"".join(make_data(1000)))
+    # Corrupt the CRC of the first block
+    raw = bytearray(fn.read_bytes())
+    block_size = raw[16]+(raw[17] << 8)+1
+    raw[block_size-8] ^= 0xFF
+    fn.write_bytes(bytes(raw))
+    with pytest.raises(pycoQCError, match="CRC"):
+        with BGZF_reader(str(fn), threads=2) as fp:
+            fp.read()
+
+@pytest.mark.parametrize("fmt, compress", [
+    ("bz2", bz2.compress),
+    ("xz", lzma.compress),
+    ("zip", None)])
+def test_open_file_stdlib_formats (tmp_path, fmt, compress):
+    data = b"".join(make_data(1000))
+    fn = tmp_path/"data.txt.{}".format(fmt)
+    if compress:
+        fn.write_bytes(compress(data))
+    else:
+        with zipfile.ZipFile(fn, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("data.txt", data)
+    assert split_file_ranges(str(fn), 4, min_range_size=1) == []
+    assert estimate_file_rows(str(fn)) == 1000
+    for threads in (1, 2):
+        with open_file(str(fn), threads=threads) as fp:
+            assert fp.read() == data
+
+@pytest.mark.parametrize("module, magic", [
+    ("zstandard", b"\x28\xb5\x2f\xfd"),
+    ("lz4", b"\x04\x22\x4d\x18")])
+def test_open_file_missing_optional_package (tmp_path, monkeypatch, module, magic):
+    fn = tmp_path/"data.txt"
+    fn.write_bytes(magic+b"\x00"*32)
+    # A None entry in sys.modules makes the import fail
+    monkeypatch.setitem(sys.modules, module, None)
+    monkeypatch.setitem(sys.modules, "lz4.frame", None)
+    with pytest.raises(pycoQCError, match="The {} package is required".format(module)):
+        open_file(str(fn))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# Standard library imports
+import gzip
+
+# Third party imports
+import numpy as np
+import pysam as ps
+
+# Local imports
+from pycoQC.common import *
+
+#~~~~~~~ HELPERS ~~~~~~~#
+
+def make_lines (n_lines, seed=0):
+    """Deterministic tabulated lines of variable lengths, preceded by a header line"""
+    rng = np.random.default_rng(seed)
+    lines = [b"read_id\tvalue\n"]
+    for i, n in enumerate(rng.integers(1, 200, n_lines)):
+        lines.append("read_{}\t{}\n".format(i, "x"*n).encode("ascii"))
+    return lines
+
+def write_bgzf (fn, data):
+    """Write data to a BGZF file made of many blocks"""
+    with ps.BGZFile(str(fn), "wb") as fp:
+        fp.write(data)
+
+def check_ranges (fn, lines, n_ranges):
+    """The lines of contiguous ranges covering the file are all the lines after the header, each exactly once"""
+    ranges = split_file_ranges(str(fn), n_ranges, min_range_size=1)
+    assert 1 < len(ranges) <= n_ranges
+    assert ranges[0][0] == 0
+    for (_, end, _, _), (start, _, _, _) in zip(ranges[:-1], ranges[1:]):
+        assert end == start
+    data = b"".join(b"".join(iter_range_lines(str(fn), *r)) for r in ranges)
+    assert data == b"".join(lines[1:])
+
+#~~~~~~~ TESTS ~~~~~~~#
+
+def test_split_file_ranges_plain (tmp_path):
+    lines = make_lines(5000)
+    fn = tmp_path/"plain.txt"
+    fn.write_bytes(b"".join(lines))
+    for n_ranges in (2, 3, 7, 64):
+        check_ranges(fn, lines, n_ranges)
+
+    # Ranges starting exactly on line starts
+    bounds = np.cumsum([len(l) for l in lines])
+    ranges = [(0, int(bounds[10]), None, False), (int(bounds[10]), int(bounds[-1]), None, False)]
+    assert b"".join(iter_range_lines(str(fn), *ranges[0])) == b"".join(lines[1:11])
+    assert b"".join(iter_range_lines(str(fn), *ranges[1])) == b"".join(lines[11:])
+
+def test_split_file_ranges_bgzf (tmp_path):
+    lines = make_lines(20000)
+    fn = tmp_path/"blocks.txt.gz"
+    write_bgzf(fn, b"".join(lines))
+    assert len(bgzf_block_offsets(str(fn))) > 4
+    for n_ranges in (2, 3, 5):
+        check_ranges(fn, lines, n_ranges)
+
+def test_bgzf_block_offsets_index (tmp_path):
+    fn = tmp_path/"blocks.txt.gz"
+    write_bgzf(fn, b"".join(make_lines(20000)))
+    offsets = bgzf_block_offsets(str(fn))
+
+    # The bgzip .gzi index lists the compressed and uncompressed offsets of all the blocks but the first
+    index = np.array([[offset, 0] for offset in offsets[1:]], dtype="<u8")
+    with open(str(fn)+".gzi", "wb") as fp:
+        fp.write(np.array([len(index)], dtype="<u8").tobytes()+index.tobytes())
+    assert bgzf_block_offsets(str(fn)) == offsets
+
+def test_split_file_ranges_gzip (tmp_path):
+    fn = tmp_path/"plain.txt.gz"
+    fn.write_bytes(gzip.compress(b"".join(make_lines(5000))))
+    assert split_file_ranges(str(fn), 4, min_range_size=1) == []
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+# Standard library imports
+from os import path
+
+# Third party imports
+import pytest
+
+# Local imports
+from pycoQC.common import pycoQCError
+from pycoQC.pycoQC_parse import pycoQC_parse
+from pycoQC.pycoQC_stream import pycoQC_stream
+
+SUMMARY_FILE = path.join(path.dirname(__file__), "..", "docs", "pycoQC", "data", "Albacore-2.1.10_basecall-1D-RNA_sequencing_summary.txt.gz")
+
+#~~~~~~~ TESTS ~~~~~~~#
+
+@pytest.mark.parametrize("parser_class", [pycoQC_parse, pycoQC_stream])
+@pytest.mark.parametrize("kwargs, filter_name", [
+    (dict(runid_list=["unknown_run_id"]), "run ID"),
+    (dict(min_time=1000), "time window"),
+    (dict(pass_only=True, min_pass_qual=100), "pass reads")])
+def test_parse_filters_discarding_all_reads (parser_class, kwargs, filter_name):
+    with pytest.raises(pycoQCError, match="No valid read left after {} filtering".format(filter_name)):
+        parser_class(SUMMARY_FILE, quiet=True, **kwargs)
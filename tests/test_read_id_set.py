@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Standard library imports
+import gzip
+from os import path
+
+# Third party imports
+import numpy as np
+import pytest
+
+# Local imports
+from pycoQC.common import *
+from pycoQC.pycoQC_parse import pycoQC_parse
+from pycoQC.pycoQC_stream import pycoQC_stream
+
+SUMMARY_FILE = path.join(path.dirname(__file__), "..", "docs", "pycoQC", "data", "Guppy-2.1.3_basecall-1D-DNA_sequencing_summary.txt.gz")
+
+#~~~~~~~ TESTS ~~~~~~~#
+
+def test_read_id_set_matches_python_set ():
+    rng = np.random.default_rng(1)
+    pool = rng.integers(0, 2**63, (5000, 2), dtype=np.int64).astype(np.uint64)
+    for n_partitions in (1, 4, 64):
+        # Small capacity so that partitions are resized while keys are added
+        s = Read_id_set(capacity=16, n_partitions=n_partitions)
+        ref = set()
+        for _ in range(20):
+            keys = pool[rng.integers(0, len(pool), 700)]
+            found = s.add_new(keys)
+            expected = []
+            for key in map(tuple, keys.tolist()):
+                expected.append(key in ref)
+                ref.add(key)
+            assert found.tolist() == expected
+            assert len(s) == len(ref)
+
+        present = np.array(sorted(ref), dtype=np.uint64)
+        absent = np.array([k for k in map(tuple, pool.tolist()) if k not in ref], dtype=np.uint64).reshape(-1, 2)
+        slots = s.find(present)
+        assert (slots >= 0).all() and len(np.unique(slots)) == len(present)
+        assert (s.find(absent) == -1).all()
+
+        # Global slots index the concatenated arrays
+        hi, lo, used, partition_slots = s.get_arrays()
+        assert used[slots].all()
+        assert (hi[slots] == present[:, 0]).all() and (lo[slots] == present[:, 1]).all()
+        assert used.sum() == len(ref) and sum(partition_slots) == len(used) == s.n_slots
+
+        # Round trip through the saved arrays
+        t = Read_id_set.from_arrays(hi, lo, used, partition_slots, len(s), s.max_load)
+        assert len(t) == len(s) and t.n_partitions == n_partitions
+        assert (t.find(present) == slots).all()
+        assert (t.find(absent) == -1).all()
+
+def test_read_id_set_duplicates_within_batch ():
+    keys = np.array([[1, 2], [3, 4], [1, 2], [1, 3], [3, 4], [1, 2]], dtype=np.uint64)
+    s = Read_id_set(n_partitions=4)
+    assert s.add_new(keys).tolist() == [False, False, True, False, True, True]
+    assert len(s) == 3
+    assert s.add_new(keys[::-1]).all()
+    assert len(s) == 3
+
+def test_read_id_set_hashed_read_ids ():
+    read_ids = ["0d6f8ac4-1a4b-4e0c-9a5e-3c1f2b7a9d10", "read_1", "read_2", "read_1", "0d6f8ac4-1a4b-4e0c-9a5e-3c1f2b7a9d10"]
+    s = Read_id_set()
+    assert s.add_new(hash_read_ids(read_ids)).tolist() == [False, False, False, True, True]
+    assert (s.find(hash_read_ids(["read_2", "read_3"])) >= 0).tolist() == [True, False]
+
+@pytest.mark.parametrize("parser_class", [pycoQC_parse, pycoQC_stream])
+def test_duplicated_reads_across_files (tmp_path, parser_class):
+    with gzip.open(SUMMARY_FILE, "rb") as fp:
+        lines = fp.readlines()
+    # The second file repeats every third read of the first one
+    fn_list = [str(tmp_path/"summary_1.txt"), str(tmp_path/"summary_2.txt")]
+    with open(fn_list[0], "wb") as fp:
+        fp.writelines(lines)
+    with open(fn_list[1], "wb") as fp:
+        fp.writelines([lines[0]]+lines[1::3])
+    n_reads = len(lines)-1
+    n_dup = len(lines[1::3])
+
+    parser = parser_class(fn_list, filter_duplicated=True, quiet=True)
+    assert parser.counter["Initial reads"] == n_reads+n_dup
+    assert parser.counter["Duplicated reads discarded"] == n_dup
+    assert parser.counter["Valid reads"] == parser_class(fn_list[0], quiet=True).counter["Valid reads"]
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# Standard library imports
+import gzip
+from os import path
+
+# Third party imports
+import numpy as np
+
+# Local imports
+from pycoQC.pycoQC_stream import pycoQC_stream, QC_state
+
+SUMMARY_FILE = path.join(path.dirname(__file__), "..", "docs", "pycoQC", "data", "Guppy-2.1.3_basecall-1D-DNA_sequencing_summary.txt.gz")
+
+#~~~~~~~ HELPERS ~~~~~~~#
+
+def write_shards (tmp_path, n_shards):
+    """Split the reads of the summary file in n_shards interleaved files. Return the shard files and the full file"""
+    with gzip.open(SUMMARY_FILE, "rb") as fp:
+        lines = fp.readlines()
+    fn_list = []
+    for i in range(n_shards):
+        fn = str(tmp_path/"shard_{}.txt".format(i))
+        with open(fn, "wb") as fp:
+            fp.writelines([lines[0]]+lines[1+i::n_shards])
+        fn_list.append(fn)
+    fn = str(tmp_path/"all.txt")
+    with open(fn, "wb") as fp:
+        fp.writelines(lines)
+    return (fn_list, fn)
+
+def sorted_sample (acc):
+    order = np.argsort(acc._sample_keys)
+    return (acc._sample_keys[order], acc.sample_df.iloc[order].reset_index(drop=True))
+
+def assert_same_accumulators (acc1, acc2):
+    assert len(acc1) == len(acc2)
+    keys1, df1 = sorted_sample(acc1)
+    keys2, df2 = sorted_sample(acc2)
+    assert (keys1 == keys2).all()
+    assert df1.equals(df2)
+    for col in ("read_len", "mean_qscore", "channel"):
+        assert acc1[col].value_counts().sort_index().equals(acc2[col].value_counts().sort_index())
+
+#~~~~~~~ TESTS ~~~~~~~#
+
+def test_merged_states_sample_all_reads (tmp_path):
+    fn_list, all_fn = write_shards(tmp_path, 2)
+    states = [pycoQC_stream(fn, quiet=True).get_state(sample=500) for fn in fn_list]
+    whole = pycoQC_stream(all_fn, quiet=True).get_state(sample=500)
+
+    merged = states[0].merge(states[1])
+    assert len(merged.all_reads.sample_df) == 500
+    assert_same_accumulators(merged.all_reads, whole.all_reads)
+    assert_same_accumulators(merged.pass_reads, whole.pass_reads)
+
+def test_state_sample_does_not_depend_on_chunks (tmp_path):
+    _, all_fn = write_shards(tmp_path, 1)
+    state1 = pycoQC_stream(all_fn, chunksize=1000, quiet=True).get_state(sample=500)
+    state2 = pycoQC_stream(all_fn, quiet=True).get_state(sample=500)
+    assert_same_accumulators(state1.all_reads, state2.all_reads)
+
+def test_state_save_load (tmp_path):
+    _, all_fn = write_shards(tmp_path, 1)
+    state = pycoQC_stream(all_fn, quiet=True).get_state()
+    fn = str(tmp_path/"state.npz")
+    state.save(fn)
+    assert path.getsize(fn) < 200000
+    loaded = QC_state.load(fn)
+    assert_same_accumulators(loaded.all_reads, state.all_reads)
+    assert loaded.counter == state.counter